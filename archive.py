@@ -0,0 +1,87 @@
+from datetime import date, timedelta
+from helpers import transaction, query_all_shards, auto_log
+from shards import all_shards
+from config import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+
+
+# Loan history archival.
+# Returned loans older than ARCHIVE_AFTER_DAYS are moved from 'loans' to 'loans_archive' in the
+# same database file, so the loans table (and its indexes) only keeps the open loans and the
+# recent history that the day-to-day checks work with. Each batch is moved in its own short
+# transaction, copying and deleting the same rows, so a loan is never lost or held twice, and
+# other writers are only blocked for one batch at a time.
+#
+# Queries over the whole history read the 'loans_history' view, which spans both tables.
+# The archive table and the view are part of the schema (see migrations.py).
+
+
+def archive_loans(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, today=None, db=None):
+    """
+    Moves the returned loans that are older than a number of days to the archive.
+
+    Args:
+        older_than_days (int, optional): Archive loans returned more than this many days ago.
+        batch_size (int, optional): Maximum number of loans moved per transaction.
+        today (date, optional): The current date. Defaults to today.
+        db (str, optional): The database to archive. Defaults to every branch database.
+
+    Returns:
+        int: The number of archived loans.
+    """
+    cutoff = str((today or date.today()) - timedelta(days=older_than_days))
+    databases = [db] if db else all_shards()
+
+    archived = 0
+    for database in databases:
+        while True:
+            with transaction(database, write=True) as c:
+                c.execute("SELECT id FROM loans WHERE is_open = 0 AND actual_returndate < ? ORDER BY id LIMIT ?;",
+                          (cutoff, batch_size))
+                ids = [row[0] for row in c.fetchall()]
+
+                if ids:
+                    placeholders = ', '.join('?' for _ in ids)
+                    c.execute(f"INSERT INTO loans_archive SELECT * FROM loans WHERE id IN ({placeholders});", ids)
+                    c.execute(f"DELETE FROM loans WHERE id IN ({placeholders});", ids)
+
+            archived += len(ids)
+            if len(ids) < batch_size:
+                break
+
+    auto_log('Loans archived', log_id=f"{archived} loans")
+
+    return archived
+
+
+def loan_history(customer_id=None, book_id=None):
+    """
+    Returns the loans of a customer or a book, including the archived ones.
+
+    Args:
+        customer_id (str, optional): Only the loans of this customer.
+        book_id (str, optional): Only the loans of this book.
+
+    Returns:
+        list: The loan records, oldest first.
+    """
+    conditions = []
+    parameters = []
+    if customer_id is not None:
+        conditions.append("custID = ?")
+        parameters.append(customer_id)
+    if book_id is not None:
+        conditions.append("bookID = ?")
+        parameters.append(book_id)
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    rows = query_all_shards(query=f"SELECT * FROM loans_history{where};", parameters=tuple(parameters), result=True)
+
+    return sorted(rows, key=lambda row: (str(row[3]), row[0]))
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Nightly archival run: python archive.py [older_than_days]
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AFTER_DAYS
+    print(f"Archived {archive_loans(older_than_days=days)} loans")
@@ -0,0 +1,219 @@
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import helpers
+from dbhandler import DataBaseHandler
+from config import ASYNC_WORKERS, ASYNC_QUEUE_SIZE
+
+
+# Asyncio-compatible data access layer.
+# Every function mirrors a blocking model or helper call and runs it on a dedicated thread pool,
+# so one event loop can serve many desks without blocking on sqlite.
+# The number of calls handed to the pool is bounded: once ASYNC_WORKERS calls are running and
+# ASYNC_QUEUE_SIZE more are queued, further callers wait in the event loop until a slot frees up.
+#
+# Saves, edits and deletes do not take a pool thread: they are handed to the database's writer
+# without waiting (see writer.py), and the event loop awaits the write's future, so many writes
+# can wait for the same group commit. They take a slot of the same bound while they are pending.
+
+_executor = None  # Dedicated thread pool for database work, created on first use
+_slots = weakref.WeakKeyDictionary()  # Event loop -> semaphore bounding the calls handed to the pool
+
+
+def get_executor():
+    """
+    Returns the dedicated database thread pool, creating it on first use.
+
+    Returns:
+        ThreadPoolExecutor: The database thread pool.
+    """
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix='library-db')
+
+    return _executor
+
+
+def shutdown():
+    """
+    Shuts down the database thread pool, waiting for running calls to finish.
+    """
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Runs a blocking database call on the database thread pool.
+
+    Args:
+        func (callable): The blocking function to run.
+        *args: Positional arguments for the function.
+        **kwargs: Keyword arguments for the function.
+
+    Returns:
+        The return value of the function. Exceptions raised by it are re-raised to the caller.
+    """
+    loop = asyncio.get_running_loop()
+
+    async with _slot(loop):
+        return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+
+def _slot(loop):
+    # Each event loop gets its own semaphore, as asyncio primitives are bound to a loop
+    if loop not in _slots:
+        _slots[loop] = asyncio.Semaphore(ASYNC_WORKERS + ASYNC_QUEUE_SIZE)
+
+    return _slots[loop]
+
+
+async def _write(write, *args, **kwargs):
+    # Handing a model write to the writer and awaiting its commit, without a pool thread
+    async with _slot(asyncio.get_running_loop()):
+        await asyncio.wrap_future(write(*args, wait=False, **kwargs))
+
+    return True
+
+
+async def save(obj):
+    """
+    Saves a Book, Customer or Loan object to the database.
+
+    Args:
+        obj (DataBaseHandler): The object to save.
+
+    Returns:
+        bool: True if the operation is successful.
+    """
+    return await _write(obj.save)
+
+
+async def edit(obj, set_clauses, values):
+    """
+    Edits a Book, Customer or Loan object in the database.
+
+    Args:
+        obj (DataBaseHandler): The object to edit.
+        set_clauses (tuple): Tuple of clauses for setting new values.
+        values: New values to be set.
+
+    Returns:
+        bool: True if the operation is successful.
+    """
+    return await _write(obj.edit, set_clauses=set_clauses, values=values)
+
+
+async def delete(obj):
+    """
+    Deletes a Book, Customer or Loan object from the database.
+
+    Args:
+        obj (DataBaseHandler): The object to delete.
+
+    Returns:
+        bool: True if the operation is successful.
+    """
+    return await _write(obj.delete)
+
+
+async def return_book(loan, return_date=None):
+    """
+    Returns a loan, keeping it in the loan history.
+
+    Args:
+        loan (Loan): The loan to return.
+        return_date (str, optional): The return date in 'YYYY-MM-DD' format. Defaults to today.
+
+    Returns:
+        bool: True if the operation is successful.
+    """
+    return await run_db(loan.return_book, return_date=return_date)
+
+
+async def load(table, condition=None):
+    """
+    Loads the records of a table from all branches.
+
+    Args:
+        table (str): Name of the database table to query.
+        condition (str, optional): Condition for filtering the data.
+
+    Returns:
+        list: Data retrieved from the database.
+    """
+    return await run_db(DataBaseHandler.load, table=table, condition=condition)
+
+
+async def load_from_db(cls):
+    """
+    Loads all objects of a model class (Book, Customer or Loan).
+
+    Args:
+        cls (type): The model class.
+
+    Returns:
+        list: The loaded objects.
+    """
+    return await run_db(cls.load_from_db)
+
+
+async def get_by_id(object_id, table):
+    """
+    Fetches a record by ID from a specified table.
+
+    Args:
+        object_id (str): The ID of the record to fetch.
+        table (str): The table name to fetch the record from.
+
+    Returns:
+        tuple: The fetched record.
+
+    Raises:
+        IdNotExist: If the record does not exist.
+    """
+    return await run_db(helpers.get_by_id, object_id, table)
+
+
+async def is_available(book_id):
+    """
+    Checks if a book is currently available for loan.
+
+    Args:
+        book_id (str): The ID of the book to check.
+
+    Raises:
+        BookNotAvailable: If the book is currently on loan and not returned.
+    """
+    return await run_db(helpers.is_available, book_id)
+
+
+async def search_books_by_title(keyword):
+    """
+    Finds books whose title contains a keyword.
+
+    Args:
+        keyword (str): The search keyword.
+
+    Returns:
+        list: The matching book records.
+    """
+    return await run_db(helpers.search_books_by_title, keyword)
+
+
+async def search_customers_by_name(keyword):
+    """
+    Finds customers whose first or last name contains a keyword.
+
+    Args:
+        keyword (str): The search keyword.
+
+    Returns:
+        list: The matching customer records.
+    """
+    return await run_db(helpers.search_customers_by_name, keyword)
@@ -0,0 +1,256 @@
+import argparse
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from shards import all_shards
+from errors import BackupFailed
+from config import BACKUP_DIR, BACKUP_PAGES_PER_STEP, BACKUP_SLEEP, BACKUP_KEEP, BACKUP_MAX_RESTARTS, BUSY_TIMEOUT
+
+
+# Online backups of the library databases.
+# sqlite's backup API copies a live database page by page while the desks keep working, so a
+# backup no longer needs the console to be closed. The copy runs in steps of
+# BACKUP_PAGES_PER_STEP pages, sleeping BACKUP_SLEEP seconds in between; the source is only
+# read-locked during a step, so the desks' writes wait at most for one step, never for the
+# whole file. A write made between two steps makes sqlite restart the copy, which keeps the
+# snapshot consistent: it always holds the database as it was at one point in time.
+# Under a steady stream of writes the copy could restart forever, so after BACKUP_MAX_RESTARTS
+# restarts it is made again in a single step, read-locking the source for the whole copy.
+#
+# Every snapshot is checked with PRAGMA integrity_check before it is kept, optionally
+# compressed with gzip, and the BACKUP_KEEP newest snapshots of every database are kept.
+# Snapshots are named after the database file and the time, e.g.
+# library-20240301-093000-000000.db.gz.
+#
+# Usage: python backup.py [--compress] [--dir system_files/backups] [--keep 7]
+#        python backup.py --verify system_files/backups/library-20240301-093000-000000.db.gz
+
+
+def integrity_problems(path):
+    """
+    Runs PRAGMA integrity_check on a database file.
+
+    Args:
+        path (str): Path of the database file (not compressed).
+
+    Returns:
+        list: The problems found, empty if the file is sound.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("PRAGMA integrity_check;").fetchall()
+    except sqlite3.DatabaseError as e:
+        # Not a database at all, e.g. a truncated file
+        return [str(e)]
+    finally:
+        conn.close()
+
+    return [] if rows == [('ok',)] else [row[0] for row in rows]
+
+
+def verify(path):
+    """
+    Checks the integrity of a snapshot, decompressing it first if needed.
+
+    Args:
+        path (str): Path of the snapshot.
+
+    Raises:
+        BackupFailed: If the snapshot is damaged.
+    """
+    if not path.endswith('.gz'):
+        problems = integrity_problems(path)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            plain = os.path.join(workdir, 'snapshot.db')
+            try:
+                with gzip.open(path, 'rb') as source, open(plain, 'wb') as target:
+                    shutil.copyfileobj(source, target)
+            except (OSError, EOFError) as e:
+                problems = [str(e)]
+            else:
+                problems = integrity_problems(plain)
+
+    if problems:
+        raise BackupFailed(path, problems)
+
+
+def snapshots_of(db, directory=BACKUP_DIR):
+    """
+    Lists the snapshots of a database, oldest first.
+
+    Args:
+        db (str): Path of the database file.
+        directory (str, optional): The backup directory.
+
+    Returns:
+        list: Paths of the snapshots.
+    """
+    prefix = os.path.splitext(os.path.basename(db))[0] + '-'
+    if not os.path.isdir(directory):
+        return []
+
+    # The timestamp in the names sorts them by time
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith(prefix) and name.endswith(('.db', '.db.gz'))
+                   and name[len(prefix):].split('.')[0].replace('-', '').isdigit())
+
+    return [os.path.join(directory, name) for name in names]
+
+
+def rotate(db, directory=BACKUP_DIR, keep=BACKUP_KEEP):
+    """
+    Deletes the oldest snapshots of a database, keeping the newest ones.
+
+    Args:
+        db (str): Path of the database file.
+        directory (str, optional): The backup directory.
+        keep (int, optional): The number of snapshots to keep.
+
+    Returns:
+        list: Paths of the deleted snapshots.
+    """
+    snapshots = snapshots_of(db, directory)
+    expired = snapshots[:-keep] if keep > 0 else snapshots
+
+    for path in expired:
+        os.remove(path)
+
+    return expired
+
+
+class _TooManyRestarts(Exception):
+    # Raised from the progress callback to abandon a stepped copy
+    pass
+
+
+def copy_database(db, target_path, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_SLEEP, progress=None,
+         max_restarts=BACKUP_MAX_RESTARTS):
+    """
+    Copies a live database into a file with sqlite's backup API.
+
+    Args:
+        db (str): Path of the database file.
+        target_path (str): Path of the copy.
+        pages (int, optional): Pages copied per step.
+        sleep (float, optional): Seconds to sleep between two steps.
+        progress (callable, optional): Called with the number of pages left and the total after every step.
+        max_restarts (int, optional): Restarts of the stepped copy before it is made in a single step.
+
+    Returns:
+        int: The number of times the stepped copy restarted.
+    """
+    restarts = 0
+    last = None
+
+    def step(status, remaining, total):
+        nonlocal restarts, last
+        # A write to the source sends the copy back to the first page, so more pages are left
+        if last is not None and remaining > last:
+            restarts += 1
+        last = remaining
+        if progress:
+            progress(remaining, total)
+        if restarts > max_restarts:
+            raise _TooManyRestarts
+
+    source = sqlite3.connect(db, timeout=BUSY_TIMEOUT)
+    target = sqlite3.connect(target_path)
+    try:
+        try:
+            source.backup(target, pages=pages, sleep=sleep, progress=step)
+        except _TooManyRestarts:
+            source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+    return restarts
+
+
+def backup(db, directory=BACKUP_DIR, compress=False, keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP,
+           sleep=BACKUP_SLEEP, progress=None, max_restarts=BACKUP_MAX_RESTARTS):
+    """
+    Copies a live database into a verified snapshot, then rotates the database's snapshots.
+
+    Args:
+        db (str): Path of the database file.
+        directory (str, optional): The backup directory, created if needed.
+        compress (bool, optional): Compress the snapshot with gzip.
+        keep (int, optional): The number of snapshots to keep.
+        pages (int, optional): Pages copied per step.
+        sleep (float, optional): Seconds to sleep between two steps.
+        progress (callable, optional): Called with the number of pages left and the total after every step.
+        max_restarts (int, optional): Restarts of the stepped copy before it is made in a single step.
+
+    Returns:
+        str: Path of the snapshot.
+
+    Raises:
+        BackupFailed: If the copy does not pass the integrity check; nothing is kept then.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"{os.path.splitext(os.path.basename(db))[0]}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.db"
+    path = os.path.join(directory, name)
+    # Writing under a temporary name, so a failed copy is never taken for a snapshot
+    partial = path + '.part'
+
+    try:
+        copy_database(db, partial, pages, sleep, progress, max_restarts)
+
+        problems = integrity_problems(partial)
+        if problems:
+            raise BackupFailed(path, problems)
+
+        if compress:
+            with open(partial, 'rb') as plain, gzip.open(path + '.gz.part', 'wb') as packed:
+                shutil.copyfileobj(plain, packed)
+            os.remove(partial)
+            path += '.gz'
+            partial = path + '.part'
+        os.replace(partial, path)
+    finally:
+        # Nothing of a failed backup is left behind
+        for leftover in (partial, path + '.gz.part'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    rotate(db, directory, keep)
+
+    return path
+
+
+def backup_all(directory=BACKUP_DIR, compress=False, keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP,
+               sleep=BACKUP_SLEEP):
+    """
+    Backs up every branch database (see backup).
+
+    Returns:
+        list: Paths of the snapshots.
+    """
+    return [backup(db, directory, compress, keep, pages, sleep) for db in all_shards()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Back up the library databases while they are in use.')
+    parser.add_argument('--dir', default=BACKUP_DIR, help='Backup directory')
+    parser.add_argument('--compress', action='store_true', help='Compress the snapshots with gzip')
+    parser.add_argument('--keep', type=int, default=BACKUP_KEEP, help='Snapshots to keep per database')
+    parser.add_argument('--pages', type=int, default=BACKUP_PAGES_PER_STEP, help='Pages copied per step')
+    parser.add_argument('--sleep', type=float, default=BACKUP_SLEEP, help='Seconds between two steps')
+    parser.add_argument('--verify', metavar='SNAPSHOT', help='Only check the integrity of a snapshot')
+    args = parser.parse_args()
+
+    if args.verify:
+        verify(args.verify)
+        print(f"{args.verify}: ok")
+    else:
+        for db in all_shards():
+            started = time.perf_counter()
+            snapshot = backup(db, args.dir, args.compress, args.keep, args.pages, args.sleep)
+            print(f"{db} -> {snapshot} ({os.path.getsize(snapshot) / 1e6:.1f} MB, "
+                  f"{time.perf_counter() - started:.1f} s, verified)")
@@ -0,0 +1,89 @@
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from config import DATABASE, SCHEMA_CACHE, SNAPSHOT_FILE
+
+
+# Startup-time benchmark.
+# Launches main.py on a copy of the database and measures the time until the main menu's
+# first prompt is printed, then exits through the menu. Cold starts run without the schema
+# cache and the snapshot (as after an upgrade); warm starts reuse the ones the previous run
+# wrote on exit (as every morning at the desk terminals).
+#
+# Usage: python bench_startup.py [--runs N]
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPT = b'-->'
+
+
+def time_to_prompt(workdir):
+    """
+    Runs main.py once and measures the time until its first prompt.
+
+    Args:
+        workdir (str): The directory to run in, holding a copy of the system files.
+
+    Returns:
+        float: Seconds from launch to the first prompt.
+    """
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(PROJECT_DIR, 'main.py')], cwd=workdir, env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    # Reading the output until the prompt appears
+    output = b''
+    while PROMPT not in output:
+        chunk = process.stdout.read1(4096)
+        if not chunk:
+            raise RuntimeError(f"main.py exited before its first prompt: {output[-200:]!r}")
+        output += chunk
+    elapsed = time.perf_counter() - start
+
+    # Exiting through the menu, so the snapshot is written as in a real session
+    process.communicate(b'0\n', timeout=30)
+
+    return elapsed
+
+
+def run(runs=5):
+    """
+    Measures cold and warm starts on a copy of the database.
+
+    Args:
+        runs (int, optional): The number of starts of each kind.
+
+    Returns:
+        dict: 'cold' and 'warm' -> list of seconds to the first prompt.
+    """
+    workdir = tempfile.mkdtemp()
+    system_files = os.path.join(workdir, os.path.dirname(DATABASE))
+    shutil.copytree(os.path.join(PROJECT_DIR, os.path.dirname(DATABASE)), system_files)
+
+    results = {'cold': [], 'warm': []}
+    try:
+        for _ in range(runs):
+            for cached in (SCHEMA_CACHE, SNAPSHOT_FILE):
+                if os.path.exists(os.path.join(workdir, cached)):
+                    os.remove(os.path.join(workdir, cached))
+            results['cold'].append(time_to_prompt(workdir))
+            results['warm'].append(time_to_prompt(workdir))
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the time from launch to the first prompt.')
+    parser.add_argument('--runs', type=int, default=5, help='Number of cold and warm starts')
+    args = parser.parse_args()
+
+    for kind, times in run(args.runs).items():
+        print(f"{kind:>5}: median {statistics.median(times) * 1000:7.1f} ms, "
+              f"best {min(times) * 1000:7.1f} ms ({len(times)} runs)")
@@ -1,4 +1,5 @@
-from helpers import auto_log, get_by_id, align_input, query_db, check_loans
+from helpers import auto_log, get_by_id, align_input, check_loans
+from search_index import search_books
 from books import Book
 from config import RE_PATT_D, ERRORS
 
@@ -307,6 +308,7 @@ def delete_book(book):
                 book_menu()  # Returning to the book menu
                 return
 
+            book.delete()  # Deleting the book from the database
             auto_log('Book deleted', log_id=book.id)  # Logging the book deletion
             print("\n*** Book deleted successfully ***\n")  # Displaying a success message
             return
@@ -329,22 +331,21 @@ def display_all_books():
 
 def find_book_by_title():
     """
-      Searches for books based on a title keyword.
+      Searches for books based on a title or author keyword.
 
       Allows the user to input a search keyword.
-      Queries the database for books with titles matching the keyword.
+      Looks the keyword up in the catalogue index, which tolerates typos and ranks the best matches first.
       Displays the search results.
       """
     # Looping to allow the user to search for books by title
     while True:
         print('\n')
-        keyword = f"%{input('Enter search keyword: ')}%"
-        if keyword == '%0%':
+        keyword = input('Enter search keyword: ')
+        if keyword == '0':
             return  # Allowing the user to exit the search
 
-        # Querying the database for books matching the search keyword
-        query = "SELECT * FROM books WHERE title LIKE ?;"
-        res_lst = query_db(query=query, parameters=(keyword,), result=True)
+        # Finding the books whose title or author match the search keyword
+        res_lst = search_books(keyword)
 
         # Displaying search results or a message if no matches are found
         if len(res_lst) == 0:
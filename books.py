@@ -1,6 +1,6 @@
 from dbhandler import DataBaseHandler
-from config import BOOKS_FIELDNAMES, RE_PATT_D, ERRORS
-from helpers import query_db, regex_check, check_number, auto_log
+from config import BOOKS_FIELDNAMES, RE_PATT_D, ERRORS, LOAN_DURATIONS
+from helpers import query_all_shards, regex_check, check_number, auto_log, next_id
 from errors import InvalidEntry, InvalidPublicationYear
 from datetime import timedelta
 
@@ -33,8 +33,7 @@ class Book(DataBaseHandler):
 
         # ID assignment logic - auto-generate if not overridden
         if override_id is False:
-            rowid = query_db(query="SELECT MAX(rowid) FROM books", result=True)[0][0]
-            self.id = str(int(rowid) + 1) if rowid else 1
+            self.id = next_id('books')
         if override_id:
             self.id = id_
 
@@ -122,17 +121,8 @@ class Book(DataBaseHandler):
               Returns:
                   timedelta: The duration for which the book can be loaned.
               """
-        # Logic to determine loan duration based on book type
-        duration = None
-
-        if str(self._book_type) == '1':
-            duration = 10
-        elif str(self._book_type) == '2':
-            duration = 5
-        elif str(self._book_type) == '3':
-            duration = 2
-
-        return timedelta(days=duration)
+        # Loan duration based on book type (see LOAN_DURATIONS in config.py)
+        return timedelta(days=LOAN_DURATIONS[int(self._book_type)])
 
     def obj_to_values(self):
         # Convert book object attributes to a tuple for database operations
@@ -192,12 +182,12 @@ class Book(DataBaseHandler):
     @classmethod
     def create_book_table(cls):
         """
-               Class method to create the books table in the database if it does not exist.
+               Class method to create the books table in every branch database if it does not exist.
                """
         # SQL query to create the books table
         query = """
         CREATE TABLE IF NOT EXISTS books (
-            id TEXT PRIMARY KEY,
+            id INTEGER PRIMARY KEY,
             title TEXT NOT NULL,
             author_pname TEXT NOT NULL,
             author_lname TEXT NOT NULL,
@@ -206,4 +196,4 @@ class Book(DataBaseHandler):
         );
         """
 
-        query_db(query=query)
+        query_all_shards(query=query)
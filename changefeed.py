@@ -0,0 +1,210 @@
+import json
+from datetime import datetime
+import events
+from helpers import transaction, query_db
+from shards import all_shards, get_shard
+from migrations import CHANGEFEED_TABLES
+from config import CHANGEFEED_BATCH_SIZE
+
+
+# Change data capture feed of the books, customers and loans.
+# Every row the models insert, update or delete is appended to the 'changes' table, in the
+# transaction of the change, with a sequence number that only grows (AUTOINCREMENT never
+# reuses a number, even after pruning). A consumer, such as a web catalogue cache or a
+# reporting warehouse, reads the changes after the last sequence number it processed, in
+# batches, and saves that number as its checkpoint, instead of re-reading whole tables.
+#
+# Every change holds the row as it is after the change (as JSON), or no data for a deletion.
+# A returned loan is recorded as an update. Every branch database has its own feed and
+# sequence numbers, and the consumers keep one checkpoint per database. The tables are added
+# by schema migration 4.
+#
+# Rows written without the models (e.g. datagen.py) bypass the feed.
+
+FEED_TABLES = ('books', 'customers', 'loans')  # Tables whose changes are captured
+
+
+def create_changefeed_tables():
+    """
+    Creates the 'changes' and 'change_checkpoints' tables in every branch database if they do not exist.
+    """
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            for query in CHANGEFEED_TABLES:
+                c.execute(query)
+
+
+def on_change(action, obj, cursor):
+    """
+    Appends a change of the models to the feed, inside the change's transaction.
+
+    Args:
+        action (str): 'insert', 'update', 'delete' or 'return'.
+        obj (DataBaseHandler): The changed model object.
+        cursor (sqlite3.Cursor): Cursor of the change's transaction.
+    """
+    table = obj.get_table()
+    row_id = obj.get_id()
+    data = None
+
+    if action != 'delete':
+        # Reading the row back, as the object may not hold every value the query set
+        cursor.execute(f"SELECT * FROM {table} WHERE id = ?;", (row_id,))
+        row = cursor.fetchone()
+        if row is not None:
+            data = json.dumps(dict(zip((column[0] for column in cursor.description), row)))
+
+    cursor.execute("INSERT INTO changes (tbl, action, rowID, data, changed) VALUES (?, ?, ?, ?, ?);",
+                   (table, 'update' if action == 'return' else action, row_id, data,
+                    datetime.now().isoformat(timespec='seconds')))
+
+
+def enable_changefeed(create_tables=True):
+    """
+    Creates the feed's tables and starts recording the changes of the models.
+
+    Args:
+        create_tables (bool, optional): False if the tables are known to exist (see migrations.ensure_schema).
+    """
+    if create_tables:
+        create_changefeed_tables()
+    for table in FEED_TABLES:
+        events.subscribe(table, on_change)
+
+
+def pull(after=0, limit=CHANGEFEED_BATCH_SIZE, tables=None, db=None):
+    """
+    Reads the changes that follow a sequence number.
+
+    Args:
+        after (int, optional): The last sequence number already processed.
+        limit (int, optional): The maximum number of changes to return.
+        tables (tuple, optional): Only return the changes of these tables.
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        list: Dicts with 'seq', 'table', 'action', 'id', 'data' (the row as a dict, None for a
+            deletion) and 'changed', in sequence order.
+    """
+    query = "SELECT seq, tbl, action, rowID, data, changed FROM changes WHERE seq > ?"
+    parameters = [after]
+    if tables:
+        query += f" AND tbl IN ({', '.join('?' for _ in tables)})"
+        parameters.extend(tables)
+    query += " ORDER BY seq LIMIT ?;"
+    parameters.append(limit)
+
+    rows = query_db(query=query, parameters=tuple(parameters), db=db, result=True)
+
+    return [{'seq': seq, 'table': table, 'action': action, 'id': row_id,
+             'data': json.loads(data) if data is not None else None, 'changed': changed}
+            for seq, table, action, row_id, data, changed in rows]
+
+
+def last_seq(db=None):
+    """
+    Returns the sequence number of the latest change of a database.
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        int: The latest sequence number, or 0 if no change was recorded.
+    """
+    rows = query_db(query="SELECT MAX(seq) FROM changes;", db=db, result=True)
+
+    return rows[0][0] or 0
+
+
+def first_seq(db=None):
+    """
+    Returns the sequence number of the oldest change still in the feed.
+
+    A reader that did not register a checkpoint (e.g. a snapshot replay) checks it to know
+    whether the changes it needs were pruned.
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        int: The oldest sequence number, or the next one if the feed is empty.
+    """
+    rows = query_db(query="SELECT COALESCE((SELECT MIN(seq) FROM changes), "
+                          "(SELECT seq + 1 FROM sqlite_sequence WHERE name = 'changes'), 1);",
+                    db=db, result=True)
+
+    return rows[0][0]
+
+
+def get_checkpoint(consumer, db=None):
+    """
+    Returns the last sequence number a consumer processed.
+
+    Args:
+        consumer (str): The consumer's name.
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        int: The checkpoint, or 0 for a new consumer.
+    """
+    rows = query_db(query="SELECT seq FROM change_checkpoints WHERE consumer = ?;", parameters=(consumer,),
+                    db=db, result=True)
+
+    return rows[0][0] if rows else 0
+
+
+def set_checkpoint(consumer, seq, db=None):
+    """
+    Saves the last sequence number a consumer processed.
+
+    Args:
+        consumer (str): The consumer's name.
+        seq (int): The sequence number.
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+    """
+    query_db(query="INSERT INTO change_checkpoints (consumer, seq) VALUES (?, ?) "
+                   "ON CONFLICT (consumer) DO UPDATE SET seq = excluded.seq;", parameters=(consumer, seq), db=db)
+
+
+def consume(consumer, handler, limit=CHANGEFEED_BATCH_SIZE, tables=None, db=None):
+    """
+    Hands the next batch of changes to a consumer's handler, then moves its checkpoint past them.
+
+    If the handler raises, the checkpoint is not moved and the batch is handed over again on
+    the next call, so every change is processed at least once.
+
+    Args:
+        consumer (str): The consumer's name.
+        handler (callable): Called with the list of changes (see pull).
+        limit (int, optional): The maximum number of changes in the batch.
+        tables (tuple, optional): Only hand over the changes of these tables.
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        int: The number of changes handed over (0 once the consumer is up to date).
+    """
+    db = db or get_shard()
+    changes = pull(after=get_checkpoint(consumer, db=db), limit=limit, tables=tables, db=db)
+
+    if changes:
+        handler(changes)
+        set_checkpoint(consumer, changes[-1]['seq'], db=db)
+
+    return len(changes)
+
+
+def prune(db=None):
+    """
+    Deletes the changes every consumer has processed.
+
+    Only the consumers with a checkpoint are waited for; a reader without one checks first_seq().
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        int: The number of deleted changes.
+    """
+    with transaction(db, write=True) as c:
+        c.execute("DELETE FROM changes WHERE seq <= (SELECT MIN(seq) FROM change_checkpoints);")
+        return c.rowcount
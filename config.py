@@ -1,11 +1,95 @@
+import os
+
 # Database file path configuration
-DATABASE = r'system_files\library.db'  # Path to the library database file
-LOGGER = r'system_files\logger'        # Path to the logger file
+DATABASE = os.path.join('system_files', 'library.db')  # Path to the library database file
+LOGGER = os.path.join('system_files', 'logger')        # Path to the logger file
+
+# Branch sharding configuration
+# Every branch key maps to its own database file. Rows written by an object are routed to the
+# file of the object's branch, while searches and reports are gathered from all the files.
+DEFAULT_BRANCH = 'main'                        # Branch used when an object has no branch key
+BRANCH_DATABASES = {DEFAULT_BRANCH: DATABASE}  # Branch key -> database file path
+
+# Connection pool configuration
+POOL_SIZE = 8       # Maximum number of open connections per database file
+POOL_TIMEOUT = 30   # Seconds to wait for a free connection
+
+# Lock contention configuration (see retry.py)
+BUSY_TIMEOUT = 0.05        # Seconds sqlite itself waits for a lock before reporting 'database is locked'
+RETRY_TIMEOUT = 10.0       # Seconds of waiting for a lock before giving up (sqlite's own default was 5)
+RETRY_BASE_DELAY = 0.005   # Seconds of backoff after the first failed attempt, doubled after each one
+RETRY_MAX_DELAY = 0.5      # Upper bound of the backoff between two attempts
+
+# Group commit configuration (see writer.py)
+WRITER_MAX_DELAY = 0.0     # Seconds the writer keeps collecting writes after the first one of a batch
+                           # (0: only the writes queued up during the previous commit, adding no latency)
+WRITER_MAX_BATCH = 256     # Maximum number of writes committed together
+
+# Async data access configuration
+ASYNC_WORKERS = 4        # Number of threads running database work for the event loop
+ASYNC_QUEUE_SIZE = 256   # Maximum number of database calls waiting for a worker
+
+# Local HTTP service configuration
+SERVER_HOST = '127.0.0.1'  # Address the service listens on
+SERVER_PORT = 8080         # Port the service listens on
+MAX_BATCH_SIZE = 1000      # Maximum number of IDs accepted by a batch endpoint
+
+# Overdue tracking configuration
+OVERDUE_TICK_SECONDS = 60  # Seconds between two checks for newly overdue loans
+OVERDUE_CHUNK_SIZE = 500   # Due loans re-read and recorded per query (below sqlite's parameter limit)
+
+# Catalogue search configuration
+SEARCH_INDEX_MAX_BOOKS = 200000  # Maximum number of books kept in the in-memory search index
+SEARCH_MIN_SCORE = 0.5           # Lowest share of the query's trigrams a fuzzy match must contain
+
+# Schema state of the database files after the last startup setup (see migrations.ensure_schema)
+SCHEMA_CACHE = os.path.join('system_files', 'schema_cache.json')
+
+# Snapshot of the in-memory structures, written on exit and restored on the next start
+SNAPSHOT_FILE = os.path.join('system_files', 'snapshot.bin')
+
+# Change data capture feed configuration (see changefeed.py)
+CHANGEFEED_BATCH_SIZE = 1000  # Changes handed to a consumer at a time
+
+# Audit log configuration (see audit.py)
+AUDIT_DATABASE = os.path.join('system_files', 'audit.db')  # Path to the audit store, apart from the library database
+AUDIT_BUFFER_SIZE = 500                                    # Buffered records that trigger a write
+AUDIT_FLUSH_SECONDS = 1.0                                  # Seconds between two writes of the buffered records
+
+# Online backup configuration (see backup.py)
+BACKUP_DIR = os.path.join('system_files', 'backups')  # Directory of the snapshots
+BACKUP_PAGES_PER_STEP = 256                           # Pages copied per step, while the source is read-locked
+BACKUP_SLEEP = 0.01                                   # Seconds between two steps, letting the desks write
+BACKUP_KEEP = 7                                       # Snapshots kept per database
+BACKUP_MAX_RESTARTS = 20                              # Restarts by writes before the copy is made in one step
+
+# Columnar export configuration (see export.py)
+EXPORT_DIR = os.path.join('system_files', 'export')  # Directory of the exported .npy column files
+EXPORT_CHUNK_SIZE = 50000                            # Rows read and written at a time
+
+# Loan archival configuration
+ARCHIVE_AFTER_DAYS = 365   # Returned loans older than this many days are moved to the archive
+ARCHIVE_BATCH_SIZE = 500   # Loans moved per transaction
+
+# Borrowing limit configuration (see customer_index.py)
+MAX_OPEN_LOANS = 5  # Open loans a customer may hold at once, unless a limit of their own is set
+
+# Loan duration in days per book type
+LOAN_DURATIONS = {1: 10, 2: 5, 3: 2}
+
+# Synthetic data generation configuration (see datagen.py)
+DATAGEN_CHUNK_SIZE = 50000  # Rows generated by a worker, and written per transaction
+
+# Late fee configuration
+# Book type -> (fine per late day, maximum fine per loan)
+FEE_RATES = {1: (0.5, 10.0),
+             2: (1.0, 15.0),
+             3: (2.0, 20.0)}
 
 # Fieldnames for different tables in the database
 BOOKS_FIELDNAMES = 'id, title, author_pname, author_lname, publication_year, type'  # Column names for books table
 CUSTOMERS_FIELDNAMES = 'id, p_name, l_name, city, age'  # Column names for customers table
-LOAN_FIELDNAMES = 'id, custID, bookID, loandate, expected_returndate, actual_returndate'  # Column names for loan table
+LOAN_FIELDNAMES = 'id, custID, bookID, loandate, expected_returndate, actual_returndate, is_open'  # Column names for loan table
 
 # Regular expression patterns for data validation
 RE_PATT_D = {
@@ -14,12 +98,12 @@ RE_PATT_D = {
     'l_name': r"^[a-z][a-z- .']{1,19}$",  # Pattern for person's last name
     'age': r'^\d{1,3}$',  # Pattern for age
     'city': r'^[a-z][a-z- ]{1,19}$',  # Pattern for city
-    'bookID': r'^\d{1,5}$',  # Pattern for book ID
+    'bookID': r'^\d{1,9}$',  # Pattern for book ID
     'title': r"^[a-z0-9][a-z0-9- ,.':]{1,59}$",  # Pattern for book title
     'pub_year': r'^\d{4}$',  # Pattern for publication year
     'book_type': r'^[1-3]$',  # Pattern for book type
     'date': r'^\d{4}-\d{2}-\d{2}$',  # Pattern for date
-    'loanID': r'^\d{1,5}$'  # Pattern for loan ID
+    'loanID': r'^\d{1,9}$'  # Pattern for loan ID
 }
 
 # Custom error messages corresponding to the validation patterns
@@ -28,9 +112,9 @@ ERRORS = {'custID': 'Invalid ID number. Must only contain 6-9 numbers.',
           'l_name': 'Invalid last name. Must only contain up to 20 letters.',
           'city': 'Invalid city name. Must only contain up to 20 letters.',
           'age': 'Invalid age. Must only contain between 1-3 numbers.',
-          'bookID': 'Invalid book ID. Must only contain 1-5 numbers.',
+          'bookID': 'Invalid book ID. Must only contain 1-9 numbers.',
           'title': 'Invalid book name. Must only contain up to 60 letters.',
           'pub_year': 'Invalid publication year. Must only contain 4 numbers (Example: 1989).',
           'book_type': 'Invalid book type. Valid types: 1, 2, 3',
           'date': 'Invalid date. Date must be in the (YYYY-MM-DD) format.',
-          'loanID': 'Invalid loan ID. Must only contain 1-5 numbers.'}
+          'loanID': 'Invalid loan ID. Must only contain 1-9 numbers.'}
@@ -0,0 +1,236 @@
+import events
+from helpers import transaction, query_all_shards, query_db
+from shards import all_shards, get_shard
+from migrations import CUSTOMER_INDEX_TABLES, CUSTOMER_INDEX_REBUILD
+from errors import BorrowLimitReached
+from config import MAX_OPEN_LOANS
+
+
+# Per-customer loan index.
+# The 'customer_loans' table holds one row per customer: the number of open loans, the number
+# of loans ever made, the latest loan's ID and the customer's borrowing limit. The row is
+# updated inside the transaction of every loan opened, returned or deleted through the models,
+# so checking a customer's open loans or borrowing limit reads one row by primary key instead
+# of counting loans.
+#
+# A customer's loan history is read through the customer ID indexes of 'loans' and
+# 'loans_archive', which point straight at the customer's own loans, so listing it takes
+# time in the number of the customer's loans, not of all loans.
+#
+# Every branch database counts the loans it holds; the counts of a customer are summed over
+# the branches. The borrowing limits are kept in the default branch's database. rebuild()
+# recounts the loans, e.g. after loans were written without the index enabled.
+#
+# The borrowing limit is enforced by the 'insert' event itself: once the new loan is counted,
+# a customer holding more open loans than their limit makes the insert fail with
+# BorrowLimitReached, and the loan is rolled back with the count. The count of the loan's
+# database is read inside the insert's write transaction, so two desks lending to the same
+# customer at once are counted one after the other. check_borrow_limit() is only an early
+# check, before a desk starts a loan it would be refused.
+
+_enabled = False
+
+
+def create_customer_index_tables():
+    """
+    Creates the 'customer_loans' table in every branch database if it does not exist.
+    """
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            for query in CUSTOMER_INDEX_TABLES:
+                c.execute(query)
+
+
+def on_loan_event(action, loan, cursor):
+    """
+    Keeps the index up to date with the 'loans' change events.
+
+    Args:
+        action (str): 'insert', 'update', 'delete' or 'return'.
+        loan (Loan): The changed loan.
+        cursor (sqlite3.Cursor): Cursor of the change's transaction.
+    """
+    customer_id = loan.customer.id
+
+    if action == 'insert':
+        cursor.execute("INSERT INTO customer_loans (custID, open_loans, total_loans, last_loanID) VALUES (?, 1, 1, ?) "
+                       "ON CONFLICT (custID) DO UPDATE SET open_loans = open_loans + 1, "
+                       "total_loans = total_loans + 1, last_loanID = MAX(COALESCE(last_loanID, 0), "
+                       "excluded.last_loanID);", (customer_id, loan.id))
+        if _over_limit(loan, cursor):
+            raise BorrowLimitReached
+    elif action == 'return':
+        cursor.execute("UPDATE customer_loans SET open_loans = open_loans - 1 WHERE custID = ?;", (customer_id,))
+    elif action == 'delete':
+        # The deleted loan is already gone, so the latest loan is looked up again
+        cursor.execute("UPDATE customer_loans SET open_loans = open_loans - ?, total_loans = total_loans - 1, "
+                       "last_loanID = (SELECT MAX(id) FROM loans_history WHERE custID = ?) WHERE custID = ?;",
+                       (int(loan.is_open()), customer_id, customer_id))
+
+
+def _over_limit(loan, cursor):
+    # Whether the customer now holds more open loans than their limit, the new loan included
+    customer_id = loan.customer.id
+    db = loan.get_db()
+    open_count, limit = cursor.execute("SELECT open_loans, borrow_limit FROM customer_loans WHERE custID = ?;",
+                                       (customer_id,)).fetchone()
+
+    # The loans held in the other branch databases, and the limit if it is kept in another one
+    for shard in all_shards():
+        if shard != db:
+            rows = query_db(query="SELECT open_loans FROM customer_loans WHERE custID = ?;",
+                            parameters=(customer_id,), db=shard, result=True)
+            open_count += sum(row[0] for row in rows)
+    if db != get_shard():
+        return open_count > borrow_limit(customer_id)
+
+    return open_count > (MAX_OPEN_LOANS if limit is None else limit)
+
+
+def enable_customer_index(create_tables=True):
+    """
+    Creates the index table and starts maintaining it on every loan written through the models.
+
+    Args:
+        create_tables (bool, optional): False if the table is known to exist (see migrations.ensure_schema).
+    """
+    global _enabled
+
+    if create_tables:
+        create_customer_index_tables()
+    events.subscribe('loans', on_loan_event)
+    _enabled = True
+
+
+def disable_customer_index():
+    """
+    Stops maintaining the index; the lookups fall back to counting the loans.
+    """
+    global _enabled
+
+    events.unsubscribe('loans', on_loan_event)
+    _enabled = False
+
+
+def is_enabled():
+    """
+    Returns whether the index is maintained in this process, and can be trusted.
+    """
+    return _enabled
+
+
+def rebuild():
+    """
+    Recounts every customer's loans from scratch, in one transaction per branch database.
+    """
+    create_customer_index_tables()
+
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            for query in CUSTOMER_INDEX_REBUILD:
+                c.execute(query)
+
+
+def loan_summary(customer_id):
+    """
+    Reads a customer's row of the index, summed over the branches.
+
+    Args:
+        customer_id (str): The customer ID.
+
+    Returns:
+        dict: 'open_loans', 'total_loans', 'last_loan' (ID, or None) and 'borrow_limit'.
+    """
+    rows = query_all_shards(query="SELECT open_loans, total_loans, last_loanID FROM customer_loans WHERE custID = ?;",
+                            parameters=(customer_id,), result=True)
+
+    return {'open_loans': sum(row[0] for row in rows), 'total_loans': sum(row[1] for row in rows),
+            'last_loan': max((row[2] for row in rows if row[2] is not None), default=None),
+            'borrow_limit': borrow_limit(customer_id)}
+
+
+def open_loans(customer_id):
+    """
+    Returns the number of open loans of a customer.
+
+    Args:
+        customer_id (str): The customer ID.
+
+    Returns:
+        int: The number of open loans.
+    """
+    if not _enabled:
+        rows = query_all_shards(query="SELECT COUNT(*) FROM loans WHERE custID = ? AND is_open = 1;",
+                                parameters=(customer_id,), result=True)
+    else:
+        rows = query_all_shards(query="SELECT open_loans FROM customer_loans WHERE custID = ?;",
+                                parameters=(customer_id,), result=True)
+
+    return sum(row[0] for row in rows)
+
+
+def borrow_limit(customer_id):
+    """
+    Returns the number of open loans a customer may hold.
+
+    Args:
+        customer_id (str): The customer ID.
+
+    Returns:
+        int: The customer's own limit, or MAX_OPEN_LOANS.
+    """
+    rows = query_db(query="SELECT borrow_limit FROM customer_loans WHERE custID = ?;", parameters=(customer_id,),
+                    db=get_shard(), result=True)
+
+    return rows[0][0] if rows and rows[0][0] is not None else MAX_OPEN_LOANS
+
+
+def set_borrow_limit(customer_id, limit):
+    """
+    Sets a customer's own borrowing limit.
+
+    Args:
+        customer_id (str): The customer ID.
+        limit (int, optional): The number of open loans the customer may hold, None for MAX_OPEN_LOANS.
+    """
+    query_db(query="INSERT INTO customer_loans (custID, borrow_limit) VALUES (?, ?) "
+                   "ON CONFLICT (custID) DO UPDATE SET borrow_limit = excluded.borrow_limit;",
+             parameters=(customer_id, limit), db=get_shard())
+
+
+def check_borrow_limit(customer_id):
+    """
+    Checks that a customer may open another loan, before the loan is made. The limit itself is
+    enforced by the loan's insert (see on_loan_event).
+
+    Args:
+        customer_id (str): The customer ID.
+
+    Raises:
+        BorrowLimitReached: If the customer already holds as many open loans as their limit.
+    """
+    if open_loans(customer_id) >= borrow_limit(customer_id):
+        raise BorrowLimitReached
+
+
+def customer_history(customer_id, limit=None):
+    """
+    Returns a customer's loans, archived ones included, newest first.
+
+    Args:
+        customer_id (str): The customer ID.
+        limit (int, optional): Only the latest loans, up to this number.
+
+    Returns:
+        list: The loan records.
+    """
+    query = "SELECT * FROM loans_history WHERE custID = ? ORDER BY id DESC"
+    parameters = (customer_id,)
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters += (limit,)
+
+    rows = query_all_shards(query=query + ';', parameters=parameters, result=True)
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    return rows[:limit] if limit is not None else rows
@@ -1,5 +1,5 @@
 from customers import Customer
-from helpers import auto_log, get_by_id, align_input, query_db, check_loans, check_id
+from helpers import auto_log, get_by_id, align_input, search_customers_by_name, check_loans, check_id
 from config import RE_PATT_D, ERRORS
 
 
@@ -343,14 +343,12 @@ def find_customer_by_name():
     while True:
         print('\n')
         # Prompting the user to enter a search keyword for customer name
-        keyword = f"%{input('Enter search keyword: ')}%"
-        if keyword == '%0%':
+        keyword = input('Enter search keyword: ')
+        if keyword == '0':
             return  # Allowing the user to exit the search
 
-        # SQL query to find customers whose first or last name matches the keyword
-        query = "SELECT * FROM customers WHERE p_name LIKE ? or l_name like ?;"
-        # Executing the query and storing the result
-        res_lst = query_db(query=query, parameters=(keyword, keyword), result=True)
+        # Finding customers whose first or last name matches the keyword
+        res_lst = search_customers_by_name(keyword)
 
         if len(res_lst) == 0:
             # If no matching results are found, inform the user
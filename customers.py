@@ -1,6 +1,6 @@
 from dbhandler import DataBaseHandler
 from config import CUSTOMERS_FIELDNAMES, RE_PATT_D, ERRORS
-from helpers import query_db, regex_check, auto_log, check_number, check_id
+from helpers import query_all_shards, regex_check, auto_log, check_number, check_id
 from errors import InvalidEntry, InvalidAge
 
 
@@ -156,12 +156,12 @@ class Customer(DataBaseHandler):
     @classmethod
     def create_customer_table(cls):
         """
-               Class method to create the customers table in the database if it does not exist.
+               Class method to create the customers table in every branch database if it does not exist.
                """
         # SQL query to create the customers table
         query = """
         CREATE TABLE IF NOT EXISTS customers  \
-            (id TEXT PRIMARY KEY,  \
+            (id INTEGER PRIMARY KEY,  \
             p_name TEXT NOT NULL, \
             l_name TEXT NOT NULL, \
             city TEXT NOT NULL, \
@@ -169,4 +169,4 @@ class Customer(DataBaseHandler):
         );
         """
 
-        query_db(query=query)
+        query_all_shards(query=query)
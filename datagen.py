@@ -0,0 +1,311 @@
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from helpers import transaction, query_all_shards, next_id, auto_log
+from shards import get_shard
+from config import LOAN_DURATIONS, DATAGEN_CHUNK_SIZE, MAX_OPEN_LOANS
+
+
+# Synthetic data generator.
+# Produces customers, books and loans that pass the validation rules of the models (RE_PATT_D,
+# ages, publication years, return dates), with realistic skew:
+#   - a few popular titles and frequent borrowers account for most loans,
+#   - recent days have more loans than older ones,
+#   - OVERDUE_RATIO of the loans are returned (or still open) after their expected date,
+#   - OPEN_RATIO of the loans are still open (up to MAX_ON_LOAN of the books), with at most one
+#     open loan per book, and at most MAX_OPEN_LOANS per customer.
+#
+# The rows are generated in chunks by worker processes and written by the calling process,
+# one bulk transaction per chunk, as sqlite only takes one writer at a time. Every chunk has
+# its own random generator, seeded from the seed and the chunk's position, so the same seed
+# produces the same rows whatever the number of workers.
+#
+# Usage: python datagen.py --customers 1000000 --books 200000 --loans 10000000 [--seed N] [--workers N]
+
+OVERDUE_RATIO = 0.08    # Share of the loans kept past their expected return date
+OPEN_RATIO = 0.05       # Share of the loans that are still open
+MAX_ON_LOAN = 0.3       # Share of the books that may be on loan at once
+HISTORY_DAYS = 3 * 365  # Loans are spread over this many days before today
+MAX_DAYS_LATE = 30      # Late loans are returned up to this many days after their expected date
+
+FIRST_NAMES = ('Tom', 'Moshe', 'Refael', 'Avishai', 'Tal', 'Noa', 'Maya', 'Yael', 'Dana', 'Ori', 'Itai', 'Lior',
+               'Shira', 'Eitan', 'Adi', 'Roni', 'Anna', 'David', 'Sarah', 'Daniel', 'Rachel', 'Jonathan', 'Miriam',
+               'Ariel', 'Hila', 'Omer', 'Gal', 'Yonatan', 'Tamar', 'Ella', 'Jean-Luc', 'Mary Ann', 'J.R.')
+LAST_NAMES = ('Kedar', 'Cohen', 'Bitton', 'Derii', 'Karo', 'Levi', 'Mizrahi', 'Peretz', 'Biton', 'Dahan',
+              'Avraham', 'Friedman', 'Azulay', 'Katz', 'Yosef', 'David', 'Ohana', 'Shapiro', "O'Brien", 'Smith',
+              'Ben-David', 'Goldberg', 'Rosen', 'Segal', 'Weiss', 'de Saint-Exupery', 'Tolkien', 'Orwell')
+CITIES = ('Jerusalem', 'Tel Aviv', 'Haifa', 'Beer Sheva', 'Ashdod', 'Netanya', 'Holon', 'Rishon Lezion',
+          'Petah Tikva', 'Rehovot', 'Eilat', 'Tiberias', 'Nazareth', 'Modiin', 'Kfar Saba', 'Herzliya')
+TITLE_WORDS = ('the', 'of', 'and', 'a', 'night', 'house', 'river', 'war', 'peace', 'garden', 'winter', 'summer',
+               'city', 'stone', 'light', 'shadow', 'king', 'queen', 'sea', 'road', 'secret', 'last', 'first',
+               'little', 'great', 'silent', 'lost', 'golden', 'dark', 'blue', 'red', 'forest', 'island', 'song',
+               'letters', 'memory', 'dream', 'empire', 'journey', 'ring', 'farm', 'prince', 'wonderland', 'stars')
+
+# Share of each book type in the catalogue
+BOOK_TYPE_WEIGHTS = ((1, 5), (2, 3), (3, 2))
+_BOOK_TYPES = [book_type for book_type, weight in BOOK_TYPE_WEIGHTS for _ in range(weight)]
+
+
+def book_type(book_id):
+    """
+    Returns the type of a generated book, derived from its ID.
+
+    Deriving the type from the ID lets the loan generators know the loan duration of any
+    generated book without reading the books back.
+
+    Args:
+        book_id (int): The book ID.
+
+    Returns:
+        int: The book type.
+    """
+    return _BOOK_TYPES[(book_id * 2654435761 >> 8) % len(_BOOK_TYPES)]
+
+
+def chunk_random(seed, kind, start):
+    """
+    Creates the random generator of one chunk.
+
+    Args:
+        seed (int): The generation seed.
+        kind (str): The kind of rows ('customers', 'books', 'loans' or 'open_loans').
+        start (int): Position of the chunk's first row.
+
+    Returns:
+        random.Random: A generator that depends only on its arguments.
+    """
+    return random.Random(f"{seed}:{kind}:{start}")
+
+
+def iso_dates(today):
+    # ISO strings of the days around the generated range, by ordinal, as formatting a date
+    # per row is a large part of the generation time
+    last = today.toordinal() + max(LOAN_DURATIONS.values())
+    return {day: date.fromordinal(day).isoformat()
+            for day in range(last - HISTORY_DAYS - 2 * MAX_DAYS_LATE - max(LOAN_DURATIONS.values()), last + 1)}
+
+
+def customer_rows(seed, start, count, first_id, today):
+    rng = chunk_random(seed, 'customers', start)
+
+    return [(first_id + start + i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(CITIES),
+             int(rng.triangular(5, 95, 35)))
+            for i in range(count)]
+
+
+def book_rows(seed, start, count, first_id, today):
+    rng = chunk_random(seed, 'books', start)
+    rows = []
+
+    for i in range(count):
+        book_id = first_id + start + i
+        title = ' '.join(rng.sample(TITLE_WORDS, rng.randint(2, 5))).capitalize()
+        rows.append((book_id, title, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+                     int(rng.triangular(1701, today.year, today.year - 5)), book_type(book_id)))
+
+    return rows
+
+
+def loan_rows(seed, start, count, first_id, today, customers, books):
+    # Returned loans
+    rng = chunk_random(seed, 'loans', start)
+    first_customer, customer_count = customers
+    first_book, book_count = books
+    today_ordinal = today.toordinal()
+    days = iso_dates(today)
+    rows = []
+
+    for i in range(count):
+        # Powers of random() skew the choice towards the first customers and books
+        customer_id = first_customer + int(customer_count * rng.random() ** 2)
+        book_id = first_book + int(book_count * rng.random() ** 3)
+        duration = LOAN_DURATIONS[book_type(book_id)]
+
+        # Recent days have more loans; the loan must be returned by today
+        loan_day = today_ordinal - int(HISTORY_DAYS * rng.random() ** 2)
+        expected = loan_day + duration
+        if rng.random() < OVERDUE_RATIO:
+            returned = expected + rng.randint(1, MAX_DAYS_LATE)
+        else:
+            returned = loan_day + rng.randint(0, duration)
+        returned = min(returned, today_ordinal)
+
+        rows.append((first_id + start + i, customer_id, book_id, days[loan_day], days[expected], days[returned], 0))
+
+    return rows
+
+
+def open_loan_rows(seed, start, count, first_id, today, customers, books):
+    # Open loans, each on a different book, spread evenly over the customers
+    rng = chunk_random(seed, 'open_loans', start)
+    first_customer, customer_count = customers
+    first_book, book_count = books
+    today_ordinal = today.toordinal()
+    days = iso_dates(today)
+    rows = []
+
+    # Stepping through the books with a step that shares no factor with their count visits
+    # every book once, so no book gets two open loans
+    step = 7919 if book_count % 7919 else 7907
+    # The same for the customers, so none holds more open loans than the borrowing limit
+    # (the open loans are capped at MAX_OPEN_LOANS per customer, see generate)
+    customer_step = 7919 if customer_count % 7919 else 7907
+
+    for i in range(count):
+        book_id = first_book + ((start + i) * step) % book_count
+        customer_id = first_customer + ((start + i) * customer_step) % customer_count
+        duration = LOAN_DURATIONS[book_type(book_id)]
+
+        if rng.random() < OVERDUE_RATIO:
+            loan_day = today_ordinal - duration - rng.randint(1, MAX_DAYS_LATE)
+        else:
+            loan_day = today_ordinal - rng.randint(0, duration)
+
+        rows.append((first_id + start + i, customer_id, book_id, days[loan_day], days[loan_day + duration], None, 1))
+
+    return rows
+
+
+GENERATORS = {'customers': customer_rows, 'books': book_rows, 'loans': loan_rows, 'open_loans': open_loan_rows}
+
+
+def generate_chunk(task):
+    """
+    Generates the rows of one chunk (run by the worker processes).
+
+    Args:
+        task (tuple): (kind, seed, start, count, generator arguments).
+
+    Returns:
+        tuple: (kind, rows).
+    """
+    kind, seed, start, count, arguments = task
+
+    return kind, GENERATORS[kind](seed, start, count, **arguments)
+
+
+def write_chunk(kind, rows, db):
+    """
+    Writes the rows of one chunk in one transaction.
+
+    Args:
+        kind (str): The kind of rows.
+        rows (list): The generated rows.
+        db (str): Path of the database file.
+    """
+    table = 'loans' if kind == 'open_loans' else kind
+    placeholders = ', '.join('?' for _ in rows[0])
+
+    with transaction(db, write=True) as c:
+        c.executemany(f"INSERT INTO {table} VALUES ({placeholders});", rows)
+
+
+def first_customer_id():
+    # Customer IDs must have 6 to 9 digits, so generated customers get 9-digit IDs
+    rows = query_all_shards(query="SELECT MAX(id) FROM customers;", result=True)
+    highest = max((int(row[0]) for row in rows if row[0] is not None), default=0)
+
+    return max(highest, 99999999) + 1
+
+
+def generate(customers=0, books=0, loans=0, seed=0, workers=None, today=None, db=None,
+             chunk_size=DATAGEN_CHUNK_SIZE, rebuild_reports=True):
+    """
+    Generates customers, books and loans and writes them to a database.
+
+    Loans only refer to the customers and books generated in the same run, and get IDs above
+    the existing ones, so the generator can add to a database that already holds data.
+
+    Args:
+        customers (int, optional): The number of customers to generate.
+        books (int, optional): The number of books to generate.
+        loans (int, optional): The number of loans to generate.
+        seed (int, optional): The seed; the same seed generates the same rows.
+        workers (int, optional): The number of worker processes. 1 generates in this process.
+            Defaults to the number of CPUs.
+        today (date, optional): The date the loans are generated up to. Defaults to today.
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+        chunk_size (int, optional): Rows per chunk (and per write transaction).
+        rebuild_reports (bool, optional): Recompute the report aggregates and the customer loan
+            index after writing, as bulk-written loans bypass the change events.
+
+    Returns:
+        dict: Kind of rows -> number of rows written.
+
+    Raises:
+        ValueError: If loans are requested without customers and books to refer to.
+    """
+    if loans and not (customers and books):
+        raise ValueError("Loans need generated customers and books")
+
+    today = today or date.today()
+    db = db or get_shard()
+
+    open_count = min(int(loans * OPEN_RATIO), int(books * MAX_ON_LOAN), customers * MAX_OPEN_LOANS)
+    first_ids = {'customers': first_customer_id(), 'books': int(next_id('books')),
+                 'loans': int(next_id('loans', 'loans_archive'))}
+    counts = {'customers': customers, 'books': books, 'loans': loans - open_count, 'open_loans': open_count}
+    loan_ranges = {'customers': (first_ids['customers'], customers), 'books': (first_ids['books'], books)}
+
+    tasks = []
+    for kind, count in counts.items():
+        arguments = {'first_id': first_ids['loans' if kind == 'open_loans' else kind], 'today': today}
+        if kind == 'open_loans':
+            # Open loans take the IDs after the returned loans
+            arguments['first_id'] += counts['loans']
+        if kind in ('loans', 'open_loans'):
+            arguments.update(loan_ranges)
+        tasks.extend((kind, seed, start, min(chunk_size, count - start), arguments)
+                     for start in range(0, count, chunk_size))
+
+    start_time = time.perf_counter()
+    if workers == 1:
+        for task in tasks:
+            write_chunk(*generate_chunk(task), db)
+    else:
+        # Keeping a few chunks in flight per worker, so generated rows do not pile up in memory
+        # while the single writer catches up
+        workers = workers or os.cpu_count() or 1
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            in_flight = deque()
+            pending = iter(tasks)
+            for task in pending:
+                in_flight.append(executor.submit(generate_chunk, task))
+                if len(in_flight) >= 2 * workers:
+                    write_chunk(*in_flight.popleft().result(), db)
+            while in_flight:
+                write_chunk(*in_flight.popleft().result(), db)
+
+    if rebuild_reports:
+        import reports
+        import customer_index
+        reports.rebuild()
+        customer_index.rebuild()
+
+    auto_log('Data generated', log_id=f"{counts} in {time.perf_counter() - start_time:.1f}s")
+
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic customers, books and loans.')
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--loans', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    from migrations import ensure_schema
+    ensure_schema()
+
+    started = time.perf_counter()
+    written = generate(customers=args.customers, books=args.books, loans=args.loans, seed=args.seed,
+                       workers=args.workers)
+    print(f"Generated {written} in {time.perf_counter() - started:.1f}s")
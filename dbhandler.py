@@ -1,5 +1,9 @@
 from abc import abstractmethod, ABCMeta
+from functools import partial
+import audit
 import helpers
+import writer
+from shards import get_shard, all_shards
 
 
 class DataBaseHandler(metaclass=ABCMeta):
@@ -10,8 +14,18 @@ class DataBaseHandler(metaclass=ABCMeta):
     for object value extraction, query execution, and basic CRUD (Create, Read, Update, Delete) operations.
 
     Methods defined as abstract must be implemented by subclasses.
+
+    Rows are routed to the database file of the object's branch. An object whose branch is
+    not known (None) is saved to the default branch, and edited or deleted on every branch.
+    Every write publishes a change event (see events.py) inside its transaction.
+
+    Writes are committed in groups by the writer thread of their database (see writer.py).
+    save(), edit() and delete() wait until the write is durable, unless called with wait=False,
+    in which case they return a Future that resolves at that point.
     """
 
+    branch = None  # Branch key of the object, set on the instance to route it to a branch database
+
     @abstractmethod
     def obj_to_values(self):
         """
@@ -40,6 +54,48 @@ class DataBaseHandler(metaclass=ABCMeta):
         """
         pass
 
+    def get_db(self):
+        """
+        Get the database file that holds the object, based on its branch key.
+
+        Returns:
+            str: Path of the branch's database file.
+        """
+        return get_shard(self.branch)
+
+    def _write(self, action, query, parameters=None, wait=True):
+        """
+        Execute a write query and publish its change event in the same transaction.
+
+        The query runs on the object's branch, or on every branch if the branch is unknown.
+        The event is only published on the branch where the query changed a row.
+
+        Parameters:
+            action (str): The change made by the query ('insert', 'update', 'delete' or 'return').
+            query (str): The SQL query to execute.
+            parameters: Parameters for the query.
+            wait (bool): Wait until the write is committed, raising its error if it failed.
+
+        Returns:
+            Future: Resolves to the number of changed rows once the write is committed on every branch.
+        """
+        if self.branch is None and action != 'insert':
+            databases = all_shards()
+        else:
+            databases = [self.get_db()]
+
+        futures = [writer.submit(db, action, self, query, parameters) for db in databases]
+        future = futures[0] if len(futures) == 1 else writer.gather(futures)
+
+        # Recording the write in the audit log once it is committed
+        if wait:
+            future.result()
+            audit.on_write(action, self, future)
+        else:
+            future.add_done_callback(partial(audit.on_write, action, self))
+
+        return future
+
     def load(self=None, table=None, condition=None):
         """
         Load data from the database.
@@ -57,16 +113,19 @@ class DataBaseHandler(metaclass=ABCMeta):
         else:
             query = f'SELECT * FROM {table};'
 
-        # Executing the query and returning the result
-        data_output = helpers.query_db(query=query, result=True)
+        # Executing the query on all branches and returning the result
+        data_output = helpers.query_all_shards(query=query, result=True)
         return data_output
 
-    def delete(self):
+    def delete(self, wait=True):
         """
         Delete the current object from the database.
 
+        Parameters:
+            wait (bool): Wait until the deletion is committed.
+
         Returns:
-            bool: True if the operation is successful.
+            bool: True if the operation is successful (a Future if wait is False).
         """
         # Retrieving the object ID and table
         object_id = self.get_id()
@@ -74,20 +133,21 @@ class DataBaseHandler(metaclass=ABCMeta):
 
         # Constructing and executing the delete query
         query = f"DELETE FROM {table} WHERE id = {object_id};"
-        helpers.query_db(query=query)
+        future = self._write('delete', query=query, wait=wait)
 
-        return True
+        return True if wait else future
 
-    def edit(self, set_clauses: tuple, values):
+    def edit(self, set_clauses: tuple, values, wait=True):
         """
         Edit the current object in the database.
 
         Parameters:
             set_clauses (tuple): Tuple of clauses for setting new values.
             values: New values to be set.
+            wait (bool): Wait until the change is committed.
 
         Returns:
-            bool: True if the operation is successful.
+            bool: True if the operation is successful (a Future if wait is False).
         """
         # Retrieving the object ID and table
         object_id = self.get_id()
@@ -96,16 +156,19 @@ class DataBaseHandler(metaclass=ABCMeta):
 
         # Constructing and executing the update query
         query = f"UPDATE {table} SET {placeholders} WHERE id = {object_id};"
-        helpers.query_db(query=query, parameters=values)
+        future = self._write('update', query=query, parameters=values, wait=wait)
 
-        return True
+        return True if wait else future
 
-    def save(self):
+    def save(self, wait=True):
         """
         Save the current object to the database.
 
+        Parameters:
+            wait (bool): Wait until the row is committed.
+
         Returns:
-            bool: True if the operation is successful.
+            bool: True if the operation is successful (a Future if wait is False).
         """
         # Retrieving table name, field names, and values from the object
         table = self.get_table()
@@ -115,6 +178,6 @@ class DataBaseHandler(metaclass=ABCMeta):
 
         # Constructing and executing the insert query
         query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders});"
-        helpers.query_db(query=query, parameters=values)
+        future = self._write('insert', query=query, parameters=values, wait=wait)
 
-        return True
+        return True if wait else future
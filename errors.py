@@ -72,4 +72,54 @@ class BookNotAvailable(Exception):
         message (str): Explanation of the error
     """
     def __str__(self):
-        return f"BookNotAvailable: This book is currently on loan"
\ No newline at end of file
+        return f"BookNotAvailable: This book is currently on loan"
+
+
+class MigrationError(Exception):
+    """
+    Exception raised when the database schema can not be migrated.
+
+    Attributes:
+        message (str): Explanation of the error
+    """
+    def __str__(self):
+        return f"MigrationError: {self.args[0] if self.args else 'Unable to migrate the database schema'}"
+
+
+class BorrowLimitReached(Exception):
+    """
+    Exception raised when a customer already holds as many open loans as they may.
+
+    Attributes:
+        message (str): Explanation of the error
+    """
+    def __str__(self):
+        return "BorrowLimitReached: The customer has reached their limit of open loans"
+
+
+class LoanAlreadyReturned(Exception):
+    """
+    Exception raised when returning a loan that is already closed.
+
+    Attributes:
+        message (str): Explanation of the error
+    """
+    def __str__(self):
+        return "LoanAlreadyReturned: This loan was already returned"
+
+
+class BackupFailed(Exception):
+    """
+    Exception raised when a snapshot does not pass its integrity check.
+
+    Attributes:
+        path (str): The snapshot's path.
+        problems (list): The integrity check's messages.
+    """
+    def __init__(self, path, problems):
+        super().__init__(path, problems)
+        self.path = path
+        self.problems = problems
+
+    def __str__(self):
+        return f"BackupFailed: {self.path}: {'; '.join(self.problems)}"
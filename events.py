@@ -0,0 +1,48 @@
+# Change events of the model classes.
+# DataBaseHandler publishes an event for every row it inserts, updates or deletes, and
+# subsystems that keep derived data (trackers, indexes, aggregates) subscribe to the tables
+# they follow. Subscribers are called inside the transaction of the change, with its cursor,
+# so their own writes are committed or rolled back together with the change.
+
+_subscribers = {}  # Table name -> list of callbacks
+
+
+def subscribe(table, callback):
+    """
+    Registers a callback for the changes of a table.
+
+    Args:
+        table (str): The table to follow ('books', 'customers' or 'loans').
+        callback (callable): Called as callback(action, obj, cursor), where action is
+            'insert', 'update', 'delete' or 'return' (a loan was closed), obj is the changed
+            model object, and cursor belongs to the transaction of the change.
+    """
+    _subscribers.setdefault(table, [])
+
+    if callback not in _subscribers[table]:
+        _subscribers[table].append(callback)
+
+
+def unsubscribe(table, callback):
+    """
+    Removes a callback registered with subscribe().
+
+    Args:
+        table (str): The followed table.
+        callback (callable): The callback to remove.
+    """
+    if callback in _subscribers.get(table, []):
+        _subscribers[table].remove(callback)
+
+
+def publish(action, obj, cursor):
+    """
+    Notifies the subscribers of a table about a change.
+
+    Args:
+        action (str): 'insert', 'update', 'delete' or 'return'.
+        obj (DataBaseHandler): The changed model object.
+        cursor (sqlite3.Cursor): Cursor of the transaction the change was made in.
+    """
+    for callback in _subscribers.get(obj.get_table(), []):
+        callback(action, obj, cursor)
@@ -0,0 +1,262 @@
+import argparse
+import ast
+import json
+import os
+import shutil
+import sys
+import time
+from array import array
+from datetime import date, datetime, timedelta
+from helpers import query_db
+from shards import all_shards
+from config import EXPORT_DIR, EXPORT_CHUNK_SIZE
+
+
+# Columnar export of the books, customers and loans for analysis.
+# Every column of a table is streamed into its own NumPy .npy file, which numpy.load reads
+# as a typed array (or maps into memory with mmap_mode='r'), without querying or copying the
+# library database. The files are written in the .npy format directly, so exporting does not
+# need numpy itself.
+#
+# The rows are read in chunks of EXPORT_CHUNK_SIZE, each chunk by its own short query that
+# continues after the last exported ID, so the desks are never locked out for longer than one
+# chunk, and memory use does not depend on the table size. As a consequence a row changed
+# during the export may be exported as it was before or after the change.
+#
+# IDs are int64, dates datetime64[D] (a missing return date is NaT), small numbers int32,
+# is_open a bool, and text a fixed-width unicode column sized by the RE_PATT_D limits.
+# The 'loans' export holds the whole history: the archived loans, then the current ones.
+#
+# The files of a table are written to '<table>.part' and renamed once complete, so a reader
+# never sees a half-written table. export.json lists the exported tables, rows and types.
+#
+# Usage: python export.py [--dir system_files/export] [--tables loans books customers]
+
+# Table -> (source tables, ((column, .npy type), ...))
+EXPORT_TABLES = {
+    'books': (('books',), (('id', '<i8'), ('title', '<U60'), ('author_pname', '<U20'), ('author_lname', '<U20'),
+                           ('publication_year', '<i4'), ('type', '<i4'))),
+    'customers': (('customers',), (('id', '<i8'), ('p_name', '<U20'), ('l_name', '<U20'), ('city', '<U20'),
+                                   ('age', '<i4'))),
+    'loans': (('loans_archive', 'loans'), (('id', '<i8'), ('custID', '<i8'), ('bookID', '<i8'),
+                                           ('loandate', '<M8[D]'), ('expected_returndate', '<M8[D]'),
+                                           ('actual_returndate', '<M8[D]'), ('is_open', '|b1')))
+}
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'  # .npy format version 1.0
+NPY_HEADER_SIZE = 128             # Fixed, so the row count can be written once it is known
+NAT = -2 ** 63                    # numpy's 'not a time', for missing dates
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def npy_header(descr, rows):
+    """
+    Builds the header of a one-dimensional .npy file.
+
+    Args:
+        descr (str): numpy type string, e.g. '<i8'.
+        rows (int): The number of values.
+
+    Returns:
+        bytes: The NPY_HEADER_SIZE bytes that precede the data.
+    """
+    text = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': ({rows},), }}"
+    text = text.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + '\n'
+
+    return NPY_MAGIC + len(text).to_bytes(2, 'little') + text.encode('latin1')
+
+
+def _little_endian(values):
+    # The .npy types are declared little-endian
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values.tobytes()
+
+
+def encode(descr, values, day_numbers=None):
+    """
+    Turns a chunk of column values into the bytes of a .npy type.
+
+    Args:
+        descr (str): numpy type string.
+        values (tuple): The values read from the database.
+        day_numbers (dict, optional): ISO date -> days since 1970, reused across chunks.
+
+    Returns:
+        bytes: The encoded values.
+    """
+    if descr == '<i8':
+        return _little_endian(array('q', values))
+    if descr == '<i4':
+        return _little_endian(array('i', values))
+    if descr == '|b1':
+        return bytes(map(bool, values))
+    if descr == '<M8[D]':
+        # Loan dates repeat a lot, so every distinct date is parsed once
+        if day_numbers is None:
+            day_numbers = {}
+        for value in set(values).difference(day_numbers):
+            day_numbers[value] = NAT if value is None else date.fromisoformat(value).toordinal() - EPOCH
+        return _little_endian(array('q', map(day_numbers.__getitem__, values)))
+    if descr.startswith('<U'):
+        # Fixed-width UTF-32, padded with NUL characters (longer values are cut)
+        width = int(descr[2:])
+        return ''.join(value[:width].ljust(width, '\0') for value in values).encode('utf-32-le')
+
+    raise ValueError(f"Unsupported column type: {descr}")
+
+
+class ColumnWriter:
+    """
+    Appends chunks of values to a .npy file.
+
+    Args:
+        path (str): Path of the file.
+        descr (str): numpy type string of the column.
+    """
+
+    def __init__(self, path, descr):
+        self.descr = descr
+        self.rows = 0
+        self.day_numbers = {} if descr == '<M8[D]' else None
+        self._file = open(path, 'wb')
+        self._file.write(npy_header(descr, 0))
+
+    def append(self, values):
+        self._file.write(encode(self.descr, values, self.day_numbers))
+        self.rows += len(values)
+
+    def close(self):
+        # Writing the final row count into the header
+        self._file.seek(0)
+        self._file.write(npy_header(self.descr, self.rows))
+        self._file.close()
+
+
+def stream(source, columns, chunk_size=EXPORT_CHUNK_SIZE, db=None):
+    """
+    Reads a table in chunks, each by its own query continuing after the last ID.
+
+    Args:
+        source (str): The table to read.
+        columns (tuple): The columns to read, starting with the ID.
+        chunk_size (int, optional): Rows per chunk.
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Yields:
+        list: The next chunk of rows.
+    """
+    query = f"SELECT {', '.join(columns)} FROM {source} WHERE id > ? ORDER BY id LIMIT ?;"
+    last_id = -2 ** 63
+    while True:
+        rows = query_db(query=query, parameters=(last_id, chunk_size), db=db, result=True)
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def export_table(table, directory=EXPORT_DIR, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Exports a table of every branch database into one .npy file per column.
+
+    Args:
+        table (str): 'books', 'customers' or 'loans'.
+        directory (str, optional): The export directory; the files go to '<directory>/<table>/'.
+        chunk_size (int, optional): Rows read and written at a time.
+
+    Returns:
+        dict: 'rows' (the number of exported rows) and 'columns' (column -> numpy type).
+    """
+    sources, schema = EXPORT_TABLES[table]
+    names = tuple(name for name, descr in schema)
+    target = os.path.join(directory, table)
+    partial = target + '.part'
+
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    writers = [ColumnWriter(os.path.join(partial, f"{name}.npy"), descr) for name, descr in schema]
+    try:
+        for db in all_shards():
+            for source in sources:
+                for rows in stream(source, names, chunk_size, db):
+                    for writer, values in zip(writers, zip(*rows)):
+                        writer.append(values)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(partial, target)
+
+    return {'rows': writers[0].rows, 'columns': dict(schema)}
+
+
+def export(tables=tuple(EXPORT_TABLES), directory=EXPORT_DIR, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Exports tables and writes the export.json manifest.
+
+    Args:
+        tables (tuple, optional): The tables to export. Defaults to all of them.
+        directory (str, optional): The export directory.
+        chunk_size (int, optional): Rows read and written at a time.
+
+    Returns:
+        dict: The manifest: 'exported' (ISO time) and 'tables' (table -> rows and column types).
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = {'exported': datetime.now().isoformat(timespec='seconds'),
+                'tables': {table: export_table(table, directory, chunk_size) for table in tables}}
+
+    with open(os.path.join(directory, 'export.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def read_column(path):
+    """
+    Reads an exported column back without numpy (for checks; analysts use numpy.load).
+
+    Args:
+        path (str): Path of the .npy file.
+
+    Returns:
+        list: The values, as int, bool, str or date (None for a missing date).
+    """
+    with open(path, 'rb') as f:
+        preamble = f.read(len(NPY_MAGIC) + 2)
+        header = ast.literal_eval(f.read(int.from_bytes(preamble[-2:], 'little')).decode('latin1'))
+        data = f.read()
+
+    descr, rows = header['descr'], header['shape'][0]
+    if descr == '|b1':
+        return [bool(value) for value in data]
+    if descr.startswith('<U'):
+        width = int(descr[2:])
+        text = data.decode('utf-32-le')
+        return [text[i * width:(i + 1) * width].rstrip('\0') for i in range(rows)]
+
+    values = array('q' if descr in ('<i8', '<M8[D]') else 'i')
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    if descr == '<M8[D]':
+        return [None if value == NAT else date(1970, 1, 1) + timedelta(days=value) for value in values]
+
+    return values.tolist()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the library tables into .npy column files.')
+    parser.add_argument('--dir', default=EXPORT_DIR, help='Export directory')
+    parser.add_argument('--tables', nargs='+', choices=tuple(EXPORT_TABLES), default=tuple(EXPORT_TABLES))
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Rows read and written at a time')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    manifest = export(args.tables, args.dir, args.chunk_size)
+    for table, info in manifest['tables'].items():
+        print(f"{table}: {info['rows']} rows")
+    print(f"Exported to {args.dir} in {time.perf_counter() - started:.1f} s")
@@ -0,0 +1,137 @@
+from datetime import date
+from helpers import transaction, query_db, query_all_shards, auto_log
+from shards import all_shards
+from migrations import FEES_TABLES, ensure_schema
+from config import FEE_RATES
+
+
+# Late fee engine.
+# Fines are computed in SQL for all late loans of a database in one statement, and written to
+# the 'fees' ledger. A ledger row becomes final once its loan is returned or its fine reaches
+# the cap of its book type; final rows are never recomputed, so every run only touches the loans
+# whose fine could have changed since the last run (open late loans and newly returned loans).
+#
+# Loans are joined with the books of their own database, so a branch's loans should refer to
+# books of the same branch.
+#
+# The tables are added by schema migration 6. The overdue tracker's background thread runs
+# calculate_fees() once a day (see overdue.py), and fees.py runs it on demand.
+
+
+def create_fees_tables():
+    """
+    Creates the 'fees' ledger and the 'fee_runs' history in every branch database if they do not exist.
+    """
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            for query in FEES_TABLES:
+                c.execute(query)
+
+
+def calculate_fees(today=None, db=None):
+    """
+    Computes the fines of the late loans whose fine may have changed since the last run.
+
+    A loan is late by the days between its expected return date and its actual return date
+    (or today, while it is open). Its fine is the daily rate of its book type times the days
+    late, limited to the cap of the book type (see FEE_RATES in config.py).
+
+    Args:
+        today (date, optional): The date to compute the fines at. Defaults to today.
+        db (str, optional): The database to compute. Defaults to every branch database.
+
+    Returns:
+        int: The number of ledger rows written.
+    """
+    today = str(today or date.today())
+    databases = [db] if db else all_shards()
+
+    # The rates of all book types as an inline table, joined with the books in SQL
+    rates = ', '.join('(?, ?, ?)' for _ in FEE_RATES)
+    rate_values = [value for book_type, (daily, cap) in FEE_RATES.items() for value in (book_type, daily, cap)]
+
+    query = f"""
+        INSERT OR REPLACE INTO fees (loanID, custID, bookID, days_late, amount, final, computed)
+        WITH rates (type, daily, cap) AS (VALUES {rates}),
+        late AS (
+            SELECT l.id, l.custID, l.bookID, l.is_open, r.daily, r.cap,
+                   CAST(julianday(COALESCE(l.actual_returndate, ?)) - julianday(l.expected_returndate) AS INTEGER)
+                   AS days_late
+            FROM loans l
+            JOIN books b ON b.id = l.bookID
+            JOIN rates r ON r.type = b.type
+            LEFT JOIN fees f ON f.loanID = l.id
+            WHERE l.expected_returndate < COALESCE(l.actual_returndate, ?)
+              AND (f.loanID IS NULL OR f.final = 0)
+        )
+        SELECT id, custID, bookID, days_late, ROUND(MIN(days_late * daily, cap), 2),
+               is_open = 0 OR days_late * daily >= cap, ?
+        FROM late;
+    """
+
+    updated = 0
+    for database in databases:
+        with transaction(database, write=True) as c:
+            c.execute(query, (*rate_values, today, today, today))
+            written = c.rowcount
+            c.execute("INSERT INTO fee_runs (run_date, loans_updated) VALUES (?, ?);", (today, written))
+        updated += written
+
+    auto_log('Fees calculated', log_id=f"{updated} loans")
+
+    return updated
+
+
+def customer_balance(customer_id):
+    """
+    Returns the total fines of a customer across all branches.
+
+    Args:
+        customer_id (str): The customer ID.
+
+    Returns:
+        float: The customer's total fines.
+    """
+    rows = query_all_shards(query="SELECT COALESCE(SUM(amount), 0) FROM fees WHERE custID = ?;",
+                            parameters=(customer_id,), result=True)
+
+    return round(sum(row[0] for row in rows), 2)
+
+
+def fees_by_book_type(db=None):
+    """
+    Summarises the fines per book type.
+
+    Args:
+        db (str, optional): The database to summarise. Defaults to the default branch database.
+
+    Returns:
+        list: (book type, number of fined loans, total fines, largest fine) records.
+    """
+    query = "SELECT b.type, COUNT(*), ROUND(SUM(f.amount), 2), MAX(f.amount) " \
+            "FROM fees f JOIN books b ON b.id = f.bookID GROUP BY b.type ORDER BY b.type;"
+
+    return query_db(query=query, db=db or all_shards()[0], result=True)
+
+
+def top_debtors(limit=10, db=None):
+    """
+    Ranks the customers by their total fines.
+
+    Args:
+        limit (int, optional): The number of customers to return.
+        db (str, optional): The database to rank. Defaults to the default branch database.
+
+    Returns:
+        list: (rank, customer ID, total fines) records.
+    """
+    query = "SELECT RANK() OVER (ORDER BY SUM(amount) DESC), custID, ROUND(SUM(amount), 2) " \
+            "FROM fees GROUP BY custID ORDER BY 1 LIMIT ?;"
+
+    return query_db(query=query, parameters=(limit,), db=db or all_shards()[0], result=True)
+
+
+if __name__ == '__main__':
+    # Billing run on demand: python fees.py
+    ensure_schema()
+    print(f"Fees updated for {calculate_fees()} loans")
@@ -0,0 +1,145 @@
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack
+from unittest import mock
+import helpers
+from config import DEFAULT_BRANCH
+from shards import use_databases
+from pool import configure, close_pool
+from writer import stop_writer
+from migrations import migrate_all_shards, create_tables
+
+
+# Test fixtures.
+# IsolatedDatabase points the default branch at a fresh temporary database for the duration of
+# a test, so tests never touch system_files/library.db and can run in parallel processes.
+# The temporary database skips fsyncs and keeps its rollback journal in memory, as its data
+# does not need to survive a crash. auto_log writes to a log file in the same temporary
+# directory, so tests do not append to system_files/logger either.
+#
+# The factories create and save model objects with unique IDs and valid default values, so
+# a test only spells out the fields it cares about.
+
+FAST_PRAGMAS = ("PRAGMA synchronous = OFF;", "PRAGMA journal_mode = MEMORY;")
+
+_customer_ids = itertools.count(100000001)
+
+
+class IsolatedDatabase:
+    """
+    Context manager running a block against a new temporary database with the full schema.
+
+    Attributes:
+        db (str): Path of the temporary database file, once entered.
+    """
+
+    def __init__(self):
+        self.db = None
+        self._directory = None
+        self._stack = None
+        self._log_handlers = None
+
+    def __enter__(self):
+        self._directory = tempfile.mkdtemp(prefix='library-test-')
+        self.db = os.path.join(self._directory, 'library.db')
+        configure(self.db, FAST_PRAGMAS)
+
+        self._stack = ExitStack()
+        self._stack.enter_context(use_databases({DEFAULT_BRANCH: self.db}))
+
+        # auto_log configures the root logger on its first call, so the configured handlers are
+        # set aside and it configures a new one for the temporary log file
+        root = logging.getLogger()
+        self._log_handlers = (root.handlers[:], root.level)
+        root.handlers.clear()
+        self._stack.enter_context(mock.patch.object(helpers, 'LOGGER', os.path.join(self._directory, 'logger')))
+        try:
+            migrate_all_shards()
+            create_tables()
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stack.close()
+        stop_writer(self.db)
+        if self._log_handlers is not None:
+            root = logging.getLogger()
+            for handler in root.handlers:
+                handler.close()
+            root.handlers[:], level = self._log_handlers
+            root.setLevel(level)
+            self._log_handlers = None
+        close_pool(self.db)
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
+def make_customer(**fields):
+    """
+    Creates and saves a customer with a unique ID.
+
+    Args:
+        **fields: Customer constructor arguments overriding the defaults.
+
+    Returns:
+        Customer: The saved customer.
+    """
+    from customers import Customer
+
+    values = {'id_': str(next(_customer_ids)), 'p_name': 'Test', 'l_name': 'Testing', 'city': 'Nowhere',
+              'age': '66'}
+    values.update(fields)
+
+    c = Customer(**values)
+    c.save()
+
+    return c
+
+
+def make_book(**fields):
+    """
+    Creates and saves a book, with the next free ID.
+
+    Args:
+        **fields: Book constructor arguments overriding the defaults.
+
+    Returns:
+        Book: The saved book.
+    """
+    from books import Book
+
+    values = {'title': 'Something', 'author_pname': 'Test', 'author_lname': 'Testing', 'year_published': '1989',
+              'book_type': '1'}
+    values.update(fields)
+
+    b = Book(**values)
+    b.save()
+
+    return b
+
+
+def make_loan(customer=None, book=None):
+    """
+    Creates and saves an open loan, creating its customer and book if they are not given.
+
+    Args:
+        customer (Customer, optional): The borrowing customer.
+        book (Book, optional): The loaned book.
+
+    Returns:
+        Loan: The saved loan.
+    """
+    from loans import Loan
+
+    customer = customer or make_customer()
+    book = book or make_book()
+
+    l = Loan(customer_id=customer.id, book_id=book.id)
+    l.save()
+
+    return l
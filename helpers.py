@@ -1,8 +1,10 @@
-import logging
-import sqlite3
 from datetime import date
 import re
-from config import DATABASE, LOGGER
+from contextlib import contextmanager, ExitStack
+from config import LOGGER
+from shards import get_shard, all_shards
+from pool import get_pool
+from retry import retry, write_queue
 from errors import InvalidEntry, InvalidAge, InvalidPublicationYear, IdNotExist, IdAlreadyExists, BookNotAvailable
 
 
@@ -25,15 +27,19 @@ def check_date(loan_date, date_):
     Validates if a given date falls within a specific range.
 
     Args:
-        loan_date (date): The starting date to compare against.
+        loan_date (date or str): The starting date to compare against.
         date_ (str): The date in string format to be checked.
 
     Returns:
-        bool: True if date_ is after loan_date and before today's date, False otherwise.
+        bool: True if date_ is between loan_date and today's date (inclusive), False otherwise.
     """
+    # Loan dates read from the database are ISO strings
+    if isinstance(loan_date, str):
+        loan_date = date.fromisoformat(loan_date)
+
     # Comparing the input date (date_) against the loan_date and today's date
-    # Ensuring that the date_ is after the loan_date and before today's date
-    return bool(loan_date < date.fromisoformat(date_) < date.today())
+    # A book can be returned on the day it was loaned, and up to today
+    return bool(loan_date <= date.fromisoformat(date_) <= date.today())
 
 
 def check_number(user_input, num_type):
@@ -47,6 +53,22 @@ def check_number(user_input, num_type):
     Returns:
         bool: True if the input is within the specified range, False otherwise.
     """
+    mini, maxi = number_range(num_type)
+
+    # Checking if the user_input falls within the specified range
+    return bool(mini < int(user_input) <= maxi)
+
+
+def number_range(num_type):
+    """
+    Returns the bounds of a numeric input type, as applied by check_number.
+
+    Args:
+        num_type (str): The type of number ('age', 'year', 'month', 'day').
+
+    Returns:
+        tuple: (minimum, maximum), the minimum itself being out of range.
+    """
     mini = None
     maxi = None
 
@@ -60,8 +82,7 @@ def check_number(user_input, num_type):
     elif num_type == 'day':
         mini, maxi = 1, 31
 
-    # Checking if the user_input falls within the specified range
-    return bool(mini < int(user_input) <= maxi)
+    return mini, maxi
 
 
 def align_input(text, pattern, error, number=None):
@@ -101,20 +122,168 @@ def align_input(text, pattern, error, number=None):
     return user_input
 
 
-def query_db(query, parameters=None, db=DATABASE, result=False):
-    res = None
+@contextmanager
+def transaction(db=None, write=False):
+    """
+    Runs a block of statements as one transaction on a pooled connection.
+
+    The transaction is committed when the block ends, and rolled back if it raises.
+    A write transaction waits for its turn in the process's write queue and takes the
+    database's write lock as it begins, retrying with backoff while another connection
+    holds it (see retry.py).
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database,
+            so pointing the default branch elsewhere (see shards.use_databases) redirects every query.
+        write (bool, optional): True if the block writes to the database.
+
+    Yields:
+        sqlite3.Cursor: A cursor to execute the statements with.
+    """
+    db = db or get_shard()
+
+    with ExitStack() as stack:
+        if write:
+            stack.enter_context(write_queue(db).turn())  # Waiting behind this process's other writers
+        conn = stack.enter_context(get_pool(db).connection())  # Borrowing a pooled connection to the database
+        if write:
+            retry(lambda: conn.execute("BEGIN IMMEDIATE;"))
 
-    with sqlite3.connect(db) as conn:  # Connecting to the database
         c = conn.cursor()
-        if parameters:
-            c.execute(query, parameters)  # Executing the query with parameters
+        try:
+            yield c
+        except BaseException:
+            conn.rollback()  # Undoing the statements of the failed block
+            raise
         else:
-            c.execute(query)  # Executing the query without parameters
+            # A commit that waits for readers to finish can be retried, the transaction stays open
+            retry(conn.commit)  # Committing the transaction
+
+
+def query_db(query, parameters=None, db=None, result=False):
+    # PRAGMA statements run outside of a write transaction, as some of them have no effect inside one
+    write = query.lstrip()[:6].upper() not in ('SELECT', 'PRAGMA')
+
+    def run():
+        with transaction(db, write=write) as c:
+            if parameters:
+                c.execute(query, parameters)  # Executing the query with parameters
+            else:
+                c.execute(query)  # Executing the query without parameters
+
+            if result:
+                return c.fetchall()  # Fetching results if required
+
+    # A read has nothing to undo, so a read locked out by a writer is simply run again
+    return run() if write else retry(run)
+
+
+def change_counter(db=None):
+    """
+    Reads the change counter from the header of a database file.
+
+    sqlite increments the counter on every committed write, so it changes whenever the
+    data changes, without running a query.
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        int: The file change counter, or 0 if the file does not exist yet.
+    """
+    try:
+        with open(db or get_shard(), 'rb') as f:
+            header = f.read(28)
+    except FileNotFoundError:
+        return 0
+
+    # The counter is a 4-byte big-endian integer at offset 24 of the header
+    return int.from_bytes(header[24:28], 'big') if len(header) == 28 else 0
+
+
+def schema_state(db=None):
+    """
+    Reads the schema cookie and the schema version from the header of a database file.
+
+    sqlite increments the schema cookie on every change of the schema (tables, indexes, views),
+    so the schema can be checked without opening a connection.
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        list: [schema cookie, schema version ('PRAGMA user_version')], or [0, 0] if the file
+            does not exist yet.
+    """
+    try:
+        with open(db or get_shard(), 'rb') as f:
+            header = f.read(64)
+    except FileNotFoundError:
+        return [0, 0]
+
+    if len(header) < 64:
+        return [0, 0]
+
+    # The cookie is at offset 40 and the user version at offset 60, both 4-byte big-endian integers
+    return [int.from_bytes(header[40:44], 'big'), int.from_bytes(header[60:64], 'big')]
+
+
+def query_all_shards(query, parameters=None, result=False):
+    """
+    Runs a query against every branch database and gathers the results.
+
+    Used for searches and reports, which must see the rows of all branches.
+    When more than one database is configured, the shards are queried in parallel.
+
+    Args:
+        query (str): The SQL query to execute.
+        parameters (tuple, optional): Parameters for the query.
+        result (bool): If True, the fetched rows of all shards are returned as one list.
+
+    Returns:
+        list: Rows gathered from all shards (or None if result is False).
+    """
+    shards = all_shards()
+
+    # A single shard does not need a thread pool
+    if len(shards) == 1:
+        return query_db(query=query, parameters=parameters, db=shards[0], result=result)
+
+    # Imported here, as single-branch deployments never need it
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        outputs = executor.map(lambda db: query_db(query=query, parameters=parameters, db=db, result=result),
+                               shards)
+        outputs = list(outputs)
+
+    if not result:
+        return None
+
+    # Concatenating the rows of all shards
+    res = []
+    for rows in outputs:
+        res.extend(rows)
+
+    return res
+
+
+def next_id(*tables):
+    """
+    Generates the next free ID of one or more tables across all branch databases.
+
+    Args:
+        *tables (str): The table names, e.g. 'loans' and 'loans_archive' for IDs unique to both.
 
-        if result:
-            res = c.fetchall()  # Fetching results if required
+    Returns:
+        str: The next ID, unique across all shards.
+    """
+    # One primary key lookup per table: MAX(id) over a UNION ALL view would scan every row
+    query = f"SELECT {', '.join(f'(SELECT MAX(id) FROM {table})' for table in tables)};"
+    rows = [(value,) for row in query_all_shards(query=query, result=True) for value in row]
+    max_ids = [int(row[0]) for row in rows if row[0]]
 
-        conn.commit()  # Committing the transaction
+    return str(max(max_ids) + 1) if max_ids else '1'
 
 
 def auto_log(msg, log_id, error=False):
@@ -126,6 +295,9 @@ def auto_log(msg, log_id, error=False):
           log_id (str): An identifier associated with the log message.
           error (bool): If True, logs as an error; otherwise, logs as info.
       """
+    # Imported on the first message rather than at startup, as logging is slow to import
+    import logging
+
     # Setting up logging configuration
     logging.basicConfig(filename=LOGGER, level=logging.DEBUG, format='%(levelname)s:%(asctime)s:%(message)s')
     if error:
@@ -151,12 +323,12 @@ def get_by_id(object_id, table):
     # Fetching record by ID and handling non-existence
     query = f"SELECT * FROM {table} WHERE id = ?;"
 
-    res = query_db(query=query, parameters=(object_id,), result=True)[0]
+    res = query_all_shards(query=query, parameters=(object_id,), result=True)
 
     if len(res) == 0:
         raise IdNotExist
 
-    return res
+    return res[0]
 
 
 def check_loans(self):
@@ -169,35 +341,27 @@ def check_loans(self):
         AssertionError: If there are active loans preventing deletion of the item.
     """
 
-    query = None
-
-    # Determining the query based on the class of the object calling this method
+    # Determining the check based on the class of the object calling this method
     if self.__class__.__name__ == 'Customer':
-        # If the object is a Customer, prepare a query to check for loans linked to this customer
-        query = f"SELECT l.id, l.custID, l.bookID, l.loandate, l.expected_returndate, l.actual_returndate " \
-                f"FROM loans l " \
-                f"JOIN customers c ON l.custID = c.id WHERE c.id = {self.id};"
+        # If the object is a Customer, count its open loans through the open-loan index. The delete
+        # is guarded by the exact count, not by the customer_loans index, which only follows the
+        # loans written through the models
+        rows = query_all_shards(query="SELECT COUNT(*) FROM loans WHERE custID = ? AND is_open = 1;",
+                                parameters=(self.id,), result=True)
+        open_count = sum(row[0] for row in rows)
 
     elif self.__class__.__name__ == 'Book':
         # If the object is a Book, prepare a query to check for loans linked to this book
         query = f"SELECT l.id, l.custID, l.bookID, l.loandate, l.expected_returndate, l.actual_returndate " \
                 f"FROM loans l " \
-                f"JOIN books b ON l.bookID = b.id WHERE b.id = {self.id};"
+                f"JOIN books b ON l.bookID = b.id WHERE b.id = {self.id} AND l.is_open = 1;"
 
-    # Executing the query to retrieve data from the database
-    data_output = query_db(query=query, result=True)
-    final_output = []
-
-    # Loop through each loan record
-    for loan in data_output:
-        # Check if the loan is still active (not returned)
-        if loan[5] == 'Not returned':
-            # If the loan is active, add it to the final output list
-            final_output.append(loan)
+        # Executing the query to retrieve the active (not returned) loans from the database
+        open_count = len(query_all_shards(query=query, result=True))
 
     # Assert that there are no active loans; raise an error if there are
-    assert len(final_output) == 0, "Unable to delete. " \
-                                   "The item you are trying to delete has open loans related to it."
+    assert open_count == 0, "Unable to delete. " \
+                            "The item you are trying to delete has open loans related to it."
 
 
 def check_id(self=None, table=None, object_id=None, test=False):
@@ -225,7 +389,7 @@ def check_id(self=None, table=None, object_id=None, test=False):
     # SQL query to check for the existence of the ID in the specified table
     query = f"SELECT * FROM {table} WHERE id = ?;"
     # Executing the query
-    data_output = query_db(query=query, parameters=(object_id,), result=True)
+    data_output = query_all_shards(query=query, parameters=(object_id,), result=True)
 
     # If not in test mode, check if the ID already exists and raise an exception if it does
     if not test:
@@ -235,6 +399,40 @@ def check_id(self=None, table=None, object_id=None, test=False):
     return True  # Returning True if the ID does not exist or if in test mode
 
 
+def availability_for(ids, cache=None):
+    """
+    Checks the availability of many books at once.
+
+    All IDs are answered with one query per chunk of IDs, instead of one query per book.
+
+    Args:
+        ids (iterable): The IDs of the books to check.
+        cache (dict, optional): Per-request cache of earlier answers. IDs found in it are not
+            queried again, and the new answers are added to it.
+
+    Returns:
+        dict: Book ID (as a string) -> True if the book is available, False if it is on loan.
+    """
+    if cache is None:
+        cache = {}
+
+    # Only querying the IDs that were not answered earlier in the request
+    pending = [id_ for id_ in dict.fromkeys(str(id_) for id_ in ids) if id_ not in cache]
+
+    # Staying well below sqlite's limit on the number of query parameters
+    for start in range(0, len(pending), 500):
+        chunk = pending[start:start + 500]
+        placeholders = ', '.join('?' for _ in chunk)
+        query = f"SELECT DISTINCT bookID FROM loans " \
+                f"WHERE is_open = 1 AND bookID IN ({placeholders});"
+        on_loan = {str(row[0]) for row in query_all_shards(query=query, parameters=tuple(chunk), result=True)}
+
+        for id_ in chunk:
+            cache[id_] = id_ not in on_loan
+
+    return {str(id_): cache[str(id_)] for id_ in ids}
+
+
 def is_available(book_id):
     """
     Checks if a book is currently available for loan.
@@ -246,16 +444,39 @@ def is_available(book_id):
         BookNotAvailable: If the book is currently on loan and not returned.
     """
 
-    # SQL query to get all loans associated with the given book ID
-    query = f"SELECT * FROM loans WHERE bookID = ?;"
-    # Executing the query
-    loans = query_db(query=query, parameters=(book_id,), result=True)
-
-    # Looping through each loan record to check if the book is currently on loan
-    for loan in loans:
-        # Checking if the book is not returned yet
-        if loan[5] == 'Not returned':
-            # If the book is not returned, raise an exception indicating it is not available
-            raise BookNotAvailable(f"This book is currently on loan")
+    # Delegating to the batch check with a single ID
+    if not availability_for([book_id])[str(book_id)]:
+        # If the book is not returned, raise an exception indicating it is not available
+        raise BookNotAvailable(f"This book is currently on loan")
 
     # If the book is not on loan, it is available
+
+
+def search_books_by_title(keyword):
+    """
+    Finds books whose title contains a keyword.
+
+    Args:
+        keyword (str): The search keyword.
+
+    Returns:
+        list: The matching book records of all branches.
+    """
+    query = "SELECT * FROM books WHERE title LIKE ?;"
+
+    return query_all_shards(query=query, parameters=(f"%{keyword}%",), result=True)
+
+
+def search_customers_by_name(keyword):
+    """
+    Finds customers whose first or last name contains a keyword.
+
+    Args:
+        keyword (str): The search keyword.
+
+    Returns:
+        list: The matching customer records of all branches.
+    """
+    query = "SELECT * FROM customers WHERE p_name LIKE ? or l_name like ?;"
+
+    return query_all_shards(query=query, parameters=(f"%{keyword}%", f"%{keyword}%"), result=True)
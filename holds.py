@@ -0,0 +1,222 @@
+from datetime import date
+import events
+from helpers import transaction, query_db, query_all_shards, get_by_id, auto_log
+from shards import all_shards, get_shard
+from errors import BookNotAvailable, IdNotExist
+
+
+# Hold (reservation) queues for books that are on loan.
+# Every book has a FIFO queue of waiting holds, ordered by hold ID. A partial index on the waiting
+# holds of each book makes "next in line" a single index lookup, however long the queue is.
+# When a loan is returned, the next waiting hold of its book is marked 'ready' in the same
+# transaction, and the book is then kept for that customer until they borrow it, or cancel the
+# hold, which passes the book on to the next waiting hold.
+#
+# A hold is kept in the database of the book's open loan, so it can be assigned atomically
+# with the loan's closing.
+
+HOLD_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS holds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bookID INTEGER NOT NULL,
+        custID INTEGER NOT NULL,
+        placed TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'waiting',
+        assigned TEXT
+    );
+    """,
+               # FIFO order of the waiting holds of each book
+               "CREATE INDEX IF NOT EXISTS idx_holds_queue ON holds (bookID, id) WHERE status = 'waiting';",
+               # A customer can only wait once for the same book
+               "CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_customer ON holds (bookID, custID) "
+               "WHERE status IN ('waiting', 'ready');",
+               "CREATE INDEX IF NOT EXISTS idx_holds_ready ON holds (bookID) WHERE status = 'ready';")
+
+
+def create_holds_table():
+    """
+    Creates the 'holds' table and its indexes in every branch database if they do not exist.
+    """
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            for query in HOLD_TABLES:
+                c.execute(query)
+
+
+def hold_database(book_id):
+    """
+    Finds the database of a book's open loan, where its holds are kept.
+
+    Args:
+        book_id (str): The book ID.
+
+    Returns:
+        str: Path of the database file (the default branch's if the book is not on loan).
+    """
+    for db in all_shards():
+        if query_db(query="SELECT 1 FROM loans WHERE bookID = ? AND is_open = 1 LIMIT 1;", parameters=(book_id,),
+                    db=db, result=True):
+            return db
+
+    return get_shard()
+
+
+def place_hold(customer_id, book_id):
+    """
+    Adds a customer to the end of a book's hold queue.
+
+    Args:
+        customer_id (str): The customer ID.
+        book_id (str): The book ID.
+
+    Returns:
+        int: The ID of the new hold.
+
+    Raises:
+        IdNotExist: If the customer or the book does not exist.
+        sqlite3.IntegrityError: If the customer already holds the book.
+    """
+    get_by_id(customer_id, 'customers')
+    get_by_id(book_id, 'books')
+
+    with transaction(hold_database(book_id), write=True) as c:
+        c.execute("INSERT INTO holds (bookID, custID, placed) VALUES (?, ?, ?);",
+                  (book_id, customer_id, str(date.today())))
+        hold_id = c.lastrowid
+
+    auto_log('Hold placed', log_id=hold_id)
+
+    return hold_id
+
+
+def cancel_hold(hold_id):
+    """
+    Cancels a waiting or ready hold. The book of a cancelled ready hold is assigned to the next
+    hold in its queue, in the same transaction.
+
+    Args:
+        hold_id (int): The hold ID.
+
+    Raises:
+        IdNotExist: If there is no active hold with this ID.
+    """
+    cancelled = 0
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            c.execute("SELECT status, bookID FROM holds WHERE id = ? AND status IN ('waiting', 'ready');",
+                      (hold_id,))
+            hold = c.fetchone()
+            if hold is None:
+                continue
+
+            c.execute("UPDATE holds SET status = 'cancelled' WHERE id = ?;", (hold_id,))
+            cancelled += c.rowcount
+            if hold[0] == 'ready':
+                assign_next(c, hold[1])
+
+    if not cancelled:
+        raise IdNotExist
+
+    auto_log('Hold cancelled', log_id=hold_id)
+
+
+def next_in_line(book_id):
+    """
+    Returns the first waiting hold of a book, read through the queue index.
+
+    Args:
+        book_id (str): The book ID.
+
+    Returns:
+        tuple: The hold record, or None if nobody is waiting.
+    """
+    rows = query_all_shards(query="SELECT * FROM holds WHERE bookID = ? AND status = 'waiting' "
+                                  "ORDER BY id LIMIT 1;", parameters=(book_id,), result=True)
+
+    return min(rows) if rows else None
+
+
+def queue_position(hold_id):
+    """
+    Returns the position of a waiting hold in its book's queue (1 is next in line).
+
+    Args:
+        hold_id (int): The hold ID.
+
+    Returns:
+        int: The queue position, or None if the hold is not waiting.
+    """
+    rows = query_all_shards(query="SELECT (SELECT COUNT(*) FROM holds q WHERE q.bookID = h.bookID "
+                                  "AND q.status = 'waiting' AND q.id <= h.id) "
+                                  "FROM holds h WHERE h.id = ? AND h.status = 'waiting';",
+                            parameters=(hold_id,), result=True)
+
+    return rows[0][0] if rows else None
+
+
+def check_reserved(book_id, customer_id):
+    """
+    Checks that a book is not kept for another customer's ready hold.
+
+    Args:
+        book_id (str): The book ID.
+        customer_id (str): The customer who wants to borrow the book.
+
+    Raises:
+        BookNotAvailable: If the book is kept for another customer.
+    """
+    rows = query_all_shards(query="SELECT custID FROM holds WHERE bookID = ? AND status = 'ready';",
+                            parameters=(book_id,), result=True)
+
+    if rows and str(rows[0][0]) != str(customer_id):
+        raise BookNotAvailable("This book is reserved for another customer")
+
+
+def assign_next(c, book_id):
+    """
+    Marks the next waiting hold of a book as ready, inside the caller's transaction.
+
+    Args:
+        c (sqlite3.Cursor): Cursor of the transaction closing the book's loan.
+        book_id (str): The returned book's ID.
+
+    Returns:
+        tuple: The assigned hold record, or None if nobody is waiting.
+    """
+    c.execute("SELECT * FROM holds WHERE bookID = ? AND status = 'waiting' ORDER BY id LIMIT 1;", (book_id,))
+    hold = c.fetchone()
+
+    if hold:
+        c.execute("UPDATE holds SET status = 'ready', assigned = ? WHERE id = ?;", (str(date.today()), hold[0]))
+        auto_log('Hold ready', log_id=hold[0])
+
+    return hold
+
+
+def on_loan_event(action, loan, cursor):
+    """
+    Assigns returned books to the next hold, and fulfils holds when their customer borrows the book.
+
+    Args:
+        action (str): 'insert', 'update', 'delete' or 'return'.
+        loan (Loan): The changed loan.
+        cursor (sqlite3.Cursor): Cursor of the change's transaction.
+    """
+    if action == 'insert':
+        cursor.execute("UPDATE holds SET status = 'fulfilled' WHERE bookID = ? AND custID = ? AND status = 'ready';",
+                       (loan.book.id, loan.customer.id))
+    elif action == 'return' or (action == 'delete' and loan.is_open()):
+        # The book is back on the shelf, either returned or with its open loan deleted
+        assign_next(cursor, loan.book.id)
+
+
+def enable_holds(create_tables=True):
+    """
+    Creates the holds tables and starts assigning returned books to the hold queues.
+
+    Args:
+        create_tables (bool, optional): False if the tables are known to exist (see migrations.ensure_schema).
+    """
+    if create_tables:
+        create_holds_table()
+    events.subscribe('loans', on_loan_event)
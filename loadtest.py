@@ -0,0 +1,397 @@
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from config import DATABASE, DEFAULT_BRANCH
+from errors import BookNotAvailable, LoanAlreadyReturned, BorrowLimitReached
+import retry
+
+
+# Load-testing harness simulating concurrent circulation desks.
+# Each worker (a thread or a process) plays one desk, running the model-layer equivalents of
+# the interactive flows in a loop, picked at random with the weights of an operation mix:
+#   checkout - loan_menu.add_loan: availability and hold checks, then Loan.save()
+#   return   - loan_menu.return_loan: Loan.return_book() on a random open loan
+#   lookup   - book_menu.get_book: the book record and its availability
+#   search   - the title and customer name searches
+#
+# Every operation is timed and classified as:
+#   ok       - completed
+#   rejected - refused by a business rule (book on loan or reserved, loan already returned)
+#   locked   - failed with 'database is locked' (sqlite's writer lock was not free in time)
+#   error    - any other failure, counted by exception type
+#
+# The test always runs on a copy of a database (or on a generated one), never on the
+# library's database itself, from a temporary directory that also receives the log and the
+# audit log. The desks run with the same write subscribers as main.py, so a write costs what
+# it costs at a real desk.
+#
+# Usage: python loadtest.py [--workers N] [--mode thread|process] [--duration S]
+#                           [--mix checkout=3,return=3,lookup=10,search=4] [--db PATH]
+
+DEFAULT_MIX = {'checkout': 3, 'return': 3, 'lookup': 10, 'search': 4}
+SAMPLE_SIZE = 2000  # Customer and book IDs each desk picks from
+SEARCH_WORDS = ('the', 'ring', 'war', 'night', 'garden', 'king', 'sea', 'Cohen', 'Levi', 'Tal', 'Noa', 'Dana')
+
+# Business outcomes of a desk operation, which are not failures of the database
+REJECTIONS = (BookNotAvailable, LoanAlreadyReturned, BorrowLimitReached)
+
+
+def checkout(rng, ids):
+    from loans import Loan
+    from helpers import is_available
+    from holds import check_reserved
+    from customer_index import check_borrow_limit
+
+    customer_id = rng.choice(ids['customers'])
+    book_id = rng.choice(ids['books'])
+
+    check_borrow_limit(customer_id)
+    is_available(book_id)
+    check_reserved(book_id, customer_id)
+    Loan(customer_id=customer_id, book_id=book_id).save()
+
+
+def return_loan(rng, ids):
+    from loans import Loan
+    from helpers import query_db
+
+    # Starting from a random ID spreads the returns over all open loans
+    query = "SELECT * FROM loans WHERE is_open = 1 AND id >= ? ORDER BY id LIMIT 1;"
+    rows = query_db(query=query, parameters=(rng.randint(1, ids['max_loan']),), result=True) or \
+        query_db(query="SELECT * FROM loans WHERE is_open = 1 ORDER BY id LIMIT 1;", result=True)
+    if not rows:
+        raise LoanAlreadyReturned("No open loans left")
+
+    row = rows[0]
+    l = Loan(customer_id=str(row[1]), book_id=str(row[2]), loan_date=row[3], expected_return_date=row[4],
+             actual_return_date=row[5], loan_id=row[0], override_id=True)
+    l.return_book()
+
+
+def lookup_book(rng, ids):
+    from helpers import get_by_id, availability_for
+
+    book_id = rng.choice(ids['books'])
+    get_by_id(book_id, 'books')
+    availability_for([book_id])
+
+
+def search(rng, ids):
+    from helpers import search_books_by_title, search_customers_by_name
+
+    search_books_by_title(rng.choice(SEARCH_WORDS))
+    search_customers_by_name(rng.choice(SEARCH_WORDS))
+
+
+OPERATIONS = {'checkout': checkout, 'return': return_loan, 'lookup': lookup_book, 'search': search}
+
+
+def parse_mix(text):
+    """
+    Parses an operation mix such as 'checkout=3,return=3,lookup=10,search=4'.
+
+    Args:
+        text (str): Comma-separated operation=weight pairs.
+
+    Returns:
+        dict: Operation name -> weight.
+
+    Raises:
+        ValueError: If an operation is unknown or a weight is not a non-negative number.
+    """
+    mix = {}
+    for pair in text.split(','):
+        name, _, weight = pair.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        mix[name] = float(weight)
+        if mix[name] < 0:
+            raise ValueError(f"Negative weight for {name}")
+
+    if not any(mix.values()):
+        raise ValueError("The operation mix is empty")
+
+    return mix
+
+
+def classify(error):
+    """
+    Classifies the outcome of an operation.
+
+    Args:
+        error (Exception): The exception the operation raised, or None.
+
+    Returns:
+        str: 'ok', 'rejected', 'locked' or 'error:<exception type>'.
+    """
+    if error is None:
+        return 'ok'
+    if isinstance(error, REJECTIONS):
+        return 'rejected'
+    if isinstance(error, sqlite3.OperationalError) and 'locked' in str(error):
+        return 'locked'
+
+    return f"error:{type(error).__name__}"
+
+
+def desk(seed, ids, mix, duration, operations=None):
+    """
+    Runs one desk's operations until the time is up.
+
+    Args:
+        seed (int): Seed of the desk's random choices.
+        ids (dict): 'customers' and 'books' ID samples, and 'max_loan', the highest loan ID.
+        mix (dict): Operation name -> weight.
+        duration (float): Seconds to run for.
+        operations (int, optional): Stop after this many operations instead.
+
+    Returns:
+        dict: 'elapsed' seconds, and per operation name, its 'latencies' (seconds) and 'outcomes' (Counter).
+    """
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = {name: {'latencies': [], 'outcomes': Counter()} for name in names}
+
+    start = time.perf_counter()
+    deadline = start + duration
+    done = 0
+    while time.perf_counter() < deadline and (operations is None or done < operations):
+        name = rng.choices(names, weights)[0]
+        error = None
+        began = time.perf_counter()
+        try:
+            OPERATIONS[name](rng, ids)
+        except Exception as e:
+            error = e
+        results[name]['latencies'].append(time.perf_counter() - began)
+        results[name]['outcomes'][classify(error)] += 1
+        done += 1
+
+    results['elapsed'] = time.perf_counter() - start
+
+    return results
+
+
+def desk_process(db, seed, ids, mix, duration, operations=None):
+    # A desk running in its own process, with the write subscribers main.py enables at startup
+    from shards import use_databases
+    from reports import enable_reporting
+    from holds import enable_holds
+    from changefeed import enable_changefeed
+    from customer_index import enable_customer_index
+    from audit import enable_audit, disable_audit
+
+    with use_databases({DEFAULT_BRANCH: db}):
+        enable_reporting(create_tables=False)
+        enable_holds(create_tables=False)
+        enable_changefeed(create_tables=False)
+        enable_customer_index(create_tables=False)
+        enable_audit(audit_path(db))
+        try:
+            results = desk(seed, ids, mix, duration, operations)
+        finally:
+            disable_audit()
+
+    return results, retry.metrics()
+
+
+def audit_path(db):
+    # The desks' audit log, next to the tested database rather than in system_files
+    return os.path.join(os.path.dirname(os.path.abspath(db)), 'audit.db')
+
+
+def sample_ids(seed):
+    """
+    Picks the customer and book IDs the desks work with.
+
+    Returns:
+        dict: 'customers' and 'books' -> lists of IDs (as strings), 'max_loan' -> the highest loan ID.
+    """
+    from helpers import query_db
+
+    rng = random.Random(seed)
+    ids = {}
+    for table in ('customers', 'books'):
+        rows = query_db(query=f"SELECT id FROM {table};", result=True)
+        if not rows:
+            raise ValueError(f"The database has no {table} to test with")
+        ids[table] = [str(row[0]) for row in rng.sample(rows, min(SAMPLE_SIZE, len(rows)))]
+    ids['max_loan'] = query_db(query="SELECT MAX(id) FROM loans;", result=True)[0][0] or 1
+
+    return ids
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(results, contention):
+    """
+    Merges the results of every desk.
+
+    Args:
+        results (list): The dicts returned by desk().
+        contention (list): The lock contention metrics of every process (see retry.metrics).
+
+    Returns:
+        dict: 'throughput' (operations per second across all desks), 'operations' (total), 'outcomes'
+            (Counter across all operations), 'contention' (the metrics of all processes added up),
+            and 'by_operation': name -> count, outcomes and the p50, p95 and p99 latencies in seconds.
+    """
+    summary = {'throughput': 0.0, 'operations': 0, 'outcomes': Counter(), 'by_operation': {},
+               'contention': {name: max(m[name] for m in contention) if name.startswith('max_')
+                              else sum(m[name] for m in contention) for name in contention[0]}}
+
+    for result in results:
+        count = sum(len(r['latencies']) for name, r in result.items() if name != 'elapsed')
+        summary['throughput'] += count / result['elapsed'] if result['elapsed'] else 0.0
+
+    for name in OPERATIONS:
+        latencies = sorted(l for result in results if name in result for l in result[name]['latencies'])
+        if not latencies:
+            continue
+        outcomes = sum((result[name]['outcomes'] for result in results if name in result), Counter())
+        summary['by_operation'][name] = {'count': len(latencies), 'outcomes': outcomes,
+                                         'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                                         'p99': percentile(latencies, 99)}
+        summary['operations'] += len(latencies)
+        summary['outcomes'] += outcomes
+
+    return summary
+
+
+def run(db, workers=4, mode='process', duration=10.0, mix=None, seed=0, operations=None):
+    """
+    Runs concurrent desks against a database.
+
+    Args:
+        db (str): Path of the database file to test (it is written to).
+        workers (int, optional): The number of desks.
+        mode (str, optional): 'process' runs every desk in its own process, as separate desk
+            terminals do; 'thread' runs them as threads of this process.
+        duration (float, optional): Seconds every desk runs for.
+        mix (dict, optional): Operation name -> weight. Defaults to DEFAULT_MIX.
+        seed (int, optional): Seed of the desks' random choices.
+        operations (int, optional): Stop every desk after this many operations.
+
+    Returns:
+        dict: The merged results (see summarize).
+    """
+    from shards import use_databases
+
+    mix = mix or DEFAULT_MIX
+    with use_databases({DEFAULT_BRANCH: db}):
+        ids = sample_ids(seed)
+
+    if mode == 'process':
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [executor.submit(desk_process, os.path.abspath(db), seed + i, ids, mix, duration, operations)
+                       for i in range(workers)]
+            results, contention = zip(*(future.result() for future in futures))
+    elif mode == 'thread':
+        import events
+        import reports
+        import holds
+        import changefeed
+        import customer_index
+        import audit
+
+        with use_databases({DEFAULT_BRANCH: db}):
+            reports.enable_reporting(create_tables=False)
+            holds.enable_holds(create_tables=False)
+            changefeed.enable_changefeed(create_tables=False)
+            customer_index.enable_customer_index(create_tables=False)
+            audit.enable_audit(audit_path(db))
+            retry.reset_metrics()
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(desk, seed + i, ids, mix, duration, operations)
+                               for i in range(workers)]
+                    results = [future.result() for future in futures]
+                contention = [retry.metrics()]
+            finally:
+                events.unsubscribe('loans', reports.on_loan_event)
+                events.unsubscribe('loans', holds.on_loan_event)
+                for table in changefeed.FEED_TABLES:
+                    events.unsubscribe(table, changefeed.on_change)
+                customer_index.disable_customer_index()
+                audit.disable_audit()
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    return summarize(results, contention)
+
+
+def print_summary(summary, workers, mode):
+    print(f"{workers} desks ({mode} mode): {summary['operations']} operations, "
+          f"{summary['throughput']:.1f} ops/s, {summary['outcomes']['locked']} 'database is locked' errors")
+    print(f"{'operation':<10}{'count':>8}{'ok':>8}{'rejected':>10}{'locked':>8}{'errors':>8}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in summary['by_operation'].items():
+        outcomes = stats['outcomes']
+        errors = sum(n for outcome, n in outcomes.items() if outcome.startswith('error:'))
+        print(f"{name:<10}{stats['count']:>8}{outcomes['ok']:>8}{outcomes['rejected']:>10}{outcomes['locked']:>8}"
+              f"{errors:>8}{stats['p50'] * 1000:>10.2f}{stats['p95'] * 1000:>10.2f}{stats['p99'] * 1000:>10.2f}")
+
+    contention = summary['contention']
+    print(f"Lock retries: {contention['retries']} ({contention['retry_wait']:.2f}s of backoff), "
+          f"{contention['failures']} given up; write queue: {contention['writes']} writes, "
+          f"{contention['queue_wait']:.2f}s waited, longest {contention['max_queue_wait'] * 1000:.1f} ms")
+
+    errors = {outcome: n for outcome, n in summary['outcomes'].items() if outcome.startswith('error:')}
+    if errors:
+        print('Errors:', ', '.join(f"{outcome[6:]} x{n}" for outcome, n in errors.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate concurrent circulation desks against a database.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of concurrent desks')
+    parser.add_argument('--mode', choices=('process', 'thread'), default='process')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run for')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Operation weights, e.g. checkout=3,return=3,lookup=10,search=4')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', default=None, help='Database to copy and test (default: generate one)')
+    parser.add_argument('--customers', type=int, default=10000, help='Customers to generate without --db')
+    parser.add_argument('--books', type=int, default=5000, help='Books to generate without --db')
+    parser.add_argument('--loans', type=int, default=100000, help='Loans to generate without --db')
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.db) if args.db else None
+    workdir = tempfile.mkdtemp(prefix='library-loadtest-')
+    os.makedirs(os.path.join(workdir, os.path.dirname(DATABASE)))
+    test_db = os.path.join(workdir, DATABASE)
+
+    # Running from the temporary directory, so the desks log there (the worker processes inherit it)
+    os.chdir(workdir)
+    try:
+        from shards import use_databases
+        from migrations import migrate_all_shards, create_tables
+
+        if source:
+            shutil.copyfile(source, test_db)
+        with use_databases({DEFAULT_BRANCH: test_db}):
+            migrate_all_shards()
+            create_tables()
+            if not source:
+                from datagen import generate
+                generate(customers=args.customers, books=args.books, loans=args.loans, seed=args.seed)
+
+        print_summary(run(test_db, workers=args.workers, mode=args.mode, duration=args.duration, mix=args.mix,
+                          seed=args.seed), args.workers, args.mode)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -1,6 +1,10 @@
 from helpers import auto_log, get_by_id, align_input, is_available
 from config import RE_PATT_D, ERRORS
 from loans import Loan
+from reports import show_dashboard
+from holds import place_hold, queue_position, check_reserved
+from customer_index import check_borrow_limit
+from errors import BookNotAvailable, BorrowLimitReached
 from datetime import date
 
 
@@ -16,18 +20,20 @@ def loan_menu():
     - Close a loan
     - Display all loans
     - Display all late loans
+    - Display the circulation dashboard
     - Return to the Main Menu
 
     No parameters or return values.
     """
     # Initialize valid action choices
-    loan_actions = ['1', '2', '3', '4', '0']
+    loan_actions = ['1', '2', '3', '4', '5', '0']
 
     # Display menu options
     print("\n[1] Open a new loan\n"
           "[2] Close a loan\n"
           "[3] Display all loans\n"
           "[4] Display all late loans\n"
+          "[5] Display circulation dashboard\n"
           "[0] Return to the Main Menu")
     loan_act = input("-->")
 
@@ -43,7 +49,7 @@ def loan_menu():
             loan_menu()
         case '2':
             loan_id = align_input('Enter loan ID: ', RE_PATT_D['loanID'], ERRORS['loanID'])
-            delete_loan(get_loan(loan_id))
+            return_loan(get_loan(loan_id))
             loan_menu()
         case '3':
             display_all_loans()
@@ -51,6 +57,9 @@ def loan_menu():
         case '4':
             display_all_loans(late_loans=True)
             loan_menu()
+        case '5':
+            show_dashboard()
+            loan_menu()
         case '0':
             return
 
@@ -84,6 +93,14 @@ def get_loan_d():
             print(e)
             cust_id_input = align_input('Enter customer ID: ', RE_PATT_D['custID'], ERRORS['custID'])
 
+    # Checking that the customer may open another loan
+    try:
+        check_borrow_limit(cust_id_input)
+    except BorrowLimitReached as e:
+        print(e)
+        loan_menu()
+        return
+
     # Book ID Input and Validation
     book_id_input = align_input('Enter book ID: ', RE_PATT_D['bookID'], ERRORS['bookID'])
     if book_id_input == '0':
@@ -102,8 +119,15 @@ def get_loan_d():
             book_id_input = align_input('Enter book ID: ', RE_PATT_D['bookID'], ERRORS['bookID'])
 
         try:
-            # Check for book availability
+            # Check for book availability, and that the book is not kept for another customer's hold
             is_available(book_id_input)
+            check_reserved(book_id_input, cust_id_input)
+        except BookNotAvailable as e:
+            # Offering to join the book's hold queue
+            print(e)
+            offer_hold(cust_id_input, book_id_input)
+            loan_menu()
+            return
         except Exception as e:
             # Handling availability related exceptions
             print(e)
@@ -113,6 +137,39 @@ def get_loan_d():
     return {'custID': cust_id_input, 'bookID': book_id_input}
 
 
+def offer_hold(customer_id, book_id):
+    """
+    Offers to place a hold on a book that is currently not available.
+
+    If the customer accepts, they are added to the end of the book's hold queue,
+    and the book is kept for them once it is returned and they are next in line.
+
+    Args:
+        customer_id (str): The customer ID.
+        book_id (str): The book ID.
+    """
+    print("\nPlace a hold on this book?\n"
+          "[1] Yes\n"
+          "[2] No")
+    while True:
+        hold_act = input("-->")
+        if hold_act in ['1', '2']:
+            break
+
+    if hold_act == '2':
+        return
+
+    try:
+        hold_id = place_hold(customer_id, book_id)
+    except Exception as e:
+        # Handling hold related exceptions, such as a customer already holding the book
+        auto_log("Error: ", e, error=True)
+        print(e)
+        return
+
+    print(f"\n*** Hold placed successfully! Position in queue: {queue_position(hold_id)} ***\n")
+
+
 def get_loan(id_num):
     """
     Retrieves loan information based on the loan ID.
@@ -174,33 +231,43 @@ def add_loan():
     print("\n*** Loan added successfully! ***\n")
 
 
-def delete_loan(loan):
+def return_loan(loan):
     """
-    Deletes a given loan after user confirmation.
+    Closes a given loan after user confirmation.
 
-    The function prompts the user to confirm the deletion of the loan.
-    If confirmed, the loan is deleted from the system.
+    The function prompts the user to confirm the return of the book. If confirmed, the loan
+    is stamped with today's date as its actual return date and kept in the loan history.
 
     Args:
-        loan (Loan): The Loan object to be deleted.
+        loan (Loan): The Loan object to be closed.
 
-    No return value. Prints confirmation upon successful deletion.
+    No return value. Prints confirmation upon successful return.
     """
-    print("\nConfirm delete?\n"
+    if not loan.is_open():
+        print("\nThis loan was already returned\n")
+        return
+
+    print("\nConfirm return?\n"
           "[1] Yes\n"
           "[2] No")
     while True:
-        del_loan_act = input("-->")
-        if del_loan_act == '1' or '2':
+        return_act = input("-->")
+        if return_act in ['1', '2']:
             break
 
-    # Matching user's choice for deletion confirmation
-    match del_loan_act:
+    # Matching user's choice for return confirmation
+    match return_act:
         case '1':
-            # Deleting the loan and logging the action
-            loan.delete()
-            auto_log('Loan deleted', log_id=loan.id)
-            print("\n*** Loan deleted successfully ***\n")
+            # Returning the book and logging the action
+            try:
+                loan.return_book()
+            except Exception as e:
+                auto_log("Error: ", e, error=True)
+                print(e)
+                return
+
+            auto_log('Loan returned', log_id=loan.id)
+            print("\n*** Loan returned successfully ***\n")
 
         case '2':
             return
@@ -218,14 +285,12 @@ def display_all_loans(late_loans=False):
 
     No return value. Prints details of loans or late loans based on the flag.
     """
-    loans = Loan.load_from_db()
+    if late_loans:
+        # Filtering the open loans whose expected return date has passed in the database
+        loans = Loan.load_from_db(condition=f"is_open = 1 AND expected_returndate < '{date.today()}'")
+    else:
+        # Listing the whole loan history, including the archived loans
+        loans = Loan.load_from_db(history=True)
 
     for l in loans:
-        if late_loans:
-            # Comparing loan return dates to filter late loans
-            temp = date.fromisoformat(l.expected_return_date)
-            if date.today() > temp:
-                l.show()
-        else:
-            # Displaying all loans
-            l.show()
+        l.show()
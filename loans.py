@@ -1,7 +1,8 @@
 from dbhandler import DataBaseHandler
 from config import LOAN_FIELDNAMES, RE_PATT_D, ERRORS
-from helpers import get_by_id, query_db, auto_log, regex_check, check_date
-from errors import InvalidEntry, InvalidDate
+from migrations import OPEN_LOAN_INDEXES, LOANS_ARCHIVE
+from helpers import get_by_id, query_all_shards, auto_log, regex_check, check_date, next_id
+from errors import InvalidEntry, InvalidDate, LoanAlreadyReturned
 from datetime import date
 from customers import Customer
 from books import Book
@@ -22,7 +23,8 @@ class Loan(DataBaseHandler):
             _book (Book): Book object associated with the loan.
             loan_date (date): Date when the loan was made.
             expected_return_date (date): Expected date for returning the loaned book.
-            _actual_return_date (date or str): Actual return date of the loaned book or 'Not returned'.
+            _actual_return_date (date or str): Actual return date of the loaned book or 'Not returned'
+                (stored as NULL with is_open = 1 in the database).
         """
 
     def __init__(self, customer_id, book_id, loan_date=None, expected_return_date=None,
@@ -44,11 +46,7 @@ class Loan(DataBaseHandler):
         self.book = book_id
 
         if override_id is False:
-            rowid = query_db(query="SELECT MAX(rowid) FROM loans", result=True)[0][0]
-            if not rowid:
-                self.id = 1
-            else:
-                self.id = str(int(rowid) + 1)
+            self.id = next_id('loans', 'loans_archive')  # IDs of archived loans are not reused
             self.loan_date = date.today()
             self.expected_return_date = self.loan_date + self._book.get_book_type_duration()
             self.actual_return_date = 'Not returned'
@@ -98,8 +96,12 @@ class Loan(DataBaseHandler):
 
     @actual_return_date.setter
     def actual_return_date(self, new_val):
-        if new_val == 'Not returned':
-            self._actual_return_date = 'Not returned'
+        self._actual_return_date = self._check_return_date(new_val)
+
+    def _check_return_date(self, new_val):
+        # Open loans are stored with a NULL actual return date
+        if new_val is None or new_val == 'Not returned':
+            return 'Not returned'
         else:
             valid_res = regex_check(RE_PATT_D['date'], new_val)
             valid_date = check_date(loan_date=self.loan_date, date_=new_val)
@@ -113,11 +115,55 @@ class Loan(DataBaseHandler):
             else:
                 date_object = date.fromisoformat(new_val)
 
-            self._actual_return_date = date_object
+            return date_object
+
+    def is_open(self):
+        # A loan is open until its actual return date is set
+        return self._actual_return_date == 'Not returned'
+
+    def return_book(self, return_date=None):
+        """
+        Closes the loan by stamping its actual return date. The loan is kept in the history.
+
+        The loan row and the data that follows the open loans (holds, overdue tracking, reports)
+        are updated in one transaction, through a 'return' change event. The object is only
+        stamped once the loan row is closed.
+
+        Args:
+            return_date (str, optional): The return date in 'YYYY-MM-DD' format. Defaults to today.
+
+        Returns:
+            bool: True if the operation is successful.
+
+        Raises:
+            LoanAlreadyReturned: If the loan is already closed, e.g. by another desk.
+            InvalidEntry: If the return date is not in the 'YYYY-MM-DD' format.
+            InvalidDate: If the return date is before the loan date or after today.
+        """
+        if not self.is_open():
+            auto_log(f"{LoanAlreadyReturned}", log_id=self.id, error=True)
+            raise LoanAlreadyReturned
+
+        actual_return_date = self._check_return_date(return_date or str(date.today()))
+
+        # Only an open loan is closed, so a loan returned concurrently is not returned twice
+        query = "UPDATE loans SET actual_returndate = ?, is_open = 0 WHERE id = ? AND is_open = 1;"
+        future = self._write('return', query=query, parameters=(f'{actual_return_date}', self.id))
+
+        if not future.result():
+            # No open loan was changed, so another desk returned it first
+            auto_log(f"{LoanAlreadyReturned}", log_id=self.id, error=True)
+            raise LoanAlreadyReturned
+
+        self._actual_return_date = actual_return_date
+
+        return True
 
     def obj_to_values(self):
+        actual_return_date = None if self.is_open() else f'{self._actual_return_date}'
+
         return (f'{self.id}', f'{self._customer._id}', f'{self._book.id}',
-                f'{self.loan_date}', f'{self.expected_return_date}', f'{self._actual_return_date}')
+                f'{self.loan_date}', f'{self.expected_return_date}', actual_return_date, int(self.is_open()))
 
     # Implementation of abstract methods from DataBaseHandler...
     def get_table(self):
@@ -142,14 +188,18 @@ class Loan(DataBaseHandler):
               f"Actual return date: {self._actual_return_date}")
 
     @classmethod
-    def load_from_db(cls):
+    def load_from_db(cls, condition=None, history=False):
         """
              Class method to load loan records from the database and create Loan objects.
 
+             Args:
+                 condition (str, optional): SQL condition for filtering the loans.
+                 history (bool, optional): Include the archived loans. Defaults to the loans table only.
+
              Returns:
                  list: A list of Loan objects loaded from the database.
              """
-        client_data = cls.load(table='loans')
+        client_data = cls.load(table='loans_history' if history else 'loans', condition=condition)
 
         objects = []
         for row in client_data:
@@ -166,22 +216,34 @@ class Loan(DataBaseHandler):
     @classmethod
     def create_loan_table(cls):
         """
-               Class method to create the 'loans' table in the database if it does not exist.
+               Class method to create the 'loans' table in every branch database if it does not exist.
                """
         query = """
         CREATE TABLE IF NOT EXISTS loans (
-            id TEXT PRIMARY KEY,
-            custID TEXT NOT NULL,
-            bookID TEXT NOT NULL,
+            id INTEGER PRIMARY KEY,
+            custID INTEGER NOT NULL,
+            bookID INTEGER NOT NULL,
             loandate TEXT NOT NULL,
             expected_returndate TEXT NOT NULL,
-            actual_returndate TEXT NOT NULL,
+            actual_returndate TEXT,
+            is_open INTEGER NOT NULL DEFAULT 1,
             FOREIGN KEY (custID) REFERENCES customers (id) ON DELETE RESTRICT,
             FOREIGN KEY (bookID) REFERENCES books (id) ON DELETE RESTRICT
         );
         """
 
+        # Indexes for finding the loans of a customer or a book without scanning the table,
+        # and partial indexes holding only the open loans, for the availability and late-loan checks
+        index_queries = ("CREATE INDEX IF NOT EXISTS idx_loans_custID ON loans (custID);",
+                         "CREATE INDEX IF NOT EXISTS idx_loans_bookID ON loans (bookID);",
+                         *OPEN_LOAN_INDEXES)
+
         foreign_key_query = "PRAGMA foreign_keys = ON;"
 
-        query_db(query=query)
-        query_db(query=foreign_key_query)
+        query_all_shards(query=query)
+        for index_query in index_queries:
+            query_all_shards(query=index_query)
+        # The archive of old returned loans, and the history view over both tables
+        for archive_query in LOANS_ARCHIVE:
+            query_all_shards(query=archive_query)
+        query_all_shards(query=foreign_key_query)
@@ -1,6 +1,12 @@
-from books import Book
-from customers import Customer
-from loans import Loan
+from migrations import ensure_schema
+from overdue import tracker
+from reports import enable_reporting
+from holds import enable_holds
+from changefeed import enable_changefeed
+from customer_index import enable_customer_index
+from audit import enable_audit
+from search_index import enable_search
+from snapshots import Snapshot, write_snapshot
 from primary_menu import menu_navigator
 
 
@@ -9,23 +15,45 @@ from primary_menu import menu_navigator
 # and then launches the primary menu for user interaction.
 #
 # The script relies on the following modules:
-# - books: Contains the Book class and related methods.
-# - customers: Contains the Customer class and related methods.
-# - loans: Contains the Loan class and related methods.
+# - migrations: Upgrades existing database files and creates the tables, when the schema changed.
+# - reports: Maintains the circulation statistics.
+# - holds: Keeps the hold queues of books that are on loan.
+# - changefeed: Records every change of the books, customers and loans for downstream consumers.
+# - search_index: Answers fuzzy catalogue searches from memory.
+# - snapshots: Saves the in-memory structures on exit, so the next start restores them instead of scanning.
+# - overdue: Tracks open loans, records the ones that become overdue and bills the late fees daily.
 # - primary_menu: Manages the primary user interface and navigation.
+#
+# The models (books, customers, loans) and the menus are imported when they are first needed.
+# bench_startup.py measures the time from launch to the first prompt.
 
 if __name__ == '__main__':
-    # Create tables for customers, books, and loans in the database.
-    # These methods are responsible for setting up the initial database schema,
-    # ensuring that the application has the necessary structure to store and
-    # retrieve data effectively.
+    # Set up the database schema: migrate existing files and create the tables for customers,
+    # books, loans and the subsystems. The schema state is cached, so when no file changed
+    # since the last start, this only reads the file headers.
+    created = ensure_schema()
+
+    enable_reporting(create_tables=created)       # Maintains the circulation aggregates on every loan.
+    enable_holds(create_tables=created)           # Assigns returned books to their hold queues.
+    enable_changefeed(create_tables=created)      # Records the changes of the models in the change feed.
+    enable_customer_index(create_tables=created)  # Counts every customer's loans for the limit checks.
+    enable_audit()                                # Records the committed writes in the audit log.
+
+    # Restore the in-memory structures from the last snapshot, falling back to a full load.
+    with Snapshot() as snapshot:
+        enable_search(snapshot)       # Loads the catalogue search index.
+        tracker.load(snapshot)        # Loads the open loans to track.
 
-    Customer.create_customer_table()  # Creates the customer table.
-    Book.create_book_table()          # Creates the book table.
-    Loan.create_loan_table()          # Creates the loan table.
+    # Start tracking open loans in the background, recording newly overdue loans on every tick
+    # and computing the late fees once a day.
+    tracker.start()
 
     # Launch the primary menu of the application.
     # The menu_navigator function handles user inputs and navigates through
     # different functionalities of the library management system, such as
     # adding books, registering customers, and managing loans.
-    menu_navigator()
+    try:
+        menu_navigator()
+    finally:
+        # Saving the in-memory structures, so the next start does not have to rebuild them
+        write_snapshot()
@@ -0,0 +1,467 @@
+import json
+from helpers import transaction, query_db, schema_state, auto_log
+from shards import get_shard, all_shards
+from config import SCHEMA_CACHE
+from errors import MigrationError
+
+
+# Versioned schema migrations.
+# The schema version of a database file is kept in its 'PRAGMA user_version'. Every migration
+# upgrades the schema by one version and knows how to downgrade it back. Migrations rebuild
+# tables in place (create, copy, drop, rename) inside one transaction, so a failed migration
+# leaves the file untouched.
+#
+# Versions:
+#   0 - Original schema: TEXT ids, loan dates as TEXT, open loans marked by 'Not returned'.
+#   1 - INTEGER ids, ISO dates with NULL as the actual return date of open loans,
+#       an 'is_open' flag and indexes on the loans' customer and book IDs.
+#   2 - Partial indexes over the open loans, so returned loans stay out of the hot lookups.
+#   3 - A 'loans_archive' table for old returned loans, and a 'loans_history' view over both tables.
+#   4 - The 'changes' and 'change_checkpoints' tables of the change feed (see changefeed.py).
+#   5 - The 'customer_loans' index of every customer's loan counts and borrowing limit,
+#       filled from the loan history (see customer_index.py).
+
+BOOKS_V1 = """
+    CREATE TABLE books (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL,
+        author_pname TEXT NOT NULL,
+        author_lname TEXT NOT NULL,
+        publication_year INTEGER NOT NULL,
+        type INTEGER NOT NULL
+    );
+"""
+
+CUSTOMERS_V1 = """
+    CREATE TABLE customers (
+        id INTEGER PRIMARY KEY,
+        p_name TEXT NOT NULL,
+        l_name TEXT NOT NULL,
+        city TEXT NOT NULL,
+        age INTEGER NOT NULL
+    );
+"""
+
+LOANS_V1 = """
+    CREATE TABLE loans (
+        id INTEGER PRIMARY KEY,
+        custID INTEGER NOT NULL,
+        bookID INTEGER NOT NULL,
+        loandate TEXT NOT NULL,
+        expected_returndate TEXT NOT NULL,
+        actual_returndate TEXT,
+        is_open INTEGER NOT NULL DEFAULT 1,
+        FOREIGN KEY (custID) REFERENCES customers (id) ON DELETE RESTRICT,
+        FOREIGN KEY (bookID) REFERENCES books (id) ON DELETE RESTRICT
+    );
+"""
+
+LOANS_V1_INDEXES = ("CREATE INDEX IF NOT EXISTS idx_loans_custID ON loans (custID);",
+                    "CREATE INDEX IF NOT EXISTS idx_loans_bookID ON loans (bookID);")
+
+# Returned loans are kept in the loans table; these indexes only hold the open ones
+OPEN_LOAN_INDEXES = ("CREATE INDEX IF NOT EXISTS idx_loans_open_bookID ON loans (bookID) WHERE is_open = 1;",
+                     "CREATE INDEX IF NOT EXISTS idx_loans_open_custID ON loans (custID) WHERE is_open = 1;",
+                     "CREATE INDEX IF NOT EXISTS idx_loans_open_expected ON loans (expected_returndate) "
+                     "WHERE is_open = 1;")
+
+# Old returned loans are moved to the archive (see archive.py). The archive has no foreign keys,
+# so books and customers that only have archived loans can be deleted.
+LOANS_ARCHIVE = ("""
+    CREATE TABLE IF NOT EXISTS loans_archive (
+        id INTEGER PRIMARY KEY,
+        custID INTEGER NOT NULL,
+        bookID INTEGER NOT NULL,
+        loandate TEXT NOT NULL,
+        expected_returndate TEXT NOT NULL,
+        actual_returndate TEXT,
+        is_open INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+                 "CREATE INDEX IF NOT EXISTS idx_loans_archive_custID ON loans_archive (custID);",
+                 "CREATE INDEX IF NOT EXISTS idx_loans_archive_bookID ON loans_archive (bookID);",
+                 # Every loan, open, returned or archived
+                 "CREATE VIEW IF NOT EXISTS loans_history AS "
+                 "SELECT * FROM loans UNION ALL SELECT * FROM loans_archive;")
+
+# Every change of the books, customers and loans, and how far each consumer has read (see changefeed.py).
+# AUTOINCREMENT keeps the sequence numbers growing, even after the oldest changes are pruned.
+CHANGEFEED_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL,
+        action TEXT NOT NULL,
+        rowID INTEGER NOT NULL,
+        data TEXT,
+        changed TEXT NOT NULL
+    );
+    """, """
+    CREATE TABLE IF NOT EXISTS change_checkpoints (
+        consumer TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL
+    );
+    """)
+
+# Open and total loans, latest loan and borrowing limit of every customer (see customer_index.py).
+# A NULL borrowing limit means the default MAX_OPEN_LOANS.
+CUSTOMER_INDEX_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS customer_loans (
+        custID INTEGER PRIMARY KEY,
+        open_loans INTEGER NOT NULL DEFAULT 0,
+        total_loans INTEGER NOT NULL DEFAULT 0,
+        last_loanID INTEGER,
+        borrow_limit INTEGER
+    );
+    """,)
+
+# Recounting every customer's loans from the loan history, archived loans included,
+# keeping the borrowing limits that were set
+CUSTOMER_INDEX_REBUILD = ("UPDATE customer_loans SET open_loans = 0, total_loans = 0, last_loanID = NULL;",
+                          """
+    INSERT INTO customer_loans (custID, open_loans, total_loans, last_loanID)
+    SELECT custID, SUM(is_open), COUNT(*), MAX(id) FROM loans_history WHERE true GROUP BY custID
+    ON CONFLICT (custID) DO UPDATE SET open_loans = excluded.open_loans, total_loans = excluded.total_loans,
+        last_loanID = excluded.last_loanID;
+    """)
+
+# The late fee ledger and the history of the fee runs (see fees.py)
+FEES_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS fees (
+        loanID INTEGER PRIMARY KEY,
+        custID INTEGER NOT NULL,
+        bookID INTEGER NOT NULL,
+        days_late INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        final INTEGER NOT NULL DEFAULT 0,
+        computed TEXT NOT NULL
+    );
+    """,
+               "CREATE INDEX IF NOT EXISTS idx_fees_custID ON fees (custID);",
+               "CREATE INDEX IF NOT EXISTS idx_fees_open ON fees (final) WHERE final = 0;",
+               """
+    CREATE TABLE IF NOT EXISTS fee_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_date TEXT NOT NULL,
+        loans_updated INTEGER NOT NULL
+    );
+    """)
+
+BOOKS_V0 = """
+    CREATE TABLE books (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        author_pname TEXT NOT NULL,
+        author_lname TEXT NOT NULL,
+        publication_year INTEGER NOT NULL,
+        type INTEGER NOT NULL
+    );
+"""
+
+CUSTOMERS_V0 = """
+    CREATE TABLE customers (
+        id TEXT PRIMARY KEY,
+        p_name TEXT NOT NULL,
+        l_name TEXT NOT NULL,
+        city TEXT NOT NULL,
+        age INTEGER NOT NULL
+    );
+"""
+
+LOANS_V0 = """
+    CREATE TABLE loans (
+        id TEXT PRIMARY KEY,
+        custID TEXT NOT NULL,
+        bookID TEXT NOT NULL,
+        loandate TEXT NOT NULL,
+        expected_returndate TEXT NOT NULL,
+        actual_returndate TEXT NOT NULL,
+        FOREIGN KEY (custID) REFERENCES customers (id) ON DELETE RESTRICT,
+        FOREIGN KEY (bookID) REFERENCES books (id) ON DELETE RESTRICT
+    );
+"""
+
+
+def rebuild_table(c, table, create_query, select_query):
+    """
+    Rebuilds a table with a new definition, copying its rows through a SELECT.
+
+    Args:
+        c (sqlite3.Cursor): Cursor of the migration's transaction.
+        table (str): The table to rebuild.
+        create_query (str): CREATE TABLE statement of the new definition (for `table`).
+        select_query (str): SELECT over the old table returning the new columns.
+    """
+    # Following sqlite's procedure: create the new table, copy, drop the old one, rename
+    c.execute(create_query.replace(f"CREATE TABLE {table} ", f"CREATE TABLE new_{table} ", 1))
+    c.execute(f"INSERT INTO new_{table} {select_query};")
+    c.execute(f"DROP TABLE {table};")
+    c.execute(f"ALTER TABLE new_{table} RENAME TO {table};")
+
+
+def check_integer_ids(c, table, columns):
+    """
+    Verifies that ID columns can be converted to INTEGER without losing information.
+
+    Args:
+        c (sqlite3.Cursor): Cursor of the migration's transaction.
+        table (str): The table to check.
+        columns (tuple): The ID columns to check.
+
+    Raises:
+        MigrationError: If an ID is not a number, or has leading zeros.
+    """
+    for column in columns:
+        c.execute(f"SELECT COUNT(*) FROM {table} WHERE CAST(CAST({column} AS INTEGER) AS TEXT) != {column};")
+        if c.fetchone()[0]:
+            raise MigrationError(f"{table}.{column} has IDs that can not be converted to numbers")
+
+
+def upgrade_1(c):
+    # Converting ids to INTEGER and the 'Not returned' sentinel to NULL plus an open flag
+    check_integer_ids(c, 'books', ('id',))
+    check_integer_ids(c, 'customers', ('id',))
+    check_integer_ids(c, 'loans', ('id', 'custID', 'bookID'))
+
+    rebuild_table(c, 'books', BOOKS_V1,
+                  "SELECT CAST(id AS INTEGER), title, author_pname, author_lname, publication_year, type "
+                  "FROM books")
+    rebuild_table(c, 'customers', CUSTOMERS_V1,
+                  "SELECT CAST(id AS INTEGER), p_name, l_name, city, age FROM customers")
+    rebuild_table(c, 'loans', LOANS_V1,
+                  "SELECT CAST(id AS INTEGER), CAST(custID AS INTEGER), CAST(bookID AS INTEGER), loandate, "
+                  "expected_returndate, NULLIF(actual_returndate, 'Not returned'), "
+                  "actual_returndate = 'Not returned' FROM loans")
+
+    for query in LOANS_V1_INDEXES:
+        c.execute(query)
+
+
+def downgrade_1(c):
+    # Restoring TEXT ids and the 'Not returned' sentinel, dropping the open flag
+    rebuild_table(c, 'books', BOOKS_V0,
+                  "SELECT CAST(id AS TEXT), title, author_pname, author_lname, publication_year, type "
+                  "FROM books")
+    rebuild_table(c, 'customers', CUSTOMERS_V0,
+                  "SELECT CAST(id AS TEXT), p_name, l_name, city, age FROM customers")
+    rebuild_table(c, 'loans', LOANS_V0,
+                  "SELECT CAST(id AS TEXT), CAST(custID AS TEXT), CAST(bookID AS TEXT), loandate, "
+                  "expected_returndate, CASE WHEN is_open THEN 'Not returned' ELSE actual_returndate END "
+                  "FROM loans")
+
+
+def upgrade_2(c):
+    # Indexing the open loans separately from the returned ones
+    for query in OPEN_LOAN_INDEXES:
+        c.execute(query)
+
+
+def downgrade_2(c):
+    for name in ('idx_loans_open_bookID', 'idx_loans_open_custID', 'idx_loans_open_expected'):
+        c.execute(f"DROP INDEX IF EXISTS {name};")
+
+
+def upgrade_3(c):
+    # Adding the archive of returned loans
+    for query in LOANS_ARCHIVE:
+        c.execute(query)
+
+
+def downgrade_3(c):
+    # Moving the archived loans back, so no history is lost
+    c.execute("INSERT INTO loans SELECT * FROM loans_archive;")
+    c.execute("DROP VIEW IF EXISTS loans_history;")
+    c.execute("DROP TABLE loans_archive;")
+
+
+def upgrade_4(c):
+    # Adding the change feed
+    for query in CHANGEFEED_TABLES:
+        c.execute(query)
+
+
+def downgrade_4(c):
+    c.execute("DROP TABLE IF EXISTS change_checkpoints;")
+    c.execute("DROP TABLE IF EXISTS changes;")
+
+
+def upgrade_5(c):
+    # Adding the customer loan index, filled from the existing loans
+    for query in CUSTOMER_INDEX_TABLES + CUSTOMER_INDEX_REBUILD:
+        c.execute(query)
+
+
+def downgrade_5(c):
+    c.execute("DROP TABLE IF EXISTS customer_loans;")
+
+
+def upgrade_6(c):
+    # Adding the late fee ledger, and dropping the full due date index fees.py used to create,
+    # as the open-loan one serves the fee runs
+    for query in FEES_TABLES:
+        c.execute(query)
+    c.execute("DROP INDEX IF EXISTS idx_loans_expected;")
+
+
+def downgrade_6(c):
+    c.execute("DROP TABLE IF EXISTS fee_runs;")
+    c.execute("DROP TABLE IF EXISTS fees;")
+
+
+# Version -> (upgrade to this version, downgrade from this version)
+MIGRATIONS = {1: (upgrade_1, downgrade_1), 2: (upgrade_2, downgrade_2), 3: (upgrade_3, downgrade_3),
+              4: (upgrade_4, downgrade_4), 5: (upgrade_5, downgrade_5), 6: (upgrade_6, downgrade_6)}
+LATEST_VERSION = max(MIGRATIONS)
+
+
+def get_version(db=None):
+    """
+    Returns the schema version of a database file.
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        int: The schema version.
+    """
+    return query_db(query="PRAGMA user_version;", db=db, result=True)[0][0]
+
+
+def has_tables(db=None):
+    """
+    Checks if a database file already holds the library tables.
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+
+    Returns:
+        bool: True if the 'loans' table exists.
+    """
+    query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'loans';"
+
+    return bool(query_db(query=query, db=db, result=True)[0][0])
+
+
+def migrate(db=None, target=LATEST_VERSION):
+    """
+    Upgrades or downgrades the schema of a database file, in place, to a target version.
+
+    A file without the library tables has nothing to convert; it is stamped with the
+    target version, and the tables are created with the current definitions.
+
+    Args:
+        db (str, optional): Path of the database file. Defaults to the default branch's database.
+        target (int, optional): The schema version to migrate to. Defaults to the latest version.
+
+    Returns:
+        int: The schema version of the file after the migration.
+
+    Raises:
+        MigrationError: If the target version is unknown, or the data can not be converted.
+    """
+    if not 0 <= target <= LATEST_VERSION:
+        raise MigrationError(f"Unknown schema version: {target}")
+
+    db = db or get_shard()
+    version = get_version(db)
+
+    if not has_tables(db):
+        query_db(query=f"PRAGMA user_version = {target};", db=db)
+        return target
+
+    # Applying one migration per transaction, so an interrupted run resumes where it stopped
+    while version != target:
+        step = version + 1 if target > version else version
+        upgrade, downgrade = MIGRATIONS[step]
+
+        # Beginning the write transaction explicitly makes the table rebuilds part of it
+        with transaction(db, write=True) as c:
+            if target > version:
+                upgrade(c)
+                version = step
+            else:
+                downgrade(c)
+                version = step - 1
+            c.execute(f"PRAGMA user_version = {version};")
+
+        auto_log('Schema migrated', log_id=f"{db} -> version {version}")
+
+    return version
+
+
+def migrate_all_shards(target=LATEST_VERSION):
+    """
+    Migrates every branch database file to a target version.
+
+    Args:
+        target (int, optional): The schema version to migrate to. Defaults to the latest version.
+    """
+    for db in all_shards():
+        migrate(db=db, target=target)
+
+
+def create_tables():
+    """
+    Creates the tables of the models and of the subsystems enabled at startup, if they do not exist.
+    """
+    # Imported here, as the models and subsystems are only needed when the schema is set up
+    from customers import Customer
+    from books import Book
+    from loans import Loan
+    from overdue import create_notifications_table
+    from reports import create_report_tables
+    from holds import create_holds_table
+    from changefeed import create_changefeed_tables
+    from customer_index import create_customer_index_tables
+    from fees import create_fees_tables
+
+    Customer.create_customer_table()
+    Book.create_book_table()
+    Loan.create_loan_table()
+    create_notifications_table()
+    create_report_tables()
+    create_holds_table()
+    create_changefeed_tables()
+    create_customer_index_tables()
+    create_fees_tables()
+
+
+def ensure_schema(cache=SCHEMA_CACHE):
+    """
+    Migrates the database files and creates the tables, unless nothing changed since the last start.
+
+    The schema cookie and version of every file are read from the file headers, without a
+    connection, and compared with the ones cached after the last setup. The setup only runs
+    when a file, its schema, or the latest schema version of the code differs from the cache.
+
+    Args:
+        cache (str, optional): Path of the schema cache file.
+
+    Returns:
+        bool: True if the schema was set up, False if the cache was current.
+    """
+    def current_state():
+        return {db: [*schema_state(db), LATEST_VERSION] for db in all_shards()}
+
+    try:
+        with open(cache) as f:
+            if json.load(f) == current_state():
+                return False
+    except (FileNotFoundError, ValueError):
+        pass
+
+    migrate_all_shards()
+    create_tables()
+
+    # Caching the state after the setup, as creating tables changes the schema cookie
+    with open(cache, 'w') as f:
+        json.dump(current_state(), f)
+
+    return True
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Usage: python migrations.py [target_version]
+    migrate_all_shards(int(sys.argv[1]) if len(sys.argv) > 1 else LATEST_VERSION)
+    print(f"Schema version: {get_version()}")
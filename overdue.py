@@ -0,0 +1,332 @@
+import heapq
+import threading
+from array import array
+from datetime import date, datetime
+import events
+import snapshots
+from fees import calculate_fees
+from helpers import query_db, query_all_shards, transaction, auto_log
+from shards import get_shard
+from config import OVERDUE_TICK_SECONDS, OVERDUE_CHUNK_SIZE
+
+
+# Incremental overdue tracking.
+# Open loans are kept in a min-heap ordered by expected return date. Each tick only pops the
+# loans that became due since the last tick and records them in the 'notifications' table,
+# so the work of a tick grows with the number of newly overdue loans, not with the loans table.
+#
+# The heap only follows the loans written by this process. Loans opened by other processes
+# (other desks, imports) are found by a range read over the open-loan due date index, covering
+# the due dates between the previous tick and this one, so that read also stays small.
+# The due loans are popped before they are recorded; if recording fails, they are pushed back
+# and reported by the next tick.
+#
+# The background thread also runs the late fee billing (fees.calculate_fees) once a day, on
+# the first tick of every date.
+
+
+class OverdueTracker:
+    """
+    Tracks open loans by due date and reports the loans that become overdue.
+
+    The heap is built once from the open loans and then kept up to date through the
+    'loans' change events. Closed loans are not removed from the heap; their entries are
+    skipped when they reach the top (lazy deletion).
+    """
+
+    def __init__(self):
+        self._heap = []   # (expected return date as ISO string, loan ID)
+        self._open = {}   # Loan ID -> expected return date of the open loans
+        self._lock = threading.Lock()
+        self._scanned_until = None  # Due dates before this one (ISO string) were read by a tick
+        self._billed = None         # Date of the last fee run of the background thread
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self, snapshot=None):
+        """
+        Builds the heap from the open loans of all branches.
+
+        Args:
+            snapshot (snapshots.Snapshot, optional): The startup snapshot. If it holds the open
+                loans, only the loans opened since it was taken are read from the database.
+        """
+        if snapshot is not None and self.restore(snapshot):
+            return
+
+        query = "SELECT id, expected_returndate FROM loans WHERE is_open = 1;"
+        rows = query_all_shards(query=query, result=True)
+        self._fill({str(row[0]): str(row[1]) for row in rows})
+
+    def _fill(self, open_loans):
+        with self._lock:
+            self._open = open_loans
+            self._heap = [(due, loan_id) for loan_id, due in self._open.items()]
+            heapq.heapify(self._heap)
+            # The loans opened from now on by other processes are found by the ticks' range reads
+            self._scanned_until = str(date.today())
+
+    def dump(self):
+        """
+        Dumps the open loans for the snapshot.
+
+        Returns:
+            bytes: (loan ID, expected return date as a day ordinal) pairs, as unsigned integers.
+        """
+        entries = array('I')
+        with self._lock:
+            for loan_id, due in self._open.items():
+                entries.extend((int(loan_id), date.fromisoformat(due).toordinal()))
+
+        return entries.tobytes()
+
+    def restore(self, snapshot):
+        """
+        Rebuilds the heap from a snapshot, and replays the loans opened since it was taken.
+
+        Loans closed since the snapshot stay in the heap; tick() skips them, as it only
+        reports loans that are still open in the database.
+
+        Args:
+            snapshot (snapshots.Snapshot): The opened snapshot.
+
+        Returns:
+            bool: True if the heap was restored, False if the snapshot is missing or out of date.
+        """
+        data = snapshot.section('open_loans')
+        if data is None or not snapshot.same_schema():
+            return False
+
+        entries = array('I')
+        entries.frombytes(data)
+        open_loans = {str(entries[i]): date.fromordinal(entries[i + 1]).isoformat()
+                      for i in range(0, len(entries), 2)}
+
+        # Replaying only the loans added after the snapshot, read through the primary key
+        if not snapshot.is_current():
+            rows = query_all_shards(query="SELECT id, expected_returndate FROM loans WHERE id > ? AND is_open = 1;",
+                                    parameters=(snapshot.ids.get('loans', 0),), result=True)
+            open_loans.update((str(row[0]), str(row[1])) for row in rows)
+
+        self._fill(open_loans)
+
+        return True
+
+    def loan_opened(self, loan_id, expected_return_date):
+        """
+        Adds an open loan to the tracker.
+
+        Args:
+            loan_id (str): The loan ID.
+            expected_return_date (date or str): The expected return date.
+        """
+        with self._lock:
+            self._open[str(loan_id)] = str(expected_return_date)
+            heapq.heappush(self._heap, (str(expected_return_date), str(loan_id)))
+
+    def loan_closed(self, loan_id):
+        """
+        Removes a loan from the tracker. Its heap entry is skipped when it reaches the top.
+
+        Args:
+            loan_id (str): The loan ID.
+        """
+        with self._lock:
+            self._open.pop(str(loan_id), None)
+
+    def on_loan_event(self, action, loan, cursor):
+        """
+        Keeps the tracker up to date with the 'loans' change events.
+
+        Args:
+            action (str): 'insert', 'update', 'delete' or 'return'.
+            loan (Loan): The changed loan.
+            cursor (sqlite3.Cursor): Cursor of the change's transaction (unused).
+        """
+        # Returned loans are no longer open
+        if action in ('delete', 'return') or not loan.is_open():
+            self.loan_closed(loan.id)
+        elif action == 'insert':
+            self.loan_opened(loan.id, loan.expected_return_date)
+
+    def pop_due(self, today=None):
+        """
+        Pops the open loans whose expected return date has passed.
+
+        Args:
+            today (date, optional): The current date. Defaults to today.
+
+        Returns:
+            list: IDs of the loans that became overdue.
+        """
+        return [loan_id for expected, loan_id in self._pop(today)]
+
+    def _pop(self, today=None):
+        # The (expected return date, loan ID) entries of the due open loans, removed from the tracker
+        today = str(today or date.today())
+        due = []
+
+        with self._lock:
+            while self._heap and self._heap[0][0] < today:
+                expected, loan_id = heapq.heappop(self._heap)
+                # Skipping entries of loans that were closed or re-added since they were pushed
+                if self._open.get(loan_id) == expected:
+                    del self._open[loan_id]
+                    due.append((expected, loan_id))
+
+        return due
+
+    def _push_back(self, entries):
+        # Tracking popped loans again, unless they were re-added meanwhile
+        with self._lock:
+            for expected, loan_id in entries:
+                self._open.setdefault(loan_id, expected)
+                heapq.heappush(self._heap, (expected, loan_id))
+
+    def tick(self, today=None):
+        """
+        Records the loans that became overdue since the last tick in the 'notifications' table.
+
+        Args:
+            today (date, optional): The current date. Defaults to today.
+
+        Returns:
+            list: IDs of the newly overdue loans.
+        """
+        today = str(today or date.today())
+        entries = self._pop(today)
+        recorded = set()
+
+        try:
+            due = {loan_id for expected, loan_id in entries}
+            if self._scanned_until is not None and self._scanned_until < today:
+                # The loans of other processes that became due since the previous tick
+                rows = query_all_shards(query="SELECT id FROM loans WHERE is_open = 1 "
+                                              "AND expected_returndate >= ? AND expected_returndate < ?;",
+                                        parameters=(self._scanned_until, today), result=True)
+                due.update(str(row[0]) for row in rows)
+
+            # Re-reading only the newly due loans, as they may have been closed by another process,
+            # and recording them a chunk at a time, as a long-idle library may have many of them
+            rows = []
+            due = sorted(due)
+            created = datetime.now().isoformat(timespec='seconds')
+            for start in range(0, len(due), OVERDUE_CHUNK_SIZE):
+                chunk = due[start:start + OVERDUE_CHUNK_SIZE]
+                placeholders = ', '.join('?' for _ in chunk)
+                query = f"SELECT id, custID, bookID, expected_returndate FROM loans " \
+                        f"WHERE is_open = 1 AND id IN ({placeholders});"
+                chunk_rows = query_all_shards(query=query, parameters=tuple(chunk), result=True)
+
+                with transaction(get_shard(), write=True) as c:
+                    c.executemany("INSERT OR IGNORE INTO notifications "
+                                  "(loanID, custID, bookID, expected_returndate, created) VALUES (?, ?, ?, ?, ?);",
+                                  [(*row, created) for row in chunk_rows])
+                rows.extend(chunk_rows)
+                recorded.update(chunk)
+        except BaseException:
+            # The loans of the chunks not recorded are reported again by the next tick
+            self._push_back([entry for entry in entries if entry[1] not in recorded])
+            raise
+
+        rows.sort(key=lambda row: (row[3], row[0]))
+
+        if self._scanned_until is not None:
+            self._scanned_until = max(self._scanned_until, today)
+
+        for row in rows:
+            auto_log('Loan overdue', log_id=row[0])
+
+        return [str(row[0]) for row in rows]
+
+    def start(self, interval=OVERDUE_TICK_SECONDS):
+        """
+        Runs tick() on a background thread every `interval` seconds, and the fee run once a day.
+
+        Args:
+            interval (float, optional): Seconds between ticks.
+        """
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='overdue-tracker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread started by start().
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        # Ticking once at startup, and then on every interval until stopped
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                auto_log("Overdue tick failed", e, error=True)
+            self._bill()
+            if self._stop.wait(interval):
+                break
+
+    def _bill(self):
+        # Running the fee run on the first tick of a date; a failed run is retried on the next tick
+        today = date.today()
+        if self._billed == today:
+            return
+
+        try:
+            calculate_fees(today)
+            self._billed = today
+        except Exception as e:
+            auto_log("Fee run failed", e, error=True)
+
+
+def create_notifications_table():
+    """
+    Creates the 'notifications' table, holding one reminder per overdue loan, if it does not exist.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        loanID INTEGER NOT NULL UNIQUE,
+        custID INTEGER NOT NULL,
+        bookID INTEGER NOT NULL,
+        expected_returndate TEXT NOT NULL,
+        created TEXT NOT NULL,
+        sent INTEGER NOT NULL DEFAULT 0
+    );
+    """
+
+    query_db(query=query, db=get_shard())
+
+
+def pending_reminders():
+    """
+    Returns the overdue notifications that were not sent yet.
+
+    Returns:
+        list: The pending notification records.
+    """
+    return query_db(query="SELECT * FROM notifications WHERE sent = 0 ORDER BY id;", db=get_shard(), result=True)
+
+
+def mark_sent(notification_ids):
+    """
+    Marks notifications as sent.
+
+    Args:
+        notification_ids (list): IDs of the sent notifications.
+    """
+    with transaction(get_shard(), write=True) as c:
+        c.executemany("UPDATE notifications SET sent = 1 WHERE id = ?;", [(id_,) for id_ in notification_ids])
+
+
+# The tracker of this process, kept up to date with the loans written through the models
+tracker = OverdueTracker()
+events.subscribe('loans', tracker.on_loan_event)
+snapshots.register('open_loans', tracker.dump)
@@ -0,0 +1,164 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from config import POOL_SIZE, POOL_TIMEOUT, BUSY_TIMEOUT
+
+
+# Pooled sqlite connections.
+# Opening a connection for every query is expensive under load, so query_db borrows
+# connections from a per-database pool and hands them back when the query is done.
+
+_pools = {}                   # Database file -> ConnectionPool
+_pragmas = {}                 # Database file -> PRAGMA statements run on every new connection
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    A bounded pool of sqlite connections to one database file.
+
+    Connections are opened lazily up to `size` and may be used from any thread,
+    but only by one thread at a time.
+
+    Args:
+        db (str): Path of the database file.
+        size (int, optional): Maximum number of open connections.
+        timeout (float, optional): Seconds to wait for a free connection before failing.
+        pragmas (tuple, optional): PRAGMA statements run on every new connection.
+    """
+
+    def __init__(self, db, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=()):
+        self.db = db
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self._idle = queue.LifoQueue()  # Most recently used connections are reused first
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Borrows a connection from the pool, opening a new one if the pool is not full.
+
+        Returns:
+            sqlite3.Connection: A connection to the pool's database.
+
+        Raises:
+            TimeoutError: If no connection becomes free within the timeout.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                # Failing fast on a locked database, as the callers retry with backoff (see retry.py)
+                conn = sqlite3.connect(self.db, timeout=BUSY_TIMEOUT, check_same_thread=False)
+                for pragma in self.pragmas:
+                    conn.execute(pragma)
+                return conn
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free database connection to {self.db}")
+
+    def release(self, conn):
+        """
+        Returns a borrowed connection to the pool.
+
+        Args:
+            conn (sqlite3.Connection): The connection to return.
+        """
+        # Never hand out a connection with a transaction left open
+        if conn.in_transaction:
+            conn.rollback()
+
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager borrowing a connection for the duration of a block.
+
+        Yields:
+            sqlite3.Connection: A connection to the pool's database.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Closes every idle connection of the pool.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+def get_pool(db):
+    """
+    Returns the connection pool of a database file, creating it on first use.
+
+    Args:
+        db (str): Path of the database file.
+
+    Returns:
+        ConnectionPool: The database's pool.
+    """
+    with _pools_lock:
+        if db not in _pools:
+            _pools[db] = ConnectionPool(db, pragmas=_pragmas.get(db, ()))
+
+        return _pools[db]
+
+
+def configure(db, pragmas):
+    """
+    Sets PRAGMA statements to run on every connection opened to a database file.
+
+    Only applies to connections opened after the call, so it is meant to be called
+    before the database is first used.
+
+    Args:
+        db (str): Path of the database file.
+        pragmas (tuple): The PRAGMA statements, e.g. ("PRAGMA synchronous = OFF;",).
+    """
+    with _pools_lock:
+        _pragmas[db] = tuple(pragmas)
+
+
+def close_pool(db):
+    """
+    Closes the idle connections of one database file's pool and forgets the pool.
+
+    Args:
+        db (str): Path of the database file.
+    """
+    with _pools_lock:
+        pool = _pools.pop(db, None)
+        _pragmas.pop(db, None)
+
+    if pool is not None:
+        pool.close()
+
+
+def close_pools():
+    """
+    Closes the idle connections of every pool and forgets the pools.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -1,8 +1,6 @@
-from customer_menu import customer_menu, find_customer_by_name
-from book_menu import book_menu, find_book_by_title
-from loan_menu import loan_menu
-from sample_data import create_sample_data
-import unittest
+# The menu modules, and through them the models, are imported when their option is first picked,
+# so the main menu is shown without loading them. The unit tests and the sample data code are
+# only imported when they are run.
 
 
 def main_menu():
@@ -53,20 +51,30 @@ def menu_navigator():
     # Match the user's action to the corresponding functionality.
     match action:
         case '1':
+            from customer_menu import customer_menu
             customer_menu()
         case '2':
+            from book_menu import book_menu
             book_menu()
         case '3':
+            from loan_menu import loan_menu
             loan_menu()
         case '4':
+            from customer_menu import find_customer_by_name
             find_customer_by_name()
         case '5':
+            from book_menu import find_book_by_title
             find_book_by_title()
         case '6':
             # Run unit tests from the 'tester' module.
+            import unittest
             unittest.main(module='tester', exit=False)
         case '7':
+            from sample_data import create_sample_data
+            from search_index import catalogue
             create_sample_data()
+            # The sample rows are inserted directly, so the search index is rebuilt
+            catalogue.load()
         case '0':
             print('Goodbye!')
             exit(0)
@@ -0,0 +1,268 @@
+from datetime import date
+import events
+from helpers import transaction, query_all_shards
+from shards import all_shards
+
+
+# Circulation reporting with materialised aggregates.
+# The aggregate tables are updated inside the transaction of every loan that is opened or closed
+# through the models, so the dashboard reads a handful of small rows instead of scanning the loans.
+# rebuild() recomputes every aggregate from the loan history, e.g. after loans were written
+# without reporting enabled. A deleted loan is taken out of every aggregate, as it is no longer
+# in the history, so the maintained aggregates always match a rebuild.
+
+REPORT_TABLES = ("""
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT PRIMARY KEY,
+        loans_opened INTEGER NOT NULL DEFAULT 0,
+        loans_returned INTEGER NOT NULL DEFAULT 0,
+        returned_late INTEGER NOT NULL DEFAULT 0
+    );
+    """, """
+    CREATE TABLE IF NOT EXISTS stats_book_types (
+        type INTEGER PRIMARY KEY,
+        loans INTEGER NOT NULL DEFAULT 0,
+        open_loans INTEGER NOT NULL DEFAULT 0
+    );
+    """, """
+    CREATE TABLE IF NOT EXISTS stats_titles (
+        bookID INTEGER PRIMARY KEY,
+        loans INTEGER NOT NULL DEFAULT 0
+    );
+    """, """
+    CREATE TABLE IF NOT EXISTS stats_customers (
+        custID INTEGER PRIMARY KEY,
+        loans INTEGER NOT NULL DEFAULT 0
+    );
+    """, """
+    CREATE TABLE IF NOT EXISTS stats_totals (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        loans INTEGER NOT NULL DEFAULT 0,
+        open_loans INTEGER NOT NULL DEFAULT 0,
+        returned INTEGER NOT NULL DEFAULT 0,
+        returned_late INTEGER NOT NULL DEFAULT 0,
+        loan_days INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+                 "CREATE INDEX IF NOT EXISTS idx_stats_titles_loans ON stats_titles (loans);",
+                 "CREATE INDEX IF NOT EXISTS idx_stats_customers_loans ON stats_customers (loans);",
+                 "INSERT OR IGNORE INTO stats_totals (id) VALUES (1);")
+
+# Rebuilding every aggregate from the loan history, archived loans included
+# (and the books, for the book types)
+REBUILD_QUERIES = ("DELETE FROM stats_daily;",
+                   "DELETE FROM stats_book_types;",
+                   "DELETE FROM stats_titles;",
+                   "DELETE FROM stats_customers;",
+                   """
+    INSERT INTO stats_daily (day, loans_opened, loans_returned, returned_late)
+    SELECT day, SUM(opened), SUM(returned), SUM(late) FROM (
+        SELECT loandate AS day, 1 AS opened, 0 AS returned, 0 AS late FROM loans_history
+        UNION ALL
+        SELECT actual_returndate, 0, 1, actual_returndate > expected_returndate FROM loans_history WHERE is_open = 0
+    ) GROUP BY day;
+    """, """
+    INSERT INTO stats_book_types (type, loans, open_loans)
+    SELECT b.type, COUNT(*), SUM(l.is_open) FROM loans_history l JOIN books b ON b.id = l.bookID GROUP BY b.type;
+    """,
+                   "INSERT INTO stats_titles (bookID, loans) "
+                   "SELECT bookID, COUNT(*) FROM loans_history GROUP BY bookID;",
+                   "INSERT INTO stats_customers (custID, loans) "
+                   "SELECT custID, COUNT(*) FROM loans_history GROUP BY custID;",
+                   """
+    UPDATE stats_totals SET
+        loans = (SELECT COUNT(*) FROM loans_history),
+        open_loans = (SELECT COUNT(*) FROM loans WHERE is_open = 1),
+        returned = (SELECT COUNT(*) FROM loans_history WHERE is_open = 0),
+        returned_late = (SELECT COUNT(*) FROM loans_history
+                         WHERE is_open = 0 AND actual_returndate > expected_returndate),
+        loan_days = (SELECT COALESCE(SUM(CAST(julianday(actual_returndate) - julianday(loandate) AS INTEGER)), 0)
+                     FROM loans_history WHERE is_open = 0)
+    WHERE id = 1;
+    """)
+
+
+def create_report_tables():
+    """
+    Creates the aggregate tables in every branch database if they do not exist.
+    """
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            for query in REPORT_TABLES:
+                c.execute(query)
+
+
+def loan_opened(c, loan):
+    """
+    Adds a newly opened loan to the aggregates.
+
+    Args:
+        c (sqlite3.Cursor): Cursor of the loan's transaction.
+        loan (Loan): The opened loan.
+    """
+    c.execute("INSERT INTO stats_daily (day, loans_opened) VALUES (?, 1) "
+              "ON CONFLICT (day) DO UPDATE SET loans_opened = loans_opened + 1;", (str(loan.loan_date),))
+    c.execute("INSERT INTO stats_book_types (type, loans, open_loans) VALUES (?, 1, 1) "
+              "ON CONFLICT (type) DO UPDATE SET loans = loans + 1, open_loans = open_loans + 1;",
+              (loan.book.book_type,))
+    c.execute("INSERT INTO stats_titles (bookID, loans) VALUES (?, 1) "
+              "ON CONFLICT (bookID) DO UPDATE SET loans = loans + 1;", (loan.book.id,))
+    c.execute("INSERT INTO stats_customers (custID, loans) VALUES (?, 1) "
+              "ON CONFLICT (custID) DO UPDATE SET loans = loans + 1;", (loan.customer.id,))
+    c.execute("UPDATE stats_totals SET loans = loans + 1, open_loans = open_loans + 1 WHERE id = 1;")
+
+
+def loan_closed(c, loan, return_date):
+    """
+    Moves a closed loan from the open loans to the returned loans of the aggregates.
+
+    Args:
+        c (sqlite3.Cursor): Cursor of the loan's transaction.
+        loan (Loan): The closed loan.
+        return_date (date): The date the book was returned.
+    """
+    late = int(return_date > date.fromisoformat(str(loan.expected_return_date)))
+    loan_days = (return_date - date.fromisoformat(str(loan.loan_date))).days
+
+    c.execute("INSERT INTO stats_daily (day, loans_returned, returned_late) VALUES (?, 1, ?) "
+              "ON CONFLICT (day) DO UPDATE SET loans_returned = loans_returned + 1, "
+              "returned_late = returned_late + excluded.returned_late;", (str(return_date), late))
+    c.execute("UPDATE stats_book_types SET open_loans = open_loans - 1 WHERE type = ?;", (loan.book.book_type,))
+    c.execute("UPDATE stats_totals SET open_loans = open_loans - 1, returned = returned + 1, "
+              "returned_late = returned_late + ?, loan_days = loan_days + ? WHERE id = 1;", (late, loan_days))
+
+
+def loan_removed(c, loan):
+    """
+    Takes a deleted loan out of the aggregates, undoing its opening and, if returned, its return.
+
+    Args:
+        c (sqlite3.Cursor): Cursor of the loan's transaction.
+        loan (Loan): The deleted loan.
+    """
+    is_open = int(loan.is_open())
+    late = loan_days = 0
+
+    c.execute("UPDATE stats_daily SET loans_opened = loans_opened - 1 WHERE day = ?;", (str(loan.loan_date),))
+    if not is_open:
+        return_date = loan.actual_return_date
+        late = int(return_date > date.fromisoformat(str(loan.expected_return_date)))
+        loan_days = (return_date - date.fromisoformat(str(loan.loan_date))).days
+        c.execute("UPDATE stats_daily SET loans_returned = loans_returned - 1, returned_late = returned_late - ? "
+                  "WHERE day = ?;", (late, str(return_date)))
+    c.execute("UPDATE stats_book_types SET loans = loans - 1, open_loans = open_loans - ? WHERE type = ?;",
+              (is_open, loan.book.book_type))
+    c.execute("UPDATE stats_titles SET loans = loans - 1 WHERE bookID = ?;", (loan.book.id,))
+    c.execute("UPDATE stats_customers SET loans = loans - 1 WHERE custID = ?;", (loan.customer.id,))
+    c.execute("UPDATE stats_totals SET loans = loans - 1, open_loans = open_loans - ?, returned = returned - ?, "
+              "returned_late = returned_late - ?, loan_days = loan_days - ? WHERE id = 1;",
+              (is_open, 1 - is_open, late, loan_days))
+
+    # Rows left without loans are dropped, as a rebuild would not create them
+    c.execute("DELETE FROM stats_daily WHERE loans_opened = 0 AND loans_returned = 0 AND day IN (?, ?);",
+              (str(loan.loan_date), str(loan.actual_return_date)))
+    c.execute("DELETE FROM stats_book_types WHERE type = ? AND loans = 0;", (loan.book.book_type,))
+    c.execute("DELETE FROM stats_titles WHERE bookID = ? AND loans = 0;", (loan.book.id,))
+    c.execute("DELETE FROM stats_customers WHERE custID = ? AND loans = 0;", (loan.customer.id,))
+
+
+def on_loan_event(action, loan, cursor):
+    """
+    Keeps the aggregates up to date with the 'loans' change events.
+
+    Args:
+        action (str): 'insert', 'update', 'delete' or 'return'.
+        loan (Loan): The changed loan.
+        cursor (sqlite3.Cursor): Cursor of the change's transaction.
+    """
+    if action == 'insert':
+        loan_opened(cursor, loan)
+    elif action == 'return':
+        # The loan object is stamped once the return is committed, so the date is read from the row
+        cursor.execute("SELECT actual_returndate FROM loans WHERE id = ?;", (loan.id,))
+        loan_closed(cursor, loan, date.fromisoformat(cursor.fetchone()[0]))
+    elif action == 'delete':
+        loan_removed(cursor, loan)
+
+
+def enable_reporting(create_tables=True):
+    """
+    Creates the aggregate tables and starts maintaining them on every loan written through the models.
+
+    Args:
+        create_tables (bool, optional): False if the tables are known to exist (see migrations.ensure_schema).
+    """
+    if create_tables:
+        create_report_tables()
+    events.subscribe('loans', on_loan_event)
+
+
+def rebuild():
+    """
+    Recomputes every aggregate from scratch, in one transaction per branch database.
+    """
+    create_report_tables()
+
+    for db in all_shards():
+        with transaction(db, write=True) as c:
+            for query in REBUILD_QUERIES:
+                c.execute(query)
+
+
+def dashboard(top=5):
+    """
+    Reads the circulation dashboard from the aggregates of all branches.
+
+    Args:
+        top (int, optional): The number of top titles and busiest customers to list.
+
+    Returns:
+        dict: The circulation statistics.
+    """
+    totals = [0, 0, 0, 0, 0]
+    for row in query_all_shards(query="SELECT loans, open_loans, returned, returned_late, loan_days "
+                                      "FROM stats_totals WHERE id = 1;", result=True):
+        totals = [total + value for total, value in zip(totals, row)]
+    loans, open_loans, returned, returned_late, loan_days = totals
+
+    loans_per_type = {}
+    for book_type, type_loans in query_all_shards(query="SELECT type, loans FROM stats_book_types;", result=True):
+        loans_per_type[book_type] = loans_per_type.get(book_type, 0) + type_loans
+
+    # The top rows are read through the indexes on the counts of each branch
+    top_titles = query_all_shards(query="SELECT s.bookID, b.title, s.loans FROM stats_titles s "
+                                        "JOIN books b ON b.id = s.bookID ORDER BY s.loans DESC LIMIT ?;",
+                                  parameters=(top,), result=True)
+    busiest_customers = query_all_shards(query="SELECT s.custID, c.p_name, c.l_name, s.loans FROM stats_customers s "
+                                               "JOIN customers c ON c.id = s.custID ORDER BY s.loans DESC LIMIT ?;",
+                                         parameters=(top,), result=True)
+
+    return {'loans': loans,
+            'open_loans': open_loans,
+            'returned': returned,
+            'loans_per_book_type': loans_per_type,
+            'top_titles': sorted(top_titles, key=lambda row: row[-1], reverse=True)[:top],
+            'busiest_customers': sorted(busiest_customers, key=lambda row: row[-1], reverse=True)[:top],
+            'average_loan_days': round(loan_days / returned, 2) if returned else 0,
+            'overdue_rate': round(returned_late / returned, 4) if returned else 0,
+            'today': query_all_shards(query="SELECT * FROM stats_daily WHERE day = ?;",
+                                      parameters=(str(date.today()),), result=True)}
+
+
+def show_dashboard():
+    """
+    Prints the circulation dashboard.
+    """
+    stats = dashboard()
+
+    print(f"\n*** Circulation Dashboard ***\n"
+          f"Loans: {stats['loans']} (open: {stats['open_loans']}, returned: {stats['returned']})\n"
+          f"Loans per book type: {stats['loans_per_book_type']}\n"
+          f"Average loan length: {stats['average_loan_days']} days\n"
+          f"Overdue rate: {stats['overdue_rate']:.1%}")
+    print("Top titles:")
+    for row in stats['top_titles']:
+        print(f"    {row[1]} (ID: {row[0]}): {row[2]} loans")
+    print("Busiest customers:")
+    for row in stats['busiest_customers']:
+        print(f"    {row[1]} {row[2]} (ID: {row[0]}): {row[3]} loans")
@@ -0,0 +1,191 @@
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from config import RETRY_TIMEOUT, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+
+
+# Lock contention handling.
+# sqlite lets one connection write to a database file at a time, and reports 'database is
+# locked' to the others once its own short wait (BUSY_TIMEOUT) is over. Instead of waiting
+# longer inside sqlite, which sleeps on a fixed schedule so that contending desks keep waking
+# up together, the failed step is retried with an exponential backoff and random jitter, for
+# up to RETRY_TIMEOUT seconds in all, so a desk waits at least as long for a long writer
+# (an archive run, a bulk load, a backup step) as it did with sqlite's default timeout.
+#
+# Write transactions take the write lock when they begin (BEGIN IMMEDIATE), the only point
+# where they wait for it, so a transaction never fails half-way because another one is writing.
+# Inside a process, writers to the same database wait in a first-come, first-served queue
+# before trying for the lock, so they do not compete with each other, and readers are not
+# held up by the queue.
+#
+# The retries and waits are counted, see metrics().
+
+_metrics = {'retries': 0,          # Lock attempts repeated after a backoff
+            'failures': 0,         # Operations that failed after the last attempt
+            'retry_wait': 0.0,     # Seconds slept in backoffs
+            'writes': 0,           # Write transactions that went through the queue
+            'queue_wait': 0.0,     # Seconds writers waited in the queue
+            'max_queue_wait': 0.0}
+_metrics_lock = threading.Lock()
+
+_queues = {}                      # Database file -> WriteQueue
+_queues_lock = threading.Lock()
+
+
+def is_locked(error):
+    """
+    Checks if an error reports lock contention.
+
+    Args:
+        error (Exception): The error.
+
+    Returns:
+        bool: True for sqlite's 'database is locked' and 'database is busy' errors.
+    """
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+def backoff(attempt):
+    """
+    Returns the delay before the next attempt, picked at random up to an exponential bound.
+
+    Args:
+        attempt (int): The number of failed attempts so far, minus one.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _record(**amounts):
+    with _metrics_lock:
+        for name, amount in amounts.items():
+            if name.startswith('max_'):
+                _metrics[name] = max(_metrics[name], amount)
+            else:
+                _metrics[name] += amount
+
+
+def retry(operation, attempts=None, timeout=RETRY_TIMEOUT):
+    """
+    Calls an operation until it does not fail because of lock contention.
+
+    The operation must be safe to repeat, e.g. a statement that did not change anything
+    when it failed.
+
+    Args:
+        operation (callable): Called without arguments.
+        attempts (int, optional): The maximum number of calls. Defaults to no limit but the timeout.
+        timeout (float, optional): Seconds after the first call when no further attempt is made.
+
+    Returns:
+        The operation's result.
+
+    Raises:
+        sqlite3.OperationalError: If the last attempt is still locked out, or on any other database error.
+    """
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            return operation()
+        except sqlite3.OperationalError as e:
+            if not is_locked(e):
+                raise
+            left = deadline - time.monotonic()
+            attempt += 1
+            if attempt == attempts or left <= 0:
+                _record(failures=1)
+                raise
+
+            # The last backoff ends at the deadline
+            delay = min(backoff(attempt - 1), left)
+            _record(retries=1, retry_wait=delay)
+            time.sleep(delay)
+
+
+class WriteQueue:
+    """
+    First-come, first-served queue of the writers of one database file in this process.
+
+    A thread already holding the queue may enter it again, so a write made while another
+    write transaction of the same thread is open does not wait for itself.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._owner = None
+        self._depth = 0
+
+    @contextmanager
+    def turn(self):
+        """
+        Context manager waiting for the caller's turn to write, and holding it during the block.
+        """
+        me = threading.get_ident()
+        with self._condition:
+            if self._owner == me:
+                self._depth += 1
+            else:
+                ticket = self._next_ticket
+                self._next_ticket += 1
+                start = time.perf_counter()
+                while ticket != self._serving:
+                    self._condition.wait()
+                waited = time.perf_counter() - start
+                self._owner = me
+                self._depth = 1
+                _record(writes=1, queue_wait=waited, max_queue_wait=waited)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._owner = None
+                    self._serving += 1
+                    self._condition.notify_all()
+
+
+def write_queue(db):
+    """
+    Returns the write queue of a database file, creating it on first use.
+
+    Args:
+        db (str): Path of the database file.
+
+    Returns:
+        WriteQueue: The database's queue.
+    """
+    with _queues_lock:
+        if db not in _queues:
+            _queues[db] = WriteQueue()
+
+        return _queues[db]
+
+
+def metrics():
+    """
+    Returns the contention metrics of this process since the start (or the last reset).
+
+    Returns:
+        dict: 'retries', 'failures', 'retry_wait' (seconds), 'writes', 'queue_wait' (seconds)
+            and 'max_queue_wait' (seconds).
+    """
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+def reset_metrics():
+    """
+    Sets the contention metrics back to zero.
+    """
+    with _metrics_lock:
+        for name in _metrics:
+            _metrics[name] = type(_metrics[name])()
@@ -0,0 +1,105 @@
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Parallel test runner.
+# Splits the tests of a module across worker processes. Every test runs on its own temporary
+# database (see fixtures.IsolatedDatabase), so the tests do not interfere with each other.
+#
+# Usage: python run_tests.py [--workers N] [module ...]
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_names(modules):
+    """
+    Lists the tests of some modules.
+
+    Args:
+        modules (list): The test module names.
+
+    Returns:
+        list: Dotted test names, e.g. 'tester.MyTestCase.test_book'.
+    """
+    names = []
+    for suite in unittest.defaultTestLoader.loadTestsFromNames(modules):
+        for case in suite:
+            names.extend(test.id() for test in case)
+
+    return names
+
+
+def run_chunk(names):
+    """
+    Runs a chunk of tests in the current process.
+
+    Args:
+        names (list): Dotted test names.
+
+    Returns:
+        tuple: (tests run, failure reports, error reports, skipped tests), where each report
+            is a (test name, traceback) pair.
+    """
+    os.chdir(PROJECT_DIR)
+    suite = unittest.defaultTestLoader.loadTestsFromNames(names)
+    result = unittest.TextTestRunner(stream=io.StringIO(), verbosity=0).run(suite)
+
+    return (result.testsRun,
+            [(test.id(), traceback) for test, traceback in result.failures],
+            [(test.id(), traceback) for test, traceback in result.errors],
+            len(result.skipped))
+
+
+def run(modules=('tester',), workers=None):
+    """
+    Runs the tests of some modules across worker processes.
+
+    Args:
+        modules (tuple, optional): The test module names.
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        bool: True if every test passed.
+    """
+    names = test_names(list(modules))
+    workers = max(1, min(workers or os.cpu_count() or 1, len(names)))
+
+    # Dealing the tests out round-robin, so slow tests defined together end up in different workers
+    chunks = [names[i::workers] for i in range(workers)]
+
+    start = time.perf_counter()
+    # Spawning fresh interpreters, as forking would copy the parent's threads and open connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        results = list(executor.map(run_chunk, chunks))
+    elapsed = time.perf_counter() - start
+
+    tests_run = sum(result[0] for result in results)
+    failures = [report for result in results for report in result[1]]
+    errors = [report for result in results for report in result[2]]
+    skipped = sum(result[3] for result in results)
+
+    for kind, reports in (('FAIL', failures), ('ERROR', errors)):
+        for name, traceback in reports:
+            print(f"{'=' * 70}\n{kind}: {name}\n{'-' * 70}\n{traceback}")
+
+    print(f"Ran {tests_run} tests in {elapsed:.2f}s on {workers} workers"
+          f"{f' ({skipped} skipped)' if skipped else ''}")
+    print('OK' if not failures and not errors else f"FAILED (failures={len(failures)}, errors={len(errors)})")
+
+    return not failures and not errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the unit tests across worker processes.')
+    parser.add_argument('modules', nargs='*', default=['tester'], help='Test modules to run')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args()
+
+    sys.path.insert(0, PROJECT_DIR)
+    sys.exit(0 if run(args.modules, args.workers) else 1)
@@ -43,7 +43,7 @@ def create_sample_data():
         l.save()  # Save each loan to the database.
 
     # Executing additional queries to insert specific loan records.
-    query_db(query = "INSERT INTO loans (id, custID, bookID, loandate, expected_returndate, actual_returndate)"
-                     " VALUES (6, 123456789, 6, '2023-04-05', '2023-04-10', 'Not returned');")
-    query_db(query= "INSERT INTO loans (id, custID, bookID, loandate, expected_returndate, actual_returndate)"
-                     " VALUES (7, 123456789, 7, '2023-04-12', '2023-04-14', 'Not returned');")
+    query_db(query = "INSERT INTO loans (id, custID, bookID, loandate, expected_returndate, actual_returndate, is_open)"
+                     " VALUES (6, 123456789, 6, '2023-04-05', '2023-04-10', NULL, 1);")
+    query_db(query= "INSERT INTO loans (id, custID, bookID, loandate, expected_returndate, actual_returndate, is_open)"
+                     " VALUES (7, 123456789, 7, '2023-04-12', '2023-04-14', NULL, 1);")
@@ -0,0 +1,401 @@
+import gc
+import heapq
+import json
+import re
+import struct
+import threading
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+import events
+import snapshots
+from helpers import query_db, query_all_shards, search_books_by_title, auto_log
+from changefeed import pull, first_seq
+from shards import all_shards
+from config import SEARCH_INDEX_MAX_BOOKS, SEARCH_MIN_SCORE
+
+
+# In-memory catalogue index with trigram fuzzy matching.
+# Every title and author name is split into trigrams (three-letter sequences of each word,
+# padded as in "  emma "), and each trigram keeps the set of books it appears in (its postings).
+# A query only visits the postings of its own trigrams, and a book matches when most of the
+# query's trigrams appear in its title or author name, so small typos still find the book.
+#
+# The index is built once from the books table, and then kept up to date through the 'books'
+# change events. It holds at most SEARCH_INDEX_MAX_BOOKS books; past that limit searches fall
+# back to the database, so memory use stays bounded however large the catalogue grows.
+# The whole index is kept in the 'search' section of the startup snapshot (see snapshots.py):
+#   header  - magic, JSON length, and the length of each array (SECTION_HEADER)
+#   JSON    - the completeness flag, the book records, their normalized titles and authors,
+#             and the trigram vocabulary
+#   arrays  - unsigned 32-bit integers, 4-byte aligned: the end offset of every trigram's
+#             postings, the postings (positions in the book list), the end offsets of every
+#             book's title and author trigrams, and those trigrams (positions in the vocabulary)
+# Restoring reads the arrays straight from the mapped file and rebuilds the postings and the
+# trigram sets from them, without normalizing or splitting any text again.
+
+
+SECTION_MAGIC = b'TRG1'
+SECTION_HEADER = struct.Struct('<4s5I')  # Magic, JSON length, then the length of each of the 4 arrays
+
+
+@contextmanager
+def paused_gc():
+    """
+    Pauses the cyclic garbage collector while the index is built in bulk.
+
+    Building the index creates millions of sets and tuples, none of them garbage, and each
+    batch of them would otherwise make the collector scan every object created so far.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def normalize(text):
+    """
+    Lowercases a text and replaces everything but letters and digits with single spaces.
+
+    Args:
+        text (str): The text to normalize.
+
+    Returns:
+        str: The normalized text.
+    """
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', str(text).lower()).split())
+
+
+def trigrams(text):
+    """
+    Splits a text into the trigrams of its words.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        frozenset: The trigrams of the normalized text.
+    """
+    grams = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return frozenset(grams)
+
+
+class CatalogueIndex:
+    """
+    Answers fuzzy title and author searches from memory.
+
+    Books are kept as their database records, with the trigrams and the normalized text of
+    their title and of their author's full name. The postings map every trigram to the IDs of
+    the books that contain it.
+    """
+
+    def __init__(self, max_books=SEARCH_INDEX_MAX_BOOKS):
+        self.max_books = max_books
+        self.complete = False  # False until loaded, or once the catalogue outgrows max_books
+        self._books = {}       # Book ID -> (record, title trigrams, author trigrams, normalized title, normalized author)
+        self._postings = {}    # Trigram -> set of book IDs
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._books)
+
+    def load(self):
+        """
+        Builds the index from the books of all branches, reading at most max_books of them.
+        """
+        # One book past the limit tells whether the catalogue is larger than the index
+        rows = []
+        for db in all_shards():
+            rows += query_db(query="SELECT * FROM books LIMIT ?;", parameters=(self.max_books + 1 - len(rows),),
+                             db=db, result=True)
+            if len(rows) > self.max_books:
+                break
+        self._rebuild(rows)
+
+    def _rebuild(self, rows):
+        with self._lock, paused_gc():
+            self._books = {}
+            self._postings = {}
+            self.complete = len(rows) <= self.max_books
+            for row in rows[:self.max_books]:
+                self._add(row)
+
+    def _add(self, record):
+        # Replacing any previous version of the book, then posting its trigrams
+        book_id = str(record[0])
+        self._remove(book_id)
+
+        title = normalize(record[1])
+        author = normalize(f"{record[2]} {record[3]}")
+        title_grams = trigrams(title)
+        author_grams = trigrams(author)
+        self._books[book_id] = (tuple(record), title_grams, author_grams, title, author)
+
+        for gram in title_grams | author_grams:
+            self._postings.setdefault(gram, set()).add(book_id)
+
+    def _remove(self, book_id):
+        entry = self._books.pop(book_id, None)
+        if entry is None:
+            return
+
+        for gram in entry[1] | entry[2]:
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(book_id)
+                if not postings:
+                    del self._postings[gram]
+
+    def add(self, record):
+        """
+        Adds a book to the index, or re-indexes it if it is already there.
+
+        Args:
+            record (tuple): The book's database record.
+        """
+        with self._lock:
+            if str(record[0]) not in self._books and len(self._books) >= self.max_books:
+                # The index no longer covers the whole catalogue
+                self.complete = False
+                return
+            self._add(record)
+
+    def remove(self, book_id):
+        """
+        Removes a book from the index.
+
+        Args:
+            book_id (str): The book ID.
+        """
+        with self._lock:
+            self._remove(str(book_id))
+
+    def search(self, text, limit=10, min_score=SEARCH_MIN_SCORE):
+        """
+        Finds the books whose title or author name best match a text.
+
+        A book's score is the share of the query's trigrams found in its title or in its
+        author's name (whichever is higher), and 1.0 if the query appears in it as is.
+
+        Args:
+            text (str): The search text.
+            limit (int, optional): The maximum number of results.
+            min_score (float, optional): The lowest score (0-1) of a returned book.
+
+        Returns:
+            list: (book record, score) pairs, best match first.
+        """
+        query = normalize(text)
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        needed = min_score * len(query_grams)
+        with self._lock:
+            # Counting the shared trigrams of every book in the query's postings, and taking the
+            # entries of the candidates; the entries are never changed, only replaced, so they
+            # are scored once the lock is released
+            hits = Counter()
+            for gram in query_grams:
+                hits.update(self._postings.get(gram, ()))
+            candidates = [self._books[book_id] for book_id, count in hits.items() if count >= needed]
+
+        results = []
+        for record, title_grams, author_grams, title, author in candidates:
+            score = max(len(query_grams & title_grams), len(query_grams & author_grams)) / len(query_grams)
+            if query in title or query in author:
+                score = 1.0
+            if score >= min_score:
+                results.append((record, round(score, 3)))
+
+        # Only the best `limit` results are ordered
+        return heapq.nsmallest(limit, results, key=lambda result: (-result[1], str(result[0][1])))
+
+    def on_book_event(self, action, book, cursor):
+        """
+        Keeps the index up to date with the 'books' change events.
+
+        Args:
+            action (str): 'insert', 'update' or 'delete'.
+            book (Book): The changed book.
+            cursor (sqlite3.Cursor): Cursor of the change's transaction (unused).
+        """
+        if action == 'delete':
+            self.remove(book.id)
+        else:
+            self.add(book.obj_to_values())
+
+    def dump(self):
+        """
+        Dumps the whole index for the snapshot, in the layout described at the top of the module.
+
+        Returns:
+            bytes: The 'search' section.
+        """
+        with self._lock:
+            entries = list(self._books.values())
+            vocabulary = list(self._postings)
+            positions = {book_id: i for i, book_id in enumerate(self._books)}
+            posting_ends, postings = array('I'), array('I')
+            for gram in vocabulary:
+                postings.extend(map(positions.__getitem__, self._postings[gram]))
+                posting_ends.append(len(postings))
+            complete = self.complete
+
+        gram_positions = {gram: i for i, gram in enumerate(vocabulary)}
+        gram_ends, grams = array('I'), array('I')
+        for entry in entries:
+            for book_grams in entry[1:3]:
+                grams.extend(map(gram_positions.__getitem__, book_grams))
+                gram_ends.append(len(grams))
+
+        text = json.dumps({'complete': complete, 'books': [entry[0] for entry in entries],
+                           'titles': [entry[3] for entry in entries], 'authors': [entry[4] for entry in entries],
+                           'grams': vocabulary}).encode()
+        text += b' ' * (-len(text) % 4)  # Aligning the arrays
+        arrays = (posting_ends, postings, gram_ends, grams)
+
+        return b''.join((SECTION_HEADER.pack(SECTION_MAGIC, len(text), *map(len, arrays)), text,
+                         *(values.tobytes() for values in arrays)))
+
+    def _load(self, data):
+        # Restoring the index from a 'search' section; False if it is of another format or too large
+        if len(data) < SECTION_HEADER.size:
+            return False
+        magic, text_length, *lengths = SECTION_HEADER.unpack_from(data)
+        if magic != SECTION_MAGIC:
+            return False
+
+        with paused_gc():
+            return self._load_arrays(data, SECTION_HEADER.size + text_length, lengths)
+
+    def _load_arrays(self, data, start, lengths):
+        meta = json.loads(bytes(data[SECTION_HEADER.size:start]))
+        if len(meta['books']) > self.max_books:
+            return False
+
+        posting_ends, postings, gram_ends, grams = arrays = [array('I') for _ in lengths]
+        for values, length in zip(arrays, lengths):
+            values.frombytes(data[start:start + length * values.itemsize])
+            start += length * values.itemsize
+
+        records = [tuple(record) for record in meta['books']]
+        book_ids = [str(record[0]) for record in records]
+        vocabulary = meta['grams']
+
+        index = {}
+        begin = 0
+        for gram, end in zip(vocabulary, posting_ends):
+            index[gram] = set(map(book_ids.__getitem__, postings[begin:end]))
+            begin = end
+
+        books = {}
+        begin = 0
+        for i, (book_id, record, title, author) in enumerate(zip(book_ids, records, meta['titles'], meta['authors'])):
+            middle, end = gram_ends[2 * i], gram_ends[2 * i + 1]
+            books[book_id] = (record, frozenset(map(vocabulary.__getitem__, grams[begin:middle])),
+                              frozenset(map(vocabulary.__getitem__, grams[middle:end])), title, author)
+            begin = end
+
+        with self._lock:
+            self._books = books
+            self._postings = index
+            self.complete = meta['complete']
+
+        return True
+
+    def restore(self, snapshot):
+        """
+        Rebuilds the index from a snapshot, then replays the book changes recorded since.
+
+        The changes are read from the change feed, after the position the snapshot recorded
+        for every database. If some of those changes were pruned from the feed since, or the
+        index then does not hold as many books as the databases (e.g. books were bulk-loaded
+        without the models), the snapshot is not used.
+
+        Args:
+            snapshot (snapshots.Snapshot): The opened snapshot.
+
+        Returns:
+            bool: True if the index was restored, False if the snapshot is missing or can not be
+                brought up to date.
+        """
+        data = snapshot.section('search')
+        if data is None:
+            return False
+
+        current = snapshot.is_current()
+        if not current and not (snapshot.same_schema() and snapshot.changes.keys() == set(all_shards())):
+            return False
+        # The snapshot's feed positions are no checkpoints, so a prune may have deleted the changes made since
+        if not current and any(first_seq(db) > seq + 1 for db, seq in snapshot.changes.items()):
+            return False
+
+        if not self._load(data):
+            return False
+        if current:
+            return True
+
+        replayed = 0
+        for db, seq in snapshot.changes.items():
+            while changes := pull(after=seq, tables=('books',), db=db):
+                for change in changes:
+                    if change['action'] == 'delete':
+                        self.remove(change['id'])
+                    else:
+                        self.add(tuple(change['data'].values()))
+                seq = changes[-1]['seq']
+                replayed += len(changes)
+
+        rows = query_all_shards(query="SELECT COUNT(*) FROM books;", result=True)
+        if not self.complete or len(self) != sum(row[0] for row in rows):
+            return False
+
+        auto_log('Search index restored', log_id=f"{replayed} changes replayed")
+
+        return True
+
+
+def search_books(text, limit=10):
+    """
+    Finds books by title or author, tolerating typos.
+
+    Uses the catalogue index when it covers every book, and the database otherwise.
+
+    Args:
+        text (str): The search text.
+        limit (int, optional): The maximum number of results.
+
+    Returns:
+        list: The matching book records, best match first.
+    """
+    if catalogue.complete:
+        return [record for record, score in catalogue.search(text, limit=limit)]
+
+    return search_books_by_title(text)[:limit]
+
+
+def enable_search(snapshot=None):
+    """
+    Loads the catalogue index (from the snapshot if it is current) and keeps it up to date.
+
+    Args:
+        snapshot (snapshots.Snapshot, optional): The startup snapshot.
+    """
+    if snapshot is None or not catalogue.restore(snapshot):
+        catalogue.load()
+        auto_log('Search index built', log_id=f"{len(catalogue)} books")
+
+    events.subscribe('books', catalogue.on_book_event)
+
+
+# The catalogue index of this process
+catalogue = CatalogueIndex()
+snapshots.register('search', catalogue.dump)
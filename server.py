@@ -0,0 +1,415 @@
+import hashlib
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from books import Book
+from customers import Customer
+from loans import Loan
+from helpers import get_by_id, is_available, availability_for, check_id, check_loans, \
+    search_customers_by_name, query_all_shards, change_counter, auto_log
+from shards import all_shards
+from reports import enable_reporting, dashboard
+from holds import enable_holds, check_reserved
+from changefeed import enable_changefeed
+from customer_index import enable_customer_index, check_borrow_limit
+from audit import enable_audit
+from search_index import enable_search, search_books
+from migrations import ensure_schema
+from config import BOOKS_FIELDNAMES, CUSTOMERS_FIELDNAMES, LOAN_FIELDNAMES, SERVER_HOST, SERVER_PORT, \
+    MAX_BATCH_SIZE
+from errors import InvalidEntry, InvalidAge, InvalidPublicationYear, InvalidDate, IdNotExist, IdAlreadyExists, \
+    BookNotAvailable, LoanAlreadyReturned, BorrowLimitReached
+
+
+# Local HTTP/JSON service over the Book, Customer and Loan models.
+#
+# Endpoints:
+#   GET    /books, /customers, /loans          - Listings (conditional GET with ETag / If-None-Match)
+#   GET    /books?q=...&limit=...              - Fuzzy title / author search, best match first
+#   GET    /customers?q=...                    - Name search
+#   GET    /<table>/<id>                       - A single record
+#   POST   /books, /customers, /loans          - Create a record from a JSON body
+#   POST   /<table>/lookup  {"ids": [...]}     - Batch lookup of many records in one call
+#   POST   /books/availability {"ids": [...]}  - Batch availability check of many books in one call
+#   POST   /loans/<id>/return                  - Return a loan (optional JSON body {"date": "YYYY-MM-DD"})
+#   DELETE /<table>/<id>                       - Delete a record
+#   GET    /reports/dashboard                  - Circulation statistics
+#
+# The server speaks HTTP/1.1, so clients can keep connections alive between requests, and all
+# database work goes through query_db's pooled connections.
+
+FIELDNAMES = {'books': BOOKS_FIELDNAMES.split(', '),
+              'customers': CUSTOMERS_FIELDNAMES.split(', '),
+              'loans': LOAN_FIELDNAMES.split(', ')}
+
+# Exceptions mapped to the HTTP status they are reported with. Malformed requests are raised as
+# InvalidEntry where they are parsed; any other exception is a server error (500), and is logged.
+ERROR_STATUS = ((IdNotExist, 404),
+                ((IdAlreadyExists, BookNotAvailable, LoanAlreadyReturned, BorrowLimitReached, AssertionError), 409),
+                ((InvalidEntry, InvalidAge, InvalidPublicationYear, InvalidDate), 400))
+
+
+def row_to_dict(table, row):
+    """
+    Converts a database record to a JSON-ready dictionary.
+
+    Args:
+        table (str): The table the record comes from.
+        row (tuple): The database record.
+
+    Returns:
+        dict: Field name -> value.
+    """
+    return dict(zip(FIELDNAMES[table], row))
+
+
+def row_to_object(table, row):
+    """
+    Creates a model object from a database record.
+
+    Args:
+        table (str): The table the record comes from.
+        row (tuple): The database record.
+
+    Returns:
+        DataBaseHandler: The Book, Customer or Loan object.
+    """
+    if table == 'books':
+        return Book(title=row[1], author_pname=row[2], author_lname=row[3], year_published=row[4],
+                    book_type=row[5], id_=row[0], override_id=True)
+    if table == 'customers':
+        return Customer(id_=row[0], p_name=row[1], l_name=row[2], city=row[3], age=row[4])
+
+    return Loan(customer_id=row[1], book_id=row[2], loan_date=row[3], expected_return_date=row[4],
+                actual_return_date=row[5], loan_id=row[0], override_id=True)
+
+
+def listing_etag(table):
+    """
+    Computes the ETag of a table listing from the change counters of the database files.
+
+    The counters change on every committed write, so the ETag is invalidated by any change
+    without having to read the table.
+
+    Args:
+        table (str): The listed table.
+
+    Returns:
+        str: The quoted ETag.
+    """
+    counters = ','.join(str(change_counter(db)) for db in all_shards())
+
+    return '"' + hashlib.sha1(f'{table}:{counters}'.encode()).hexdigest() + '"'
+
+
+def fetch_many(table, ids):
+    """
+    Fetches many records by ID with one query per chunk of IDs.
+
+    Args:
+        table (str): The table to fetch from.
+        ids (list): The record IDs.
+
+    Returns:
+        dict: ID (as a string) -> record, for the IDs that exist.
+    """
+    found = {}
+
+    # Staying well below sqlite's limit on the number of query parameters
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ', '.join('?' for _ in chunk)
+        query = f"SELECT * FROM {table} WHERE id IN ({placeholders});"
+        for row in query_all_shards(query=query, parameters=tuple(chunk), result=True):
+            found[str(row[0])] = row
+
+    return found
+
+
+def require(data, field):
+    """
+    Reads a required field of a request body.
+
+    Args:
+        data (dict): The decoded JSON body.
+        field (str): The field name.
+
+    Returns:
+        The field's value.
+
+    Raises:
+        InvalidEntry: If the field is missing.
+    """
+    if field not in data:
+        raise InvalidEntry(f"Missing field: {field}")
+
+    return data[field]
+
+
+def require_ids(data):
+    """
+    Reads the 'ids' list of a batch request body.
+
+    Args:
+        data (dict): The decoded JSON body.
+
+    Returns:
+        list: The IDs, as strings.
+
+    Raises:
+        InvalidEntry: If the IDs are missing, not a list, or more than MAX_BATCH_SIZE.
+    """
+    ids = require(data, 'ids')
+    if not isinstance(ids, list):
+        raise InvalidEntry("'ids' must be a list")
+    if len(ids) > MAX_BATCH_SIZE:
+        raise InvalidEntry(f"A batch may contain up to {MAX_BATCH_SIZE} IDs")
+
+    return [str(id_) for id_ in ids]
+
+
+def error_message(e):
+    """
+    Builds a readable message from an exception, including the message it was raised with.
+
+    Args:
+        e (Exception): The exception.
+
+    Returns:
+        str: The error message.
+    """
+    message = str(e)
+    if e.args and str(e.args[0]) not in message:
+        message = f"{message}{e.args[0]}"
+
+    return message
+
+
+class LibraryRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP requests of the library service.
+
+    Every request is dispatched to a route method returning a (status, payload, headers) tuple.
+    Exceptions raised by the models are reported as JSON errors with a matching status.
+    """
+
+    protocol_version = 'HTTP/1.1'  # Keeps client connections alive between requests
+
+    def do_GET(self):
+        self.dispatch(self.route_get)
+
+    def do_POST(self):
+        self.dispatch(self.route_post)
+
+    def do_DELETE(self):
+        self.dispatch(self.route_delete)
+
+    def dispatch(self, route):
+        """
+        Runs a route method and sends its result, or the error it raised.
+
+        Args:
+            route (callable): The route method to run.
+        """
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+
+        try:
+            status, payload, headers = route(parts, query)
+        except Exception as e:
+            for error_types, error_status in ERROR_STATUS:
+                if isinstance(e, error_types):
+                    status = error_status
+                    break
+            else:
+                status = 500
+                auto_log("Server error", e, error=True)
+            payload, headers = {'error': error_message(e)}, {}
+
+        self.send_json(status, payload, headers)
+
+    def send_json(self, status, payload, headers):
+        """
+        Sends a JSON response.
+
+        Args:
+            status (int): The HTTP status.
+            payload: JSON-serialisable response body, or None for an empty body.
+            headers (dict): Additional response headers.
+        """
+        body = b'' if payload is None else json.dumps(payload).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if body:
+            self.wfile.write(body)
+
+    def read_json(self):
+        """
+        Reads the JSON body of the request.
+
+        Returns:
+            dict: The decoded body (empty if the request has no body).
+
+        Raises:
+            InvalidEntry: If the body is not a JSON object.
+        """
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length)) if length else {}
+        except ValueError:
+            raise InvalidEntry("The request body is not valid JSON") from None
+
+        if not isinstance(data, dict):
+            raise InvalidEntry("The request body must be a JSON object")
+
+        return data
+
+    def route_get(self, parts, query):
+        if len(parts) == 1 and parts[0] in FIELDNAMES:
+            table = parts[0]
+            etag = listing_etag(table)
+
+            # Conditional GET - the client's copy is still current
+            if self.headers.get('If-None-Match') == etag:
+                return 304, None, {'ETag': etag}
+
+            keyword = query.get('q', [None])[0]
+            if keyword is not None and table == 'books':
+                limit = query.get('limit', ['10'])[0]
+                if not limit.isdigit():
+                    raise InvalidEntry("'limit' must be a number")
+                rows = search_books(keyword, limit=int(limit))
+            elif keyword is not None and table == 'customers':
+                rows = search_customers_by_name(keyword)
+            else:
+                rows = query_all_shards(query=f"SELECT * FROM {table};", result=True)
+
+            return 200, [row_to_dict(table, row) for row in rows], {'ETag': etag}
+
+        if len(parts) == 2 and parts[0] in FIELDNAMES:
+            return 200, row_to_dict(parts[0], get_by_id(parts[1], parts[0])), {}
+
+        if parts == ['reports', 'dashboard']:
+            return 200, dashboard(), {}
+
+        return 404, {'error': 'Unknown endpoint'}, {}
+
+    def route_post(self, parts, query):
+        data = self.read_json()
+
+        if len(parts) == 2 and parts[0] in FIELDNAMES and parts[1] in ('lookup', 'availability'):
+            ids = require_ids(data)
+
+            if parts[1] == 'lookup':
+                found = fetch_many(parts[0], ids)
+                return 200, {'found': {id_: row_to_dict(parts[0], row) for id_, row in found.items()},
+                             'missing': [id_ for id_ in ids if id_ not in found]}, {}
+
+            if parts[0] == 'books':
+                return 200, {'availability': availability_for(ids)}, {}
+
+        if len(parts) == 3 and parts[0] == 'loans' and parts[2] == 'return':
+            l = row_to_object('loans', get_by_id(parts[1], 'loans'))
+            l.return_book(data.get('date'))
+            auto_log('Loan returned', log_id=l.id)
+            return 200, row_to_dict('loans', l.obj_to_values()), {}
+
+        if parts == ['books']:
+            b = Book(title=require(data, 'title'), author_pname=require(data, 'author_pname'),
+                     author_lname=require(data, 'author_lname'), year_published=require(data, 'publication_year'),
+                     book_type=require(data, 'type'))
+            b.save()
+            auto_log('Book added', log_id=b.id)
+            return 201, row_to_dict('books', b.obj_to_values()), {}
+
+        if parts == ['customers']:
+            check_id(table='customers', object_id=require(data, 'id'))
+            c = Customer(id_=data['id'], p_name=require(data, 'p_name'), l_name=require(data, 'l_name'),
+                         city=require(data, 'city'), age=require(data, 'age'))
+            c.save()
+            auto_log('Customer added', log_id=c.id)
+            return 201, row_to_dict('customers', c.obj_to_values()), {}
+
+        if parts == ['loans']:
+            customer_id, book_id = require(data, 'custID'), require(data, 'bookID')
+            check_borrow_limit(customer_id)
+            is_available(book_id)
+            check_reserved(book_id, customer_id)
+            l = Loan(customer_id=customer_id, book_id=book_id)
+            l.save()
+            auto_log('New loan added', log_id=l.id)
+            return 201, row_to_dict('loans', l.obj_to_values()), {}
+
+        return 404, {'error': 'Unknown endpoint'}, {}
+
+    def route_delete(self, parts, query):
+        if len(parts) == 2 and parts[0] in FIELDNAMES:
+            obj = row_to_object(parts[0], get_by_id(parts[1], parts[0]))
+
+            # Customers and books with open loans can not be deleted
+            if parts[0] != 'loans':
+                check_loans(obj)
+
+            obj.delete()
+            auto_log(f'{obj.__class__.__name__} deleted', log_id=obj.id)
+            return 200, {'deleted': str(obj.id)}, {}
+
+        return 404, {'error': 'Unknown endpoint'}, {}
+
+    def log_message(self, format, *args):
+        # Writing the access log to the library's logger instead of stderr
+        auto_log('Request', format % args)
+
+
+def make_server(host=SERVER_HOST, port=SERVER_PORT):
+    """
+    Creates the library HTTP server. Each connection is served on its own thread.
+
+    Args:
+        host (str, optional): Address to listen on.
+        port (int, optional): Port to listen on (0 picks a free port).
+
+    Returns:
+        ThreadingHTTPServer: The server, ready to serve_forever().
+    """
+    server = ThreadingHTTPServer((host, port), LibraryRequestHandler)
+    server.daemon_threads = True
+
+    return server
+
+
+def run(host=SERVER_HOST, port=SERVER_PORT):
+    """
+    Creates the tables if needed and serves the library API until interrupted.
+
+    Args:
+        host (str, optional): Address to listen on.
+        port (int, optional): Port to listen on.
+    """
+    created = ensure_schema()
+    enable_reporting(create_tables=created)
+    enable_holds(create_tables=created)
+    enable_changefeed(create_tables=created)
+    enable_customer_index(create_tables=created)
+    enable_audit()
+    enable_search()
+
+    server = make_server(host, port)
+    print(f"Serving the library API on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    run()
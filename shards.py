@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+from config import BRANCH_DATABASES, DEFAULT_BRANCH
+
+
+# Routing layer for multi-branch deployments.
+# Each branch key is mapped to its own database file (see BRANCH_DATABASES in config.py),
+# so every branch only writes to, and locks, its own file.
+
+
+def get_shard(branch=None):
+    """
+    Returns the database file that holds the rows of a given branch.
+
+    Args:
+        branch (str, optional): The branch key. Defaults to the default branch.
+
+    Returns:
+        str: Path of the branch's database file.
+
+    Raises:
+        KeyError: If the branch key is not configured.
+    """
+    if branch is None:
+        branch = DEFAULT_BRANCH
+
+    if branch not in BRANCH_DATABASES:
+        raise KeyError(f"Unknown branch: {branch}")
+
+    return BRANCH_DATABASES[branch]
+
+
+def all_shards():
+    """
+    Returns every configured database file, without duplicates.
+
+    Several branches may share a file, so the list is deduplicated while keeping the
+    configuration order (the default branch's file comes first).
+
+    Returns:
+        list: Paths of all database files.
+    """
+    shards = [get_shard()]
+
+    for db in BRANCH_DATABASES.values():
+        if db not in shards:
+            shards.append(db)
+
+    return shards
+
+
+def add_branch(branch, db):
+    """
+    Registers a new branch and its database file at runtime.
+
+    Args:
+        branch (str): The branch key.
+        db (str): Path of the branch's database file.
+    """
+    BRANCH_DATABASES[branch] = db
+
+
+def branches():
+    """
+    Returns the configured branch keys.
+
+    Returns:
+        list: All branch keys.
+    """
+    return list(BRANCH_DATABASES.keys())
+
+
+@contextmanager
+def use_databases(databases):
+    """
+    Points the branches at other database files for the duration of a block.
+
+    Every query that is routed through the branches, including query_db without an explicit
+    database, uses the given files inside the block. The tests use it to run against a
+    temporary database instead of the library's.
+
+    Args:
+        databases (dict): Branch key -> database file path. Must include the default branch.
+
+    Yields:
+        dict: The branch mapping in use.
+    """
+    if DEFAULT_BRANCH not in databases:
+        raise KeyError(f"The default branch '{DEFAULT_BRANCH}' needs a database")
+
+    previous = dict(BRANCH_DATABASES)
+    BRANCH_DATABASES.clear()
+    BRANCH_DATABASES.update(databases)
+    try:
+        yield BRANCH_DATABASES
+    finally:
+        BRANCH_DATABASES.clear()
+        BRANCH_DATABASES.update(previous)
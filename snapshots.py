@@ -0,0 +1,200 @@
+import json
+import mmap
+import os
+import struct
+from helpers import query_all_shards, change_counter, schema_state, auto_log
+from shards import all_shards
+from changefeed import last_seq
+from config import SNAPSHOT_FILE
+
+
+# Snapshots of the derived data structures kept in memory (search index, open loans).
+# Instead of rebuilding every structure from a full scan at startup, the structures are dumped
+# into one snapshot file on exit, and restored from it on the next start.
+#
+# File layout:
+#   header   - magic, format version, length of the metadata (see HEADER)
+#   metadata - JSON: the state of every database file when the snapshot was written (its change
+#              counter and schema version), the highest ID of every table, the position of every
+#              database's change feed, and the offset and length of every section
+#   sections - the bytes dumped by each structure, one after the other
+#
+# The file is memory-mapped, so reading a section only touches the pages it is stored in.
+# A structure restored from a snapshot checks the recorded state against the databases:
+# the change counters show whether anything was written since, and the ID counters and the
+# change feed positions show which rows were added or changed since, so only those need to be
+# replayed.
+
+MAGIC = b'LIBSNAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII')  # Magic, format version, metadata length
+
+_dumpers = {}  # Section name -> callable returning the section's bytes
+
+
+def register(name, dump):
+    """
+    Registers a structure whose data is written to the snapshot.
+
+    Args:
+        name (str): The section name.
+        dump (callable): Called without arguments, returns the section's bytes.
+    """
+    _dumpers[name] = dump
+
+
+def database_state():
+    """
+    Reads the current state of every branch database file.
+
+    sqlite's 'PRAGMA data_version' only reports changes made by other connections of the
+    same process, so the file change counter is used, which every committed write increments.
+    Both values are read from the file header, without opening a connection.
+
+    Returns:
+        dict: Database path -> [change counter, schema version].
+    """
+    return {db: [change_counter(db), schema_state(db)[1]] for db in all_shards()}
+
+
+def id_counters():
+    """
+    Reads the highest ID of the tables whose derived structures replay new rows.
+
+    Returns:
+        dict: Table name -> highest ID across all branches (0 if the table is empty).
+    """
+    counters = {}
+    for table in ('books', 'loans'):
+        rows = query_all_shards(query=f"SELECT MAX(id) FROM {table};", result=True)
+        counters[table] = max((int(row[0]) for row in rows if row[0] is not None), default=0)
+
+    return counters
+
+
+def write_snapshot(path=SNAPSHOT_FILE):
+    """
+    Writes the data of every registered structure to a snapshot file.
+
+    Args:
+        path (str, optional): Path of the snapshot file.
+    """
+    state = database_state()
+    ids = id_counters()
+    changes = {db: last_seq(db) for db in all_shards()}
+
+    sections = {}
+    data = []
+    offset = 0
+    for name, dump in _dumpers.items():
+        section = dump()
+        sections[name] = [offset, len(section)]
+        data.append(section)
+        offset += len(section)
+
+    metadata = json.dumps({'state': state, 'ids': ids, 'changes': changes, 'sections': sections}).encode()
+
+    # Writing to a temporary file first, so a crash never leaves a half-written snapshot
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(metadata)))
+        f.write(metadata)
+        for section in data:
+            f.write(section)
+    os.replace(f"{path}.tmp", path)
+
+    auto_log('Snapshot written', log_id=', '.join(sections))
+
+
+class Snapshot:
+    """
+    A snapshot file opened for reading.
+
+    A missing, unreadable or older-format file opens as an empty snapshot, which holds no
+    sections, so every structure falls back to its full load.
+
+    Use as a context manager, so the memory map is closed once the structures are restored.
+    """
+
+    def __init__(self, path=SNAPSHOT_FILE):
+        self.state = {}
+        self.ids = {}
+        self.changes = {}  # Database path -> last change feed sequence number
+        self._sections = {}
+        self._data_start = 0
+        self._file = None
+        self._map = None
+
+        try:
+            self._file = open(path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, metadata_length = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported snapshot format: {version}")
+
+            metadata = json.loads(self._map[HEADER.size:HEADER.size + metadata_length])
+        except (OSError, ValueError, struct.error) as e:
+            auto_log('Snapshot not loaded', e)
+            self.close()
+            return
+
+        self.state = metadata['state']
+        self.ids = metadata['ids']
+        self.changes = metadata.get('changes', {})
+        self._sections = metadata['sections']
+        self._data_start = HEADER.size + metadata_length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Closes the memory map and the file.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def section(self, name):
+        """
+        Reads a section of the snapshot.
+
+        Args:
+            name (str): The section name.
+
+        Returns:
+            bytes: The section's bytes, or None if the snapshot does not hold it.
+        """
+        if name not in self._sections or self._map is None:
+            return None
+
+        offset, length = self._sections[name]
+        start = self._data_start + offset
+
+        return self._map[start:start + length]
+
+    def is_current(self):
+        """
+        Checks that no database was written to since the snapshot was taken.
+
+        Returns:
+            bool: True if the change counters and schema versions are unchanged.
+        """
+        return bool(self.state) and self.state == database_state()
+
+    def same_schema(self):
+        """
+        Checks that the schema of every database is the one the snapshot was taken with.
+
+        Returns:
+            bool: True if the schema versions are unchanged.
+        """
+        current = database_state()
+
+        return bool(self.state) and self.state.keys() == current.keys() and \
+            all(self.state[db][1] == current[db][1] for db in current)
@@ -1,8 +1,48 @@
+import asyncio
+import http.client
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from datetime import date, datetime, timedelta
+import async_db
+import events
+import server
+from overdue import OverdueTracker, create_notifications_table, tracker
+import holds
+import reports
+from archive import archive_loans, loan_history
+import snapshots
+from search_index import CatalogueIndex, catalogue
+from fees import create_fees_tables, calculate_fees, customer_balance
+from migrations import migrate, migrate_all_shards, create_tables, ensure_schema, get_version, LATEST_VERSION, \
+    LOANS_V0, BOOKS_V0, CUSTOMERS_V0
 from customers import Customer
 from books import Book
 from loans import Loan
-from helpers import check_id, check_loans
+from fixtures import IsolatedDatabase, make_customer, make_book, make_loan
+from datagen import generate
+import loadtest
+import retry
+import writer
+import changefeed
+import audit
+import backup
+import validation
+import export
+import customer_index
+from shards import all_shards, use_databases
+from pool import close_pool
+from config import DATABASE, DEFAULT_BRANCH, RE_PATT_D, ERRORS, OVERDUE_CHUNK_SIZE, MAX_OPEN_LOANS
+from helpers import check_id, check_loans, availability_for, query_db, query_all_shards, next_id, change_counter, \
+    regex_check, transaction
+from errors import LoanAlreadyReturned, BackupFailed, InvalidAge, InvalidDate, BorrowLimitReached
 
 
 class MyTestCase(unittest.TestCase):
@@ -14,6 +54,15 @@ class MyTestCase(unittest.TestCase):
        helper functions like check_id and check_loans to ensure they work correctly.
        """
 
+    def setUp(self):
+        # Running every test against its own temporary database, so tests never touch the
+        # library's database and can run in parallel (see run_tests.py).
+        self.database = IsolatedDatabase()
+        self.database.__enter__()
+
+    def tearDown(self):
+        self.database.__exit__(None, None, None)
+
     def test_customer(self):
         """
               Test the Customer class's creation, saving, retrieval, and deletion.
@@ -124,6 +173,968 @@ class MyTestCase(unittest.TestCase):
         b.delete()
         c.delete()
 
+    def test_availability_for(self):
+        """
+              Test the batch availability check and its per-request cache.
+              """
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='1')
+        b.save()
+        free = Book(title='Other', author_pname='Test', author_lname='Testing', year_published='1989', book_type='1')
+        free.save()
+        l = Loan(customer_id='123456789', book_id=b.id)
+        l.save()
+
+        cache = {}
+        availability = availability_for([b.id, free.id], cache=cache)
+        self.assertEqual(availability, {str(b.id): False, str(free.id): True})
+        self.assertEqual(cache, availability)
+
+        l.delete()
+        # Answers already in the cache are not queried again.
+        self.assertFalse(availability_for([b.id], cache=cache)[str(b.id)])
+        self.assertTrue(availability_for([b.id])[str(b.id)])
+
+        free.delete()
+        b.delete()
+        c.delete()
+
+    def test_overdue_tracker(self):
+        """
+              Test that the overdue tracker follows loan events and reports each overdue loan once.
+              """
+        create_notifications_table()
+        tracker = OverdueTracker()
+        events.subscribe('loans', tracker.on_loan_event)
+
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='1')
+        b.save()
+        l = Loan(customer_id='123456789', book_id=b.id)
+        l.save()
+
+        try:
+            # Not due yet today, overdue once the expected return date has passed.
+            self.assertEqual(tracker.tick(), [])
+            self.assertEqual(tracker.tick(today=date.today() + timedelta(days=30)), [str(l.id)])
+            self.assertEqual(tracker.tick(today=date.today() + timedelta(days=31)), [])
+
+            # A closed loan is never reported.
+            tracker.loan_opened(l.id, l.expected_return_date)
+            l.delete()
+            self.assertEqual(tracker.tick(today=date.today() + timedelta(days=30)), [])
+
+            # Due loans that could not be recorded are reported by the next tick
+            failing = make_loan()
+            query_db(query="DROP TABLE notifications;")
+            with self.assertRaises(sqlite3.OperationalError):
+                tracker.tick(today=date.today() + timedelta(days=30))
+            create_notifications_table()
+            self.assertEqual(tracker.tick(today=date.today() + timedelta(days=30)), [str(failing.id)])
+
+            # A loan opened by another process is found by the due date range read
+            loaded = OverdueTracker()
+            loaded.load()
+            other = make_loan()
+            self.assertEqual(loaded.tick(today=date.today() + timedelta(days=30)), [str(failing.id), str(other.id)])
+
+            # An overdue backlog longer than one chunk is recorded whole
+            backlog = [(1000000 + i, c.id, b.id, '2020-01-01', '2020-01-11') for i in range(OVERDUE_CHUNK_SIZE + 1)]
+            with transaction(self.database.db, write=True) as cursor:
+                cursor.executemany("INSERT INTO loans (id, custID, bookID, loandate, expected_returndate) "
+                                   "VALUES (?, ?, ?, ?, ?);", backlog)
+            idle = OverdueTracker()
+            idle.load()
+            self.assertEqual(idle.tick(), [str(row[0]) for row in backlog])
+            self.assertEqual(query_db(query="SELECT COUNT(*) FROM notifications WHERE loanID >= 1000000;",
+                                      result=True), [(len(backlog),)])
+        finally:
+            events.unsubscribe('loans', tracker.on_loan_event)
+            query_db(query="DELETE FROM notifications WHERE loanID = ?;", parameters=(str(l.id),))
+            query_db(query="DELETE FROM loans WHERE id >= 1000000;")
+            b.delete()
+            c.delete()
+
+    def test_return_loan(self):
+        """
+              Test that returning a loan keeps it in the history and makes the book available again.
+              """
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='1')
+        b.save()
+        l = Loan(customer_id=c.id, book_id=b.id)
+        l.save()
+
+        try:
+            self.assertEqual(availability_for([b.id]), {str(b.id): False})
+            self.assertTrue(l.return_book())
+            rows = query_db(query="SELECT actual_returndate, is_open FROM loans WHERE id = ?;", parameters=(l.id,),
+                            result=True)
+            self.assertEqual(rows, [(str(date.today()), 0)])
+            self.assertEqual(availability_for([b.id]), {str(b.id): True})
+            self.assertFalse(check_loans(b))
+
+            with self.assertRaises(LoanAlreadyReturned):
+                l.return_book()
+
+            # A copy loaded before the return (another desk's) finds the loan closed when it writes
+            other_desk = make_loan()
+            stale = Loan.load_from_db(condition=f"id = {other_desk.id}")[0]
+            other_desk.return_book()
+            with self.assertRaises(LoanAlreadyReturned):
+                stale.return_book()
+            self.assertTrue(stale.is_open())
+        finally:
+            l.delete()
+            b.delete()
+            c.delete()
+
+    def test_archive(self):
+        """
+              Test that old returned loans move to the archive and stay in the loan history.
+              """
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='1')
+        b.save()
+        old = Loan(customer_id=c.id, book_id=b.id)
+        old.save()
+        old.return_book()
+        query_db(query="UPDATE loans SET loandate = '2020-01-01', expected_returndate = '2020-01-11', "
+                       "actual_returndate = '2020-01-09' WHERE id = ?;", parameters=(old.id,))
+        recent = Loan(customer_id=c.id, book_id=b.id)
+        recent.save()
+
+        try:
+            self.assertGreaterEqual(archive_loans(older_than_days=365, batch_size=1), 1)
+            self.assertEqual(query_db(query="SELECT id FROM loans WHERE id IN (?, ?);",
+                                      parameters=(old.id, recent.id), result=True), [(int(recent.id),)])
+            self.assertEqual([row[0] for row in loan_history(customer_id=c.id)], [int(old.id), int(recent.id)])
+            self.assertGreater(int(next_id('loans', 'loans_archive')), int(recent.id))
+
+            # The archived loan's ID is not reused once it is the latest one
+            recent.delete()
+            self.assertGreater(int(Loan(customer_id=c.id, book_id=b.id).id), int(old.id))
+        finally:
+            query_db(query="DELETE FROM loans_archive WHERE id = ?;", parameters=(old.id,))
+            b.delete()
+            c.delete()
+
+    def test_search_index(self):
+        """
+              Test fuzzy ranked search, incremental updates through the book events and the snapshot.
+              """
+        index = CatalogueIndex()
+        index.load()
+        events.subscribe('books', index.on_book_event)
+        b = Book(title='Pride And Prejudice', author_pname='Jane', author_lname='Austen', year_published='1813',
+                 book_type='2')
+        b.save()
+
+        try:
+            # Misspelled title and author still find the book
+            self.assertEqual(index.search('prejudise')[0][0][0], str(b.id))
+            self.assertEqual(index.search('jane austin')[0][0][0], str(b.id))
+            self.assertEqual(index.search('Pride')[0][1], 1.0)
+
+            b.title = 'Emma'
+            b.edit(set_clauses=('title = ?',), values=('Emma',))
+            self.assertEqual(index.search('prejudice'), [])
+
+            path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+            snapshots.register('search', index.dump)
+            snapshots.write_snapshot(path)
+            restored = CatalogueIndex()
+            # The trigrams are read back from the snapshot, no text is normalized again
+            with snapshots.Snapshot(path) as snapshot, \
+                    mock.patch('search_index.normalize', side_effect=AssertionError('normalized')):
+                self.assertTrue(restored.restore(snapshot))
+            self.assertEqual(len(restored), len(index))
+            self.assertEqual(restored._postings, index._postings)
+            self.assertEqual(restored._books, index._books)
+
+            b.delete()
+            self.assertFalse(any(record[0] == str(b.id) for record, score in index.search('emma')))
+            # The snapshot is out of date once the database changed
+            with snapshots.Snapshot(path) as snapshot:
+                self.assertFalse(CatalogueIndex().restore(snapshot))
+
+            # A catalogue larger than the index is only read up to the limit
+            make_book()
+            make_book()
+            bounded = CatalogueIndex(max_books=1)
+            bounded.load()
+            self.assertEqual((len(bounded), bounded.complete), (1, False))
+        finally:
+            snapshots.register('search', catalogue.dump)
+            events.unsubscribe('books', index.on_book_event)
+            b.delete()
+
+    def test_snapshot(self):
+        """
+              Test restoring the open loans from a snapshot and replaying the loans opened after it.
+              """
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='1')
+        b.save()
+        first = Loan(customer_id=c.id, book_id=b.id)
+        first.save()
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+
+        try:
+            create_notifications_table()
+            tracker.load()
+            snapshots.write_snapshot(path)
+            first.return_book()
+            second = Loan(customer_id=c.id, book_id=b.id)
+            second.save()
+
+            restored = OverdueTracker()
+            with snapshots.Snapshot(path) as snapshot:
+                self.assertFalse(snapshot.is_current())
+                self.assertTrue(restored.restore(snapshot))
+            # The returned loan is restored but never reported; the new loan is replayed
+            self.assertEqual(restored.tick(today=date.today() + timedelta(days=30)), [str(second.id)])
+
+            # A missing or foreign file opens as an empty snapshot
+            with open(path, 'wb') as f:
+                f.write(b'not a snapshot')
+            with snapshots.Snapshot(path) as snapshot:
+                self.assertIsNone(snapshot.section('open_loans'))
+                self.assertFalse(OverdueTracker().restore(snapshot))
+        finally:
+            query_db(query="DELETE FROM notifications WHERE loanID = ?;", parameters=(str(second.id),))
+            second.delete()
+            first.delete()
+            b.delete()
+            c.delete()
+
+    def test_fixtures(self):
+        """
+              Test that each test runs on its own database, and that the factories create unique records.
+              """
+        self.assertEqual(all_shards(), [self.database.db])
+        self.assertNotEqual(self.database.db, DATABASE)
+
+        library_counter = change_counter(DATABASE)
+        l = make_loan()
+        other = make_loan(customer=l.customer)
+        self.assertEqual(other.customer.id, l.customer.id)
+        self.assertNotEqual(other.book.id, l.book.id)
+        self.assertEqual(len(query_db(query="SELECT * FROM loans WHERE is_open = 1;", result=True)), 2)
+        # The library's database was not written to
+        self.assertEqual(change_counter(DATABASE), library_counter)
+
+    def test_branches(self):
+        """
+              Test that writes go to their branch's database and that reads and IDs span every branch.
+              """
+        north = os.path.join(tempfile.mkdtemp(), 'north.db')
+        try:
+            with use_databases({DEFAULT_BRANCH: self.database.db, 'north': north}):
+                migrate_all_shards()
+                create_tables()
+
+                local = make_book(title='Emma')
+                remote = Book(title='Persuasion', author_pname='Jane', author_lname='Austen', year_published='1817',
+                              book_type='2')
+                remote.branch = 'north'
+                remote.save()
+
+                # The insert lands in its branch only, and reads gather both branches
+                self.assertEqual(query_db(query="SELECT id FROM books;", db=north, result=True), [(int(remote.id),)])
+                self.assertEqual(query_db(query="SELECT id FROM books WHERE id = ?;", parameters=(remote.id,),
+                                          result=True), [])
+                rows = query_all_shards(query="SELECT title FROM books ORDER BY title;", result=True)
+                self.assertEqual(sorted(row[0] for row in rows), ['Emma', 'Persuasion'])
+
+                # IDs are unique across the branches
+                self.assertNotEqual(local.id, remote.id)
+                self.assertGreater(int(next_id('books')), max(int(local.id), int(remote.id)))
+
+                # An object of unknown branch is deleted wherever it is
+                remote.branch = None
+                self.assertTrue(remote.delete())
+                self.assertEqual(query_db(query="SELECT id FROM books;", db=north, result=True), [])
+        finally:
+            writer.stop_writer(north)
+            close_pool(north)
+
+    def test_datagen(self):
+        """
+              Test that generated data is valid, deterministic and has at most one open loan per book.
+              """
+        today = date(2024, 3, 1)
+        counts = generate(customers=40, books=30, loans=300, seed=7, workers=1, today=today, chunk_size=64)
+        self.assertEqual(counts, {'customers': 40, 'books': 30, 'loans': 291, 'open_loans': 9})
+
+        customers = query_db(query="SELECT * FROM customers ORDER BY id;", result=True)
+        books = query_db(query="SELECT * FROM books ORDER BY id;", result=True)
+        loans = query_db(query="SELECT * FROM loans ORDER BY id;", result=True)
+        self.assertEqual((len(customers), len(books), len(loans)), (40, 30, 300))
+
+        for row in customers:
+            for field, value in zip(('custID', 'p_name', 'l_name', 'city', 'age'), row):
+                self.assertTrue(regex_check(RE_PATT_D[field], value), (field, value))
+        for row in books:
+            for field, value in zip(('bookID', 'title', 'p_name', 'l_name', 'pub_year', 'book_type'), row):
+                self.assertTrue(regex_check(RE_PATT_D[field], value), (field, value))
+
+        open_books = [row[2] for row in loans if row[6] == 1]
+        self.assertEqual(len(open_books), len(set(open_books)))
+        open_customers = [row[1] for row in loans if row[6] == 1]
+        self.assertLessEqual(max(map(open_customers.count, open_customers)), MAX_OPEN_LOANS)
+        for row in loans:
+            self.assertLessEqual(row[3], today.isoformat())
+            if row[5] is not None:
+                self.assertTrue(row[3] <= row[5] <= today.isoformat())
+
+        # The same seed generates the same rows
+        with IsolatedDatabase():
+            generate(customers=40, books=30, loans=300, seed=7, workers=1, today=today, chunk_size=64)
+            self.assertEqual(query_db(query="SELECT * FROM loans ORDER BY id;", result=True), loans)
+            self.assertEqual(query_db(query="SELECT * FROM books ORDER BY id;", result=True), books)
+
+    def test_loadtest(self):
+        """
+              Test that the load test runs the operation mix and classifies the outcomes.
+              """
+        generate(customers=20, books=20, loans=100, seed=3, workers=1)
+        summary = loadtest.run(self.database.db, workers=2, mode='thread', duration=30, operations=25, seed=3)
+
+        self.assertEqual(summary['operations'], 50)
+        self.assertEqual(sum(summary['outcomes'].values()), 50)
+        self.assertTrue(set(summary['by_operation']) <= set(loadtest.DEFAULT_MIX))
+        for stats in summary['by_operation'].values():
+            self.assertLessEqual(stats['p50'], stats['p95'])
+            self.assertLessEqual(stats['p95'], stats['p99'])
+
+        self.assertEqual(loadtest.classify(sqlite3.OperationalError('database is locked')), 'locked')
+        self.assertEqual(loadtest.classify(LoanAlreadyReturned()), 'rejected')
+        self.assertEqual(loadtest.parse_mix('checkout=1,search=2'), {'checkout': 1.0, 'search': 2.0})
+
+    def test_lock_retry(self):
+        """
+              Test that a write waits for another connection's lock with backoff instead of failing.
+              """
+        retry.reset_metrics()
+        blocker = sqlite3.connect(self.database.db, isolation_level=None, check_same_thread=False)
+        blocker.execute("BEGIN IMMEDIATE;")  # Another desk holding the write lock
+        timer = threading.Timer(0.3, blocker.rollback)
+        timer.start()
+
+        try:
+            make_customer()
+            self.assertGreater(retry.metrics()['retries'], 0)
+            self.assertEqual(retry.metrics()['failures'], 0)
+        finally:
+            timer.join()
+            blocker.close()
+
+        # Only lock contention is retried, and only up to the number of attempts or the timeout
+        calls = []
+
+        def locked():
+            calls.append(1)
+            raise sqlite3.OperationalError('database is locked')
+
+        with self.assertRaises(sqlite3.OperationalError):
+            retry.retry(locked, attempts=3)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(retry.metrics()['failures'], 1)
+        with self.assertRaises(sqlite3.OperationalError):
+            retry.retry(lambda: calls.append(1) or query_db(query="SELECT * FROM no_such_table;"))
+        self.assertEqual(len(calls), 4)
+
+        started = time.monotonic()
+        with self.assertRaises(sqlite3.OperationalError):
+            retry.retry(locked, timeout=0.2)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertGreater(len(calls), 5)
+
+    def test_group_commit(self):
+        """
+              Test that writes arriving together are committed in one batch, each failing on its own.
+              """
+        w = writer.Writer(self.database.db, max_delay=0.2)
+        customers = [Customer(id_=str(id_), p_name='Test', l_name='Testing', city='Nowhere', age='66')
+                     for id_ in (200000001, 200000002, 200000003)]
+        query = "INSERT INTO customers (id, p_name, l_name, city, age) VALUES (?, ?, ?, ?, ?);"
+
+        try:
+            futures = [w.submit('insert', c, query, c.obj_to_values()) for c in customers]
+            duplicate = w.submit('insert', customers[0], query, customers[0].obj_to_values())
+
+            self.assertEqual([future.result(timeout=5) for future in futures], [1, 1, 1])
+            with self.assertRaises(sqlite3.IntegrityError):
+                duplicate.result(timeout=5)
+            self.assertEqual((w.batches, w.writes), (1, 4))
+            self.assertEqual(len(query_db(query="SELECT * FROM customers;", result=True)), 3)
+        finally:
+            w.stop()
+
+        # The models wait for their write, unless asked for its future
+        future = make_customer().delete(wait=False)
+        self.assertEqual(future.result(timeout=5), 1)
+
+    def test_changefeed(self):
+        """
+              Test that model writes are captured in order and consumed from a checkpoint.
+              """
+        changefeed.enable_changefeed(create_tables=False)
+        try:
+            l = make_loan()
+            l.return_book()
+            l.book.edit(set_clauses=('title = ?',), values=('Another Title',))
+            l.delete()
+
+            changes = changefeed.pull()
+            self.assertEqual([(change['table'], change['action']) for change in changes],
+                             [('customers', 'insert'), ('books', 'insert'), ('loans', 'insert'),
+                              ('loans', 'update'), ('books', 'update'), ('loans', 'delete')])
+            self.assertEqual([change['seq'] for change in changes], sorted(change['seq'] for change in changes))
+            self.assertIsNotNone(changes[3]['data']['actual_returndate'])
+            self.assertEqual(changes[4]['data']['title'], 'Another Title')
+            self.assertIsNone(changes[5]['data'])
+
+            # A failing consumer reads the same batch again; a working one moves on
+            def failing(batch):
+                raise RuntimeError
+            with self.assertRaises(RuntimeError):
+                changefeed.consume('warehouse', failing, limit=4)
+            seen = []
+            self.assertEqual(changefeed.consume('warehouse', seen.extend, limit=4), 4)
+            self.assertEqual(changefeed.consume('warehouse', seen.extend, limit=4), 2)
+            self.assertEqual(changefeed.consume('warehouse', seen.extend, limit=4), 0)
+            self.assertEqual(seen, changes)
+            self.assertEqual(changefeed.prune(), 6)
+            self.assertEqual(changefeed.pull(), [])
+
+            # The search index replays the book changes made after its snapshot
+            gone = make_book(title='Moby Dick')
+            index = CatalogueIndex()
+            index.load()
+            path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+            snapshots.register('search', index.dump)
+            try:
+                snapshots.write_snapshot(path)
+            finally:
+                snapshots.register('search', catalogue.dump)
+            gone.delete()
+            make_book(title='Pride And Prejudice')
+
+            restored = CatalogueIndex()
+            with snapshots.Snapshot(path) as snapshot:
+                self.assertFalse(snapshot.is_current())
+                self.assertTrue(restored.restore(snapshot))
+            self.assertEqual([record[1] for record, score in restored.search('pride prejudice')],
+                             ['Pride And Prejudice'])
+            self.assertEqual(restored.search('moby dick'), [])
+
+            # Once a prune deleted the changes the snapshot needs, it is not used, even though the
+            # deletion and the insertion left the number of books as it was
+            changefeed.set_checkpoint('warehouse', changefeed.last_seq())
+            changefeed.prune()
+            with snapshots.Snapshot(path) as snapshot:
+                self.assertFalse(CatalogueIndex().restore(snapshot))
+        finally:
+            for table in changefeed.FEED_TABLES:
+                events.unsubscribe(table, changefeed.on_change)
+
+    def test_audit(self):
+        """
+              Test that committed model writes are buffered into the audit store and queried by row and time.
+              """
+        path = os.path.join(tempfile.mkdtemp(), 'audit.db')
+        audit.log = audit.AuditLog(path, buffer_size=3, flush_seconds=60)
+        audit.log.start()
+        try:
+            start = datetime.now()
+            l = make_loan()
+            # The third record filled the buffer, and the background thread wrote it
+            deadline = time.monotonic() + 5
+            while query_db(query="SELECT COUNT(*) FROM audit;", db=path, result=True)[0][0] < 3:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+            l.return_book()
+            l.book.edit(set_clauses=('title = ?',), values=('Another Title',), wait=False).result()
+            # A write that changed nothing is not recorded
+            Book('Missing', 'Test', 'Testing', '1989', '1', id_='999999999').edit(
+                set_clauses=('title = ?',), values=('Nothing',))
+
+            self.assertEqual([record['action'] for record in audit.log.history('loans', l.id)], ['insert', 'return'])
+            self.assertEqual([record['action'] for record in audit.log.history('books', l.book.id)],
+                             ['insert', 'update'])
+            self.assertEqual(audit.log.history('books', '999999999'), [])
+            self.assertEqual(audit.log.history('loans', l.id)[0]['actor'], audit.ACTOR)
+
+            end = datetime.now() + timedelta(seconds=1)
+            self.assertEqual(len(audit.log.between(start, end)), 5)
+            self.assertEqual(len(audit.log.between(start, end, entity='loans')), 2)
+            self.assertEqual(audit.log.between(end, end + timedelta(days=1)), [])
+        finally:
+            audit.log.stop()
+            audit.log = None
+
+    def test_backup(self):
+        """
+              Test that online backups are consistent, verified, compressed on request and rotated.
+              """
+        make_loan()
+        directory = tempfile.mkdtemp()
+        db = all_shards()[0]
+
+        # A write made between two steps restarts the copy, so the snapshot still holds it
+        writes = []
+        def write_once(remaining, total):
+            if not writes:
+                writes.append(make_customer())
+        first = backup.backup(db, directory, pages=1, sleep=0, progress=write_once)
+        self.assertTrue(writes)
+        copy = sqlite3.connect(first)
+        try:
+            self.assertEqual(copy.execute("SELECT COUNT(*) FROM customers;").fetchone()[0], 2)
+        finally:
+            copy.close()
+
+        # A copy that keeps being restarted is made again in a single step, and still holds every write
+        def write_always(remaining, total):
+            writes.append(make_customer())
+        restarted = backup.backup(db, directory, pages=1, sleep=0, progress=write_always, max_restarts=0)
+        copy = sqlite3.connect(restarted)
+        try:
+            self.assertEqual(copy.execute("SELECT COUNT(*) FROM customers;").fetchone()[0], len(writes) + 1)
+        finally:
+            copy.close()
+
+        # A source that can not be copied leaves no partial file behind
+        broken = os.path.join(tempfile.mkdtemp(), 'broken.db')
+        with open(broken, 'wb') as f:
+            f.write(b'\xff' * 4096)
+        with self.assertRaises(sqlite3.DatabaseError):
+            backup.backup(broken, directory)
+        self.assertFalse([name for name in os.listdir(directory) if name.endswith('.part')])
+
+        second = backup.backup(db, directory, compress=True, keep=2)
+        self.assertTrue(second.endswith('.db.gz'))
+        backup.verify(second)
+        third = backup.backup(db, directory, keep=2)
+        self.assertEqual(backup.snapshots_of(db, directory), [second, third])
+
+        # A damaged snapshot fails its check
+        with open(third, 'r+b') as f:
+            f.seek(100)
+            f.write(b'\xff' * 4096)
+        with self.assertRaises(BackupFailed):
+            backup.verify(third)
+
+    def test_batch_validation(self):
+        """
+              Test that column checks flag the same values as the setters, without raising.
+              """
+        columns = {'id': ['123456789', '12', '234567890', '345678901'],
+                   'p_name': ['Test', 'Test', 'T3st', 'Test'],
+                   'l_name': ["O'Brien", 'Testing', 'Testing', 'Testing'],
+                   'city': ['Nowhere', 'Nowhere', 'Nowhere', 'Nowhere'],
+                   'age': ['66', '66', '130', 4]}
+        result = validation.validate('customers', columns)
+        self.assertEqual(list(result.mask), [0, 1, 1, 1])
+        self.assertEqual(result.valid_rows(), [0])
+        self.assertEqual(result.errors[1], [('id', ERRORS['custID'])])
+        self.assertEqual(result.errors[2], [('p_name', ERRORS['p_name']), ('age', str(InvalidAge()))])
+        self.assertEqual(result.errors[3], [('age', str(InvalidAge()))])  # check_number excludes the minimum
+
+        today = date.today()
+        rows = [('1', '123456789', '1', '2024-01-10', '2024-01-20', None, 1),
+                ('2', '123456789', '1', '2024-01-10', '2024-01-20', '2024-01-09', 0),
+                ('3', '123456789', '1', '2024-01-10', '2024-01-20', (today + timedelta(days=1)).isoformat(), 0),
+                ('4', '123456789', 'x', '2024-01-10', '2024-01-20', '10/01/2024', 0)]
+        result = validation.validate('loans', validation.columns_from_rows('loans', rows))
+        self.assertEqual(list(result.mask), [0, 1, 1, 1])
+        self.assertEqual(result.errors[1], [('actual_returndate', str(InvalidDate()))])
+        self.assertEqual(result.errors[2], [('actual_returndate', str(InvalidDate()))])
+        self.assertEqual(result.errors[3], [('bookID', ERRORS['bookID']), ('actual_returndate', ERRORS['date'])])
+
+        with self.assertRaises(ValueError):
+            validation.validate('books', {'title': ['A title'], 'type': []})
+
+    def test_export(self):
+        """
+              Test that tables are exported in chunks into typed .npy column files.
+              """
+        returned = make_loan()
+        returned.return_book()
+        archive_loans(older_than_days=-1)
+        open_loan = make_loan()
+        directory = tempfile.mkdtemp()
+
+        manifest = export.export(directory=directory, chunk_size=1)
+        self.assertEqual(manifest['tables']['loans']['rows'], 2)
+        self.assertEqual(manifest['tables']['loans']['columns']['loandate'], '<M8[D]')
+        self.assertFalse(os.path.exists(os.path.join(directory, 'loans.part')))
+
+        def column(table, name):
+            return export.read_column(os.path.join(directory, table, f"{name}.npy"))
+
+        # The archived loan comes first, then the current ones
+        self.assertEqual(column('loans', 'id'), [int(returned.id), int(open_loan.id)])
+        self.assertEqual(column('loans', 'loandate'), [date.today(), date.today()])
+        self.assertEqual(column('loans', 'actual_returndate'), [date.today(), None])
+        self.assertEqual(column('loans', 'is_open'), [False, True])
+        self.assertEqual(column('books', 'title'), [returned.book.title, open_loan.book.title])
+        self.assertEqual(column('customers', 'age'), [int(returned.customer.age), int(open_loan.customer.age)])
+
+        with open(os.path.join(directory, 'loans', 'id.npy'), 'rb') as f:
+            self.assertEqual(f.read(8), b'\x93NUMPY\x01\x00')
+            self.assertEqual(os.path.getsize(f.name), export.NPY_HEADER_SIZE + 2 * 8)
+
+    def test_customer_index(self):
+        """
+              Test that the customer loan index follows the loans and enforces the borrowing limit.
+              """
+        customer_index.enable_customer_index(create_tables=False)
+        try:
+            c = make_customer()
+            customer_index.set_borrow_limit(c.id, 2)
+            first = make_loan(customer=c)
+            second = make_loan(customer=c)
+
+            self.assertEqual(customer_index.loan_summary(c.id),
+                             {'open_loans': 2, 'total_loans': 2, 'last_loan': int(second.id), 'borrow_limit': 2})
+            with self.assertRaises(BorrowLimitReached):
+                customer_index.check_borrow_limit(c.id)
+            with self.assertRaises(AssertionError):
+                check_loans(c)
+
+            first.return_book()
+            customer_index.check_borrow_limit(c.id)
+            archive_loans(older_than_days=-1)
+            second.delete()
+            self.assertEqual(customer_index.loan_summary(c.id),
+                             {'open_loans': 0, 'total_loans': 1, 'last_loan': int(first.id), 'borrow_limit': 2})
+            check_loans(c)
+            self.assertEqual([row[0] for row in customer_index.customer_history(c.id)], [int(first.id)])
+
+            # The maintained counts match a recount, and the limit set is kept
+            summary = customer_index.loan_summary(c.id)
+            customer_index.rebuild()
+            self.assertEqual(customer_index.loan_summary(c.id), summary)
+
+            # Loans made at once, without the early check, are refused by the insert past the limit
+            first_id = int(next_id('loans', 'loans_archive'))
+            loans = [Loan(customer_id=c.id, book_id=make_book().id, loan_date=date.today(),
+                          expected_return_date=date.today(), loan_id=str(first_id + i), override_id=True)
+                     for i in range(3)]
+            futures = [loan.save(wait=False) for loan in loans]
+            self.assertEqual([type(future.exception()) for future in futures].count(BorrowLimitReached), 1)
+            self.assertEqual(customer_index.open_loans(c.id), 2)
+
+            # A loan written around the models is not in the index, but still blocks the delete
+            other = make_customer()
+            query_db(query="INSERT INTO loans (id, custID, bookID, loandate, expected_returndate) "
+                           "VALUES (?, ?, ?, ?, ?);",
+                     parameters=(first_id + 3, other.id, make_book().id, str(date.today()), str(date.today())))
+            self.assertEqual(customer_index.loan_summary(other.id)['open_loans'], 0)
+            with self.assertRaises(AssertionError):
+                check_loans(other)
+        finally:
+            customer_index.disable_customer_index()
+
+    def test_migration(self):
+        """
+              Test upgrading an original-schema database in place and downgrading it back.
+              """
+        db = os.path.join(tempfile.mkdtemp(), 'legacy.db')
+        with sqlite3.connect(db) as conn:
+            for query in (BOOKS_V0, CUSTOMERS_V0, LOANS_V0):
+                conn.execute(query)
+            conn.execute("INSERT INTO books VALUES ('7', 'Emma', 'Jane', 'Austen', 1815, 2);")
+            conn.execute("INSERT INTO customers VALUES ('123456789', 'Test', 'Testing', 'Nowhere', 66);")
+            conn.execute("INSERT INTO loans VALUES ('1', '123456789', '7', '2023-04-05', '2023-04-10', "
+                         "'Not returned');")
+            conn.execute("INSERT INTO loans VALUES ('2', '123456789', '7', '2023-03-01', '2023-03-11', "
+                         "'2023-03-09');")
+        conn.close()
+
+        self.assertEqual(migrate(db=db), LATEST_VERSION)
+        rows = query_db(query="SELECT id, custID, actual_returndate, is_open FROM loans ORDER BY id;", db=db,
+                        result=True)
+        self.assertEqual(rows, [(1, 123456789, None, 1), (2, 123456789, '2023-03-09', 0)])
+        plan = query_db(query="EXPLAIN QUERY PLAN SELECT id FROM loans WHERE bookID = 7 AND is_open = 1;", db=db,
+                        result=True)
+        self.assertIn('idx_loans_open_bookID', plan[0][-1])
+        tables = query_db(query="SELECT name FROM sqlite_master WHERE name IN ('fees', 'fee_runs', "
+                                "'idx_loans_expected') ORDER BY name;", db=db, result=True)
+        self.assertEqual(tables, [('fee_runs',), ('fees',)])
+
+        self.assertEqual(migrate(db=db, target=0), 0)
+        self.assertEqual(get_version(db), 0)
+        rows = query_db(query="SELECT id, actual_returndate FROM loans ORDER BY id;", db=db, result=True)
+        self.assertEqual(rows, [('1', 'Not returned'), ('2', '2023-03-09')])
+
+    def test_startup(self):
+        """
+              Test that the schema setup is skipped while the cached schema state is current,
+              and that starting the program does not import the menus and models.
+              """
+        cache = os.path.join(tempfile.mkdtemp(), 'schema_cache.json')
+        self.assertTrue(ensure_schema(cache))
+        self.assertFalse(ensure_schema(cache))
+
+        # A schema change (here, a new index) invalidates the cache
+        query_db(query="CREATE INDEX IF NOT EXISTS idx_test_startup ON books (title);")
+        try:
+            self.assertTrue(ensure_schema(cache))
+        finally:
+            query_db(query="DROP INDEX IF EXISTS idx_test_startup;")
+
+        code = "import sys, main; print(sorted({'book_menu', 'loans', 'sample_data', 'unittest'} & set(sys.modules)))"
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.stdout.strip(), '[]')
+
+    def test_fees(self):
+        """
+              Test fine calculation, the fee cap and that settled fines are not recomputed.
+              """
+        create_fees_tables()
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='3')
+        b.save()
+        l = Loan(customer_id='123456789', book_id=b.id)
+        l.save()
+        due = date.fromisoformat(str(l.expected_return_date))
+
+        try:
+            # Type 3 books are fined 2.0 per late day, up to 20.0.
+            self.assertEqual(calculate_fees(today=due), 0)
+            self.assertEqual(calculate_fees(today=due + timedelta(days=3)), 1)
+            self.assertEqual(customer_balance('123456789'), 6.0)
+
+            self.assertEqual(calculate_fees(today=due + timedelta(days=30)), 1)
+            self.assertEqual(customer_balance('123456789'), 20.0)
+            # A capped fine is final and is skipped by the next runs.
+            self.assertEqual(calculate_fees(today=due + timedelta(days=31)), 0)
+        finally:
+            query_db(query="DELETE FROM fees WHERE loanID = ?;", parameters=(l.id,))
+            l.delete()
+            b.delete()
+            c.delete()
+
+    def test_reports(self):
+        """
+              Test that the materialised aggregates follow loans and match a rebuild from scratch.
+              """
+        reports.enable_reporting()
+        reports.rebuild()
+        before = reports.dashboard()
+
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='2')
+        b.save()
+        l = Loan(customer_id='123456789', book_id=b.id)
+        l.save()
+
+        try:
+            after = reports.dashboard()
+            self.assertEqual(after['loans'], before['loans'] + 1)
+            self.assertEqual(after['open_loans'], before['open_loans'] + 1)
+            self.assertEqual(after['loans_per_book_type'][2], before['loans_per_book_type'].get(2, 0) + 1)
+
+            # The incrementally maintained aggregates match a full rebuild.
+            reports.rebuild()
+            self.assertEqual(reports.dashboard(), after)
+
+            l.delete()
+            closed = reports.dashboard()
+            self.assertEqual(closed['open_loans'], before['open_loans'])
+            self.assertEqual(closed['returned'], before['returned'])
+            self.assertEqual(closed['loans'], before['loans'])
+        finally:
+            events.unsubscribe('loans', reports.on_loan_event)
+            reports.rebuild()
+            b.delete()
+            c.delete()
+
+    def test_reports_delete(self):
+        """
+              Test that deleting loans, open or returned, leaves the same aggregates as a rebuild.
+              """
+        reports.enable_reporting()
+        try:
+            kept = make_loan()
+            returned = make_loan(customer=kept.customer)
+            returned.return_book()
+            open_loan = make_loan(book=returned.book)
+            returned.delete()
+            open_loan.delete()
+
+            def aggregates():
+                return {table: query_db(query=f"SELECT * FROM {table} ORDER BY 1;", result=True)
+                        for table in ('stats_daily', 'stats_book_types', 'stats_titles', 'stats_customers',
+                                      'stats_totals')}
+
+            maintained = aggregates()
+            reports.rebuild()
+            self.assertEqual(aggregates(), maintained)
+            self.assertEqual(maintained['stats_titles'], [(int(kept.book.id), 1)])
+        finally:
+            events.unsubscribe('loans', reports.on_loan_event)
+
+    def test_holds(self):
+        """
+              Test that a returned book is assigned to the first hold in its queue.
+              """
+        holds.enable_holds()
+        customers = [Customer(id_=f'12345678{i}', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+                     for i in range(3)]
+        for c in customers:
+            c.save()
+        b = Book(title='Something', author_pname='Test', author_lname='Testing', year_published='1989', book_type='1')
+        b.save()
+        l = Loan(customer_id=customers[0].id, book_id=b.id)
+        l.save()
+
+        try:
+            first = holds.place_hold(customers[1].id, b.id)
+            second = holds.place_hold(customers[2].id, b.id)
+            self.assertEqual(holds.next_in_line(b.id)[0], first)
+            self.assertEqual(holds.queue_position(second), 2)
+
+            # Closing the loan assigns the book to the first customer in line.
+            l.delete()
+            self.assertEqual(holds.next_in_line(b.id)[0], second)
+            with self.assertRaises(Exception):
+                holds.check_reserved(b.id, customers[2].id)
+            holds.check_reserved(b.id, customers[1].id)
+
+            # Borrowing the book fulfils the ready hold.
+            l = Loan(customer_id=customers[1].id, book_id=b.id)
+            l.save()
+            self.assertEqual(query_db(query="SELECT status FROM holds WHERE id = ?;", parameters=(first,),
+                                      result=True), [('fulfilled',)])
+        finally:
+            events.unsubscribe('loans', holds.on_loan_event)
+            query_db(query="DELETE FROM holds WHERE bookID = ?;", parameters=(b.id,))
+            l.delete()
+            b.delete()
+            for c in customers:
+                c.delete()
+
+    def test_cancel_hold(self):
+        """
+              Test that cancelling a ready hold assigns the book to the next hold in line.
+              """
+        holds.enable_holds()
+        customers = [make_customer() for _ in range(4)]
+        b = make_book()
+        l = make_loan(customer=customers[0], book=b)
+
+        try:
+            hold_ids = [holds.place_hold(c.id, b.id) for c in customers[1:]]
+            l.return_book()
+            status = "SELECT status FROM holds WHERE bookID = ? ORDER BY id;"
+            self.assertEqual(query_db(query=status, parameters=(b.id,), result=True),
+                             [('ready',), ('waiting',), ('waiting',)])
+
+            holds.cancel_hold(hold_ids[0])
+            self.assertEqual(query_db(query=status, parameters=(b.id,), result=True),
+                             [('cancelled',), ('ready',), ('waiting',)])
+            holds.check_reserved(b.id, customers[2].id)
+        finally:
+            events.unsubscribe('loans', holds.on_loan_event)
+
+    def test_async_lookup(self):
+        """
+              Test that the async data access layer mirrors the blocking lookups.
+              """
+        c = Customer(id_='123456789', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+        asyncio.run(async_db.save(c))
+
+        async def lookups():
+            # Running many lookups concurrently on the database thread pool.
+            found = await asyncio.gather(*(async_db.get_by_id('123456789', 'customers') for _ in range(20)))
+            matches = await async_db.search_customers_by_name('Testing')
+            return found, matches
+
+        found, matches = asyncio.run(lookups())
+        self.assertEqual(len(found), 20)
+        self.assertEqual(str(found[0][0]), '123456789')
+        self.assertEqual(len(matches), 1)
+
+        self.assertTrue(asyncio.run(async_db.delete(c)), "Delete Successful")
+
+        # Writes are awaited on the writer, without taking a thread of the pool
+        customers = [Customer(id_=f'2345678{i:02}', p_name='Test', l_name='Testing', city='Nowhere', age='66')
+                     for i in range(20)]
+
+        async def saves():
+            return await asyncio.gather(*(async_db.save(customer) for customer in customers))
+
+        with mock.patch.object(async_db, 'get_executor', side_effect=AssertionError('pool thread taken')):
+            self.assertEqual(asyncio.run(saves()), [True] * 20)
+        self.assertEqual(query_db(query="SELECT COUNT(*) FROM customers WHERE id >= 234567800;", result=True),
+                         [(20,)])
+        with self.assertRaises(sqlite3.IntegrityError):
+            asyncio.run(async_db.save(customers[0]))
+
+    def test_http_service(self):
+        """
+              Test the HTTP service over one kept-alive connection: create, conditional GET, batch and delete.
+              """
+        httpd = server.make_server(port=0)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+
+        def request(method, path, body=None, headers=None):
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+            return response, json.loads(data) if data else None
+
+        try:
+            response, _ = request('POST', '/customers', {'id': '123456789', 'p_name': 'Test', 'l_name': 'Testing',
+                                                         'city': 'Nowhere', 'age': '66'})
+            self.assertEqual(response.status, 201)
+
+            # A listing fetched again with its ETag is not sent twice.
+            response, _ = request('GET', '/customers')
+            etag = response.getheader('ETag')
+            response, _ = request('GET', '/customers', headers={'If-None-Match': etag})
+            self.assertEqual(response.status, 304)
+
+            response, data = request('POST', '/customers/lookup', {'ids': ['123456789', '999999999']})
+            self.assertEqual(list(data['found']), ['123456789'])
+            self.assertEqual(data['missing'], ['999999999'])
+
+            response, data = request('POST', '/books/availability', {'ids': ['1', '2']})
+            self.assertEqual(set(data['availability']), {'1', '2'})
+
+            # Malformed requests are the client's error, failures of the handlers are the server's
+            response, data = request('POST', '/books', {'title': 'Emma'})
+            self.assertEqual((response.status, data['error']), (400, 'InvalidEntry: Missing field: author_pname'))
+            response, _ = request('POST', '/books/lookup', {'ids': 7})
+            self.assertEqual(response.status, 400)
+            with mock.patch.object(server, 'dashboard', side_effect=KeyError('total')):
+                response, _ = request('GET', '/reports/dashboard')
+            self.assertEqual(response.status, 500)
+
+            response, _ = request('DELETE', '/customers/123456789')
+            self.assertEqual(response.status, 200)
+            response, _ = request('GET', '/customers/123456789')
+            self.assertEqual(response.status, 404)
+        finally:
+            conn.close()
+            httpd.shutdown()
+            httpd.server_close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,165 @@
+import re
+from datetime import date
+from itertools import compress
+from operator import not_
+from helpers import number_range
+from errors import InvalidAge, InvalidPublicationYear, InvalidDate
+from config import RE_PATT_D, ERRORS, BOOKS_FIELDNAMES, CUSTOMERS_FIELDNAMES, LOAN_FIELDNAMES
+
+
+# Batch validation of imported rows.
+# The model setters validate one field at a time, raising and logging on the first bad value,
+# which is right for a desk typing one customer, but far too slow for a million-row import.
+# Here the data comes in columns (one list of values per field), and every check runs over a
+# whole column at once: the patterns of RE_PATT_D are compiled once, each distinct value of a
+# column is matched once, and the bad rows are then found with set lookups mapped over the
+# column in the interpreter's C code (map, itertools.compress). Nothing is raised or logged
+# per row; the result holds a per-row error mask and the messages of ERRORS for the bad rows.
+#
+# The checks are those of the setters: the field's pattern, the check_number range of ages
+# and publication years, and a loan's actual return date between its loan date and today.
+# Columns without a rule (e.g. is_open) are not checked, and missing columns are not required.
+
+# Table -> column -> (RE_PATT_D key, check_number type or None)
+RULES = {
+    'customers': {'id': ('custID', None), 'p_name': ('p_name', None), 'l_name': ('l_name', None),
+                  'city': ('city', None), 'age': ('age', 'age')},
+    'books': {'id': ('bookID', None), 'title': ('title', None), 'author_pname': ('p_name', None),
+              'author_lname': ('l_name', None), 'publication_year': ('pub_year', 'year'), 'type': ('book_type', None)},
+    'loans': {'id': ('loanID', None), 'custID': ('custID', None), 'bookID': ('bookID', None),
+              'loandate': ('date', None), 'expected_returndate': ('date', None), 'actual_returndate': ('date', None)}
+}
+
+# Column names of every table, in the database's order
+FIELDNAMES = {'customers': CUSTOMERS_FIELDNAMES.split(', '), 'books': BOOKS_FIELDNAMES.split(', '),
+              'loans': LOAN_FIELDNAMES.split(', ')}
+
+RANGE_ERRORS = {'age': str(InvalidAge()), 'year': str(InvalidPublicationYear())}
+DATE_ERROR = str(InvalidDate())
+OPEN_LOAN = (None, 'Not returned')  # Actual return dates of open loans
+
+# The patterns, compiled once (the setters go through re's cache on every call)
+_MATCHERS = {key: re.compile(pattern, re.IGNORECASE).match for key, pattern in RE_PATT_D.items()}
+
+
+class BatchResult:
+    """
+    The outcome of a batch validation.
+
+    Attributes:
+        rows (int): The number of validated rows.
+        mask (bytearray): 1 for every row with at least one error, 0 for a valid row.
+        errors (dict): Row index -> list of (column, message) pairs, for the bad rows only.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.mask = bytearray(rows)
+        self.errors = {}
+
+    def add(self, indices, column, message):
+        # Marking the bad rows of a column's check
+        for i in indices:
+            self.mask[i] = 1
+            self.errors.setdefault(i, []).append((column, message))
+
+    def invalid(self):
+        """
+        Returns the number of rows with at least one error.
+        """
+        return len(self.errors)
+
+    def valid_rows(self):
+        """
+        Returns the indices of the valid rows, in order.
+        """
+        return list(compress(range(self.rows), map(not_, self.mask)))
+
+
+def columns_from_rows(table, rows):
+    """
+    Turns rows (e.g. read from a CSV file) into the columns validate takes.
+
+    Args:
+        table (str): 'customers', 'books' or 'loans'.
+        rows (list): Tuples of values in the table's column order (see FIELDNAMES).
+
+    Returns:
+        dict: Column name -> tuple of values.
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(FIELDNAMES[table])
+
+    return dict(zip(FIELDNAMES[table], columns))
+
+
+def validate(table, columns):
+    """
+    Validates columns of data for a table, without raising on bad values.
+
+    Args:
+        table (str): 'customers', 'books' or 'loans'.
+        columns (dict): Column name -> list of values, all of the same length.
+
+    Returns:
+        BatchResult: The error mask and messages.
+
+    Raises:
+        KeyError: If the table is unknown.
+        ValueError: If the columns are not all of the same length.
+    """
+    rules = RULES[table]
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"Columns of different lengths: {sorted(lengths)}")
+
+    rows = lengths.pop() if lengths else 0
+    result = BatchResult(rows)
+
+    for column, values in columns.items():
+        if column not in rules:
+            continue
+        key, num_type = rules[column]
+        match = _MATCHERS[key]
+
+        if column == 'actual_returndate':
+            _check_return_dates(result, values, columns.get('loandate'), match)
+            continue
+
+        # Imported columns repeat the same values (names, cities, ages, dates), so every
+        # distinct value is checked once, and the rows are then marked by a set lookup
+        text = list(map(str, values))
+        distinct = set(text)
+        bad_format = {value for value in distinct if not match(value)}
+        _mark(result, text, bad_format, column, ERRORS[key])
+
+        if num_type is not None:
+            # Only the values of the right format are compared, as check_number does
+            mini, maxi = number_range(num_type)
+            out_of_range = {value for value in distinct - bad_format if not mini < int(value) <= maxi}
+            _mark(result, text, out_of_range, column, RANGE_ERRORS[num_type])
+
+    return result
+
+
+def _mark(result, text, bad_values, column, message):
+    # Marking the rows holding one of the bad values, scanning the column only if there is one
+    if bad_values:
+        result.add(compress(range(len(text)), map(bad_values.__contains__, text)), column, message)
+
+
+def _check_return_dates(result, values, loan_dates, match):
+    # Open loans have no return date; a return date must fall between the loan date and today.
+    # ISO dates compare as strings, so the range check needs no parsing.
+    today = date.today().isoformat()
+    text = [None if value in OPEN_LOAN else str(value) for value in values]
+    distinct = set(text)
+    distinct.discard(None)
+
+    bad_format = {value for value in distinct if not match(value)}
+    _mark(result, text, bad_format, 'actual_returndate', ERRORS['date'])
+
+    if loan_dates is None:
+        loan_dates = [''] * len(text)
+    out_of_range = [i for i, (value, loaned) in enumerate(zip(text, loan_dates))
+                    if value is not None and value not in bad_format and not str(loaned) <= value <= today]
+    result.add(out_of_range, 'actual_returndate', DATE_ERROR)
@@ -0,0 +1,277 @@
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import events
+from helpers import transaction
+from config import WRITER_MAX_DELAY, WRITER_MAX_BATCH
+
+
+# Single-writer commit queue.
+# Every write of the model classes (see DataBaseHandler._write) is handed to the writer thread
+# of its database file, which runs the writes that arrive close together in one transaction
+# and commits them at once (group commit), so many writes share one fsync instead of paying
+# one each.
+#
+# The writer takes the first waiting write, then keeps collecting writes for up to
+# WRITER_MAX_DELAY seconds or until it has WRITER_MAX_BATCH of them. Writes that arrive while
+# a batch is being committed wait for the next batch, so under load the batches grow by
+# themselves without any added delay.
+#
+# Each write runs inside its own savepoint, so a failing write (e.g. a duplicate ID) is undone
+# and reported to its caller alone, while the rest of the batch is committed. Every caller
+# gets a Future, which resolves once the batch holding its write is committed, i.e. durable,
+# and raises the write's error if it failed.
+#
+# The writers group the writes of the threads of one process (the HTTP service, the async
+# layer); separate desk processes each have their own writer, and take turns on the database
+# lock as before (see retry.py).
+
+_writers = {}                   # Database file -> Writer
+_writers_lock = threading.Lock()
+
+
+class WriteRequest:
+    """
+    One write handed to a writer.
+
+    Attributes:
+        action (str): The change made by the query ('insert', 'update', 'delete' or 'return').
+        obj (DataBaseHandler): The written model object, passed to the change event.
+        query (str): The SQL query.
+        parameters (tuple): Parameters for the query.
+        future (Future): Resolves to the number of changed rows once the write is committed.
+    """
+    __slots__ = ('action', 'obj', 'query', 'parameters', 'future', 'rowcount', 'error', 'done')
+
+    def __init__(self, action, obj, query, parameters=None):
+        self.action = action
+        self.obj = obj
+        self.query = query
+        self.parameters = parameters or ()
+        self.future = Future()
+        self.rowcount = 0
+        self.error = None  # The write's own error, set if its savepoint was rolled back
+        self.done = False  # Whether the write ran in the current batch
+
+
+class Writer:
+    """
+    The writer thread of one database file.
+
+    Args:
+        db (str): Path of the database file.
+        max_delay (float, optional): Seconds to keep collecting writes after the first one of a batch.
+        max_batch (int, optional): Maximum number of writes committed together.
+
+    Attributes:
+        batches (int): The number of committed batches.
+        writes (int): The number of writes in them.
+    """
+
+    def __init__(self, db, max_delay=WRITER_MAX_DELAY, max_batch=WRITER_MAX_BATCH):
+        self.db = db
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.SimpleQueue()
+        self._batch = None  # Writes of the batch being run
+        self._cursor = None
+        self._thread = threading.Thread(target=self._run, name=f"writer-{db}", daemon=True)
+        self._thread.start()
+
+    def submit(self, action, obj, query, parameters=None):
+        """
+        Hands a write to the writer.
+
+        Args:
+            action (str): The change made by the query ('insert', 'update', 'delete' or 'return').
+            obj (DataBaseHandler): The written model object.
+            query (str): The SQL query.
+            parameters (tuple, optional): Parameters for the query.
+
+        Returns:
+            Future: Resolves to the number of changed rows once the write is committed.
+        """
+        request = WriteRequest(action, obj, query, parameters)
+
+        if threading.current_thread() is self._thread:
+            # A write made by a change event's subscriber joins the batch being run, as waiting
+            # for the next batch would wait for the writer itself
+            self._execute(request)
+            self._batch.append(request)
+        else:
+            self._queue.put(request)
+
+        return request.future
+
+    def stop(self):
+        """
+        Commits the writes already handed over, then stops the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            request = self._queue.get()
+            if request is None:
+                break
+
+            # Collecting the writes that arrive within the delay, up to the batch size
+            batch = [request]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    remaining = deadline - time.monotonic()
+                    request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        self._batch = batch
+        try:
+            with transaction(self.db, write=True) as c:
+                self._cursor = c
+                for request in batch:
+                    if not request.done:
+                        self._execute(request)
+        except BaseException as e:
+            # Nothing of the batch was committed
+            for request in self._batch:
+                request.future.set_exception(request.error or e)
+            return
+        finally:
+            self._cursor = None
+            self._batch = None
+
+        self.batches += 1
+        self.writes += len(batch)
+        for request in batch:
+            if request.error is not None:
+                request.future.set_exception(request.error)
+            else:
+                request.future.set_result(request.rowcount)
+
+    def _execute(self, request):
+        c = self._cursor
+        request.done = True
+
+        c.execute("SAVEPOINT write;")
+        try:
+            c.execute(request.query, request.parameters)
+            request.rowcount = c.rowcount
+            if c.rowcount > 0:
+                events.publish(request.action, request.obj, c)
+        except Exception as e:
+            # Undoing this write only, the others of the batch are not affected
+            c.execute("ROLLBACK TO write;")
+            c.execute("RELEASE write;")
+            request.error = e
+        else:
+            c.execute("RELEASE write;")
+
+
+def get_writer(db):
+    """
+    Returns the writer of a database file, starting it on first use.
+
+    Args:
+        db (str): Path of the database file.
+
+    Returns:
+        Writer: The database's writer.
+    """
+    with _writers_lock:
+        if db not in _writers:
+            _writers[db] = Writer(db)
+
+        return _writers[db]
+
+
+def submit(db, action, obj, query, parameters=None):
+    """
+    Hands a write to the writer of a database file.
+
+    Args:
+        db (str): Path of the database file.
+        action (str): The change made by the query ('insert', 'update', 'delete' or 'return').
+        obj (DataBaseHandler): The written model object.
+        query (str): The SQL query.
+        parameters (tuple, optional): Parameters for the query.
+
+    Returns:
+        Future: Resolves to the number of changed rows once the write is committed.
+    """
+    return get_writer(db).submit(action, obj, query, parameters)
+
+
+def gather(futures):
+    """
+    Combines the futures of one write made on several databases.
+
+    Args:
+        futures (list): The futures of the write on each database.
+
+    Returns:
+        Future: Resolves to the total number of changed rows once every future is resolved, or
+            raises the first error among them.
+    """
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def resolved(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            combined.set_exception(errors[0])
+        else:
+            combined.set_result(sum(f.result() for f in futures))
+
+    for future in futures:
+        future.add_done_callback(resolved)
+
+    return combined
+
+
+def stop_writer(db):
+    """
+    Commits the pending writes of a database file and stops its writer.
+
+    Args:
+        db (str): Path of the database file.
+    """
+    with _writers_lock:
+        writer = _writers.pop(db, None)
+
+    if writer is not None:
+        writer.stop()
+
+
+def stop_writers():
+    """
+    Commits the pending writes of every database file and stops the writers.
+    """
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+
+    for writer in writers:
+        writer.stop()
+
+
+# Writes handed over without waiting for them are committed before the process exits
+atexit.register(stop_writers)